@@ -0,0 +1,220 @@
+"""
+Continuous batching of the osmosis sampling - a pool of in-flight images, each one at its own timestep.
+"""
+
+import numpy as np
+import torch
+from tqdm.auto import tqdm
+
+from telemetry import SamplingTelemetry
+import utils as utilso
+
+
+class ContinuousBatchingScheduler:
+    """
+    Sample a stream of images with a fixed size pool of in-flight images.
+
+    Every slot of the pool holds a single image at its own (respaced) timestep with its own phi's. All the
+    slots are packed into a single UNet call with a per sample timestep vector, and whenever an image
+    finishes its last step a new image is admitted into its slot, so a dataset run does not wait for the
+    slowest image of a static batch.
+
+    The guidance loss is a sum of per image losses, hence the x and phi gradients of every slot are
+    independent. The phi's of a slot are updated only when its own timestep is guided and not frozen, the
+    optimizer state of the other slots is kept as it is (an optimizer with per element state, see
+    noise.MASKED_SOLVERS).
+
+    :param sampler: the diffusion sampler (DDPM or DDIM, possibly respaced).
+    :param model: the diffusion model.
+    :param cond_method: the osmosis conditioning method, its operator is created with batch_size=pool_size.
+    :param sample_pattern: the sample pattern configuration (guidance, freeze phi and alternating windows).
+    :param pool_size: the number of in-flight images.
+    :param seed: the seed of the x_T noise of every admitted image (the same x_T as a sampling of a single
+                 image with torch.manual_seed(seed)), None - the global random state.
+    :param telemetry: SamplingTelemetry for the per step values of the pool.
+    """
+
+    def __init__(self, sampler, model, cond_method, sample_pattern, pool_size=4, seed=None, telemetry=None):
+        self.sampler = sampler
+        self.model = model
+        self.cond_method = cond_method
+        self.operator = cond_method.operator
+        self.sample_pattern = sample_pattern
+        self.pool_size = int(pool_size)
+        self.seed = seed
+        self.telemetry = telemetry if telemetry is not None else SamplingTelemetry(flush_every=1)
+
+        self.num_timesteps = sampler.num_timesteps
+        self.timestep_map = sampler.timestep_map
+        self.original_num_steps = sampler.original_num_steps
+        if hasattr(sampler, 'check_precision'):
+            sampler.check_precision(sample_pattern)
+        # the phi's of every slot are optimized independently (masked_optimize)
+        if hasattr(self.operator, 'check_masked_solver'):
+            self.operator.check_masked_solver()
+
+    # %% per slot schedule - python values only, no device synchronization
+
+    def _step_pattern(self, idx):
+        """
+        The sample pattern values of a single (respaced) timestep, according to the original timesteps.
+        """
+        original_idx = self.timestep_map[idx]
+        step_stride = original_idx - self.timestep_map[idx - 1] if idx > 0 else original_idx + 1
+
+        guidance_flag = (self.sample_pattern['pattern'] == 'original') or \
+                        (self.sample_pattern['pattern'] is None) or \
+                        (self.sample_pattern['start_guidance'] * self.original_num_steps >= original_idx >=
+                         self.sample_pattern['stop_guidance'] * self.original_num_steps)
+        freeze_phi = utilso.is_freeze_phi(self.sample_pattern, original_idx, self.original_num_steps)
+        alternate_len = utilso.set_alternate_length(self.sample_pattern, original_idx, self.original_num_steps)
+
+        return {'original_idx': original_idx, 'step_stride': step_stride, 'guidance': guidance_flag,
+                'freeze_phi': freeze_phi, 'alternate_len': alternate_len}
+
+    def _variables_dict(self):
+        names = self.operator.get_variable_gradients().keys()
+        return {key_ii: value_ii.detach() for key_ii, value_ii in zip(names, self.operator.get_variable_list())}
+
+    def _initial_noise(self, shape, device):
+        if self.seed is None:
+            return torch.randn(shape, device=device)
+        generator = torch.Generator(device=device).manual_seed(self.seed)
+        return torch.randn(shape, device=device, generator=generator)
+
+    # %% the pool sampling
+
+    def run(self, images):
+        """
+        Sample all the images of a stream, yield every image when it is finished.
+
+        :param images: an iterable of (measurement, info) - a [C x H x W] measurement in [-1,1] and
+                       any information of the image (e.g. its file name), which is returned with the result.
+        :return: a generator of dictionaries with the keys: info, sample, pred_xstart ([4 x H x W] cpu tensors),
+                 variables (the phi's of the image) and loss (the last guidance loss of the image).
+        """
+        images = iter(images)
+        pool_size = self.pool_size
+
+        # per slot state, a timestep of -1 means an empty slot
+        slot_idx = [-1] * pool_size
+        slot_alternate_ii = [0] * pool_size
+        slot_pattern = [None] * pool_size
+        slot_info = [None] * pool_size
+        img, measurement, slot_loss = None, None, None
+
+        def admit(slot_ii):
+            nonlocal img, measurement, slot_loss
+            try:
+                measurement_ii, info_ii = next(images)
+            except StopIteration:
+                slot_idx[slot_ii] = -1
+                return False
+
+            device = measurement_ii.device if img is None else img.device
+            measurement_ii = measurement_ii.to(device)
+            if img is None:
+                # allocate the pool according to the first image
+                measurement = torch.zeros((pool_size,) + tuple(measurement_ii.shape), device=device)
+                img = torch.zeros((pool_size, 4) + tuple(measurement_ii.shape[1:]), device=device)
+                slot_loss = torch.zeros(pool_size, device=device)
+
+            measurement[slot_ii] = measurement_ii
+            img[slot_ii] = self._initial_noise(img.shape[1:], device)
+            slot_loss[slot_ii] = 0
+            self.operator.reset_variables(slot_ii)
+
+            slot_idx[slot_ii] = self.num_timesteps - 1
+            slot_alternate_ii[slot_ii] = 0
+            slot_pattern[slot_ii] = self._step_pattern(slot_idx[slot_ii])
+            slot_info[slot_ii] = info_ii
+            return True
+
+        for slot_ii in range(pool_size):
+            admit(slot_ii)
+
+        # the model of the sampler step regions, wrapped once for the stream
+        model = self.sampler.wrap_model(self.model)
+
+        pbar = tqdm(desc="continuous batching")
+        self.telemetry.reset(pbar=pbar)
+        pool_step = 0
+
+        while any([idx_ii >= 0 for idx_ii in slot_idx]):
+            device = img.device
+            active = [idx_ii >= 0 for idx_ii in slot_idx]
+            guided = [active_ii and pattern_ii['guidance'] for active_ii, pattern_ii in zip(active, slot_pattern)]
+            update = [guided_ii and not pattern_ii['freeze_phi'] for guided_ii, pattern_ii in zip(guided, slot_pattern)]
+
+            # empty slots are sampled at t=0 and ignored
+            time = torch.tensor([max(idx_ii, 0) for idx_ii in slot_idx], device=device)
+            step_stride = torch.tensor([pattern_ii['step_stride'] if pattern_ii is not None else 1
+                                        for pattern_ii in slot_pattern], device=device)
+            time_index = torch.tensor([pattern_ii['original_idx'] / self.original_num_steps
+                                       if pattern_ii is not None else 0. for pattern_ii in slot_pattern],
+                                      device=device)
+
+            img.requires_grad = any(guided)
+
+            # a single unet call for the whole pool, every slot at its own timestep
+            out = self.sampler.denoise_step(model, img, time)
+            sample = out['mean']
+
+            if any(guided):
+                guided_mask = torch.tensor(guided, device=device).view(-1, 1, 1, 1)
+                update_mask = torch.tensor(update, device=device)
+                # the conditioning updates x_t in place
+                unguided_sample = sample.detach().clone()
+
+                sample, loss, _, _, _ = self.cond_method.conditioning(x_t=sample,
+                                                                      measurement=measurement,
+                                                                      x_prev=img,
+                                                                      x_0_hat=out['pred_xstart'],
+                                                                      freeze_phi=not any(update),
+                                                                      time_index=time_index,
+                                                                      step_stride=step_stride,
+                                                                      update_mask=update_mask,
+                                                                      telemetry=self.telemetry)
+                sample = torch.where(guided_mask, sample, unguided_sample)
+                slot_loss = torch.where(guided_mask.view(-1), loss, slot_loss)
+
+            # sampling new img - no noise for the slots at t == 0
+            noise = torch.randn_like(sample)
+            img = (sample + (time != 0).float().view(-1, 1, 1, 1) * out['std'] * noise).detach()
+
+            self.telemetry.record(pool_step, loss=slot_loss, variables=self._variables_dict(),
+                                  timesteps=list(slot_idx))
+            pool_step += 1
+            pbar.update(1)
+
+            # advance the slots, yield the finished images and admit new ones
+            for slot_ii in range(pool_size):
+                if not active[slot_ii]:
+                    continue
+
+                slot_alternate_ii[slot_ii] += 1
+                if slot_alternate_ii[slot_ii] < slot_pattern[slot_ii]['alternate_len']:
+                    continue
+
+                slot_alternate_ii[slot_ii] = 0
+                slot_idx[slot_ii] -= 1
+                if slot_idx[slot_ii] >= 0:
+                    slot_pattern[slot_ii] = self._step_pattern(slot_idx[slot_ii])
+                    continue
+
+                yield {'info': slot_info[slot_ii],
+                       'sample': img[slot_ii].detach().cpu(),
+                       'pred_xstart': out['pred_xstart'][slot_ii].detach().cpu(),
+                       'variables': {key_ii: value_ii[slot_ii].clone().cpu()
+                                     for key_ii, value_ii in self._variables_dict().items()},
+                       'loss': np.array(slot_loss[slot_ii].item())}
+
+                if not admit(slot_ii):
+                    slot_pattern[slot_ii] = None
+
+        # the frozen timestep table lookups of the pool (counted on the device)
+        if getattr(self.sampler, 'timestep_table', False) and hasattr(self.model, 'check_timesteps'):
+            self.model.check_timesteps()
+
+        self.telemetry.close()
+        pbar.close()
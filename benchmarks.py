@@ -0,0 +1,942 @@
+"""
+Micro benchmarks for the sampling hot path.
+
+Run for example:
+    python benchmarks.py schedule --steps 1000 --image_size 256
+    python benchmarks.py respacing -c osmosis_sample.yaml --respacing ddim50,ddim100,ddim250
+    python benchmarks.py batch -c osmosis_sample.yaml --batch_sizes 1,2,4,8 --device cpu
+    python benchmarks.py fast_path -c osmosis_sample.yaml --timestep_respacing 100
+    python benchmarks.py compile -c osmosis_sample.yaml --timestep_respacing ddim50 --device cpu
+    python benchmarks.py attention -c osmosis_sample.yaml --timestep_respacing ddim50
+    python benchmarks.py checkpointing -c osmosis_sample.yaml --memory_budget_mb 2000,4000
+    python benchmarks.py phi_gradients -c osmosis_sample.yaml --batch_size 2
+    python benchmarks.py phi_solver -c osmosis_sample.yaml --batch_size 2
+    python benchmarks.py pyramid -c osmosis_sample.yaml --timestep_respacing ddim50 --levels 0,1,2,3
+    python benchmarks.py config -c osmosis_sample.yaml --image_size 256
+    python benchmarks.py setup -c osmosis_sample.yaml --batch_size 1
+    python benchmarks.py sequence -c osmosis_sample.yaml --timestep_respacing ddim50 --start_t 0.4
+    python benchmarks.py sdedit -c osmosis_sample.yaml --timestep_respacing ddim50 --start_ts 1,0.8,0.6,0.4,0.2
+    python benchmarks.py early_termination -c osmosis_sample.yaml --timestep_respacing ddim50
+    python benchmarks.py feature_cache -c osmosis_sample.yaml --timestep_respacing ddim50 --cache_intervals 1,2,3,5
+    python benchmarks.py timestep_table -c osmosis_sample.yaml --timestep_respacing ddim50
+    python benchmarks.py load -c osmosis_sample.yaml --flat_path ./models/osmosis_outdoor.osm
+    python benchmarks.py precision -c osmosis_sample.yaml --timestep_respacing ddim50 --precisions bf16
+    python benchmarks.py quantization -c osmosis_sample.yaml --timestep_respacing ddim50 --device cpu
+"""
+
+import os
+import sys
+import copy
+import time
+import subprocess
+import resource
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from noise import get_noise, get_operator
+from condition import get_conditioning_method
+from unet import create_model, set_attention_backend, set_feature_cache
+from quantization import quantize_unet
+from gaussian_diffusion import create_sampler, get_named_beta_schedule, extract_and_expand
+from schedule_tables import ScheduleTables
+from compile_utils import compile_method, reset_compiled
+from checkpoint_policy import apply_checkpoint_policy, profile_blocks
+from sampling_config import SamplingConfig, DepthConfig
+from convergence import ConvergenceMonitor
+import utils as utilso
+import data as datao
+
+
+# %% timing helpers
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_function(fn, repeats=100, warmup=10, device=torch.device('cpu')):
+    """
+    Time a function and return the mean run time in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    _synchronize(device)
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    _synchronize(device)
+    return (time.perf_counter() - start_time) / repeats
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """
+    The peak allocated memory on cuda, on the cpu the peak resident memory of the process (it can not be reset).
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+# %% schedule tables - per step overhead of the coefficients lookup
+
+def bench_schedule(args):
+    device = torch.device(args.device)
+    betas = get_named_beta_schedule(args.noise_schedule, args.steps)
+    tables = ScheduleTables(betas, device=device)
+
+    # the numpy tables, as they were used by the processors before the device tables
+    alphas_cumprod = np.cumprod(1.0 - betas, axis=0)
+    alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+    posterior_variance = betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
+    numpy_tables = {
+        'sqrt_recip_alphas_cumprod': np.sqrt(1.0 / alphas_cumprod),
+        'sqrt_recipm1_alphas_cumprod': np.sqrt(1.0 / alphas_cumprod - 1),
+        'posterior_mean_coef1': betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod),
+        'posterior_mean_coef2': (1.0 - alphas_cumprod_prev) * np.sqrt(1.0 - betas) / (1.0 - alphas_cumprod),
+        'posterior_log_variance_clipped': np.log(np.append(posterior_variance[1], posterior_variance[1:])),
+        'sqrt_alphas_cumprod': np.sqrt(alphas_cumprod),
+        'sqrt_one_minus_alphas_cumprod': np.sqrt(1.0 - alphas_cumprod),
+    }
+    timestep_map = list(range(args.steps))
+
+    image_size = args.image_size or 256
+    x = torch.randn(args.batch_size, 4, image_size, image_size, device=device)
+    t = torch.tensor([args.steps // 2] * args.batch_size, device=device)
+
+    # the lookups of a single osmosis step: p_mean_variance (epsilon + learned_range), q_sample and the model wrapper
+    def legacy_step():
+        for array in numpy_tables.values():
+            extract_and_expand(array, t, x)
+        extract_and_expand(np.log(betas), t, x)
+        torch.tensor(timestep_map, device=t.device, dtype=t.dtype)[t]
+
+    def tables_step():
+        for name in list(numpy_tables.keys()) + ['log_betas']:
+            tables.extract(name, t, x)
+        tables.timestep_map[t]
+
+    legacy_time = time_function(legacy_step, repeats=args.repeats, device=device)
+    tables_time = time_function(tables_step, repeats=args.repeats, device=device)
+
+    print(f"Schedule lookups per step ({args.steps} steps table, device: {device})")
+    print(f"    numpy tables (before): {1e6 * legacy_time:.1f} us")
+    print(f"    device tables (after): {1e6 * tables_time:.1f} us")
+    print(f"    speedup: x{legacy_time / tables_time:.1f}, "
+          f"saved per {args.steps} steps sampling: {1e3 * args.steps * (legacy_time - tables_time):.1f} ms")
+
+
+# %% osmosis sampling helpers - build the sampling objects from a configuration file
+
+def load_config(args):
+    config = utilso.arguments_from_file(args.config_file)
+    if args.image_size is not None:
+        config.unet_model['image_size'] = args.image_size
+    if args.num_channels is not None:
+        config.unet_model['num_channels'] = args.num_channels
+    # random weights - the checkpoint does not fit an overridden model, or it is not available
+    if args.image_size is not None or args.num_channels is not None or \
+            not os.path.isfile(config.unet_model.get('model_path', '') or ''):
+        config.unet_model['model_path'] = ''
+    return config
+
+
+def load_measurement(config, batch_size, device):
+    # the same preprocessing as in osmosis_inference
+    image_size = config.unet_model['image_size']
+    transform = transforms.Compose([transforms.ToTensor(),
+                                    transforms.Resize(size=image_size),
+                                    transforms.CenterCrop(size=[image_size, image_size]),
+                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+    dataset = datao.ImagesFolder(config.data['root'], transform)
+    measurement = torch.stack([dataset[ii % len(dataset)][0] for ii in range(batch_size)])
+    return measurement.to(device)
+
+
+def build_osmosis(config, device, batch_size=1, model=None, sample_pattern=None, **diffusion_overrides):
+    """
+    Create the model, the conditioning method and the sampler of the osmosis sampling.
+    """
+    sample_pattern = sample_pattern if sample_pattern is not None else config.sample_pattern
+    if model is None:
+        model = create_model(**config.unet_model).to(device).eval()
+
+    sampling_config = SamplingConfig.from_args(config, device)
+    operator_config = dict(sampling_config.operator_params(config.measurement['operator']), batch_size=batch_size)
+    operator = get_operator(device=device, **operator_config)
+    if dict(config.diffusion, **diffusion_overrides).get('compile', False):
+        compile_method(operator, "forward")
+    noiser = get_noise(**config.measurement['noise'])
+    cond_method = get_conditioning_method(config.conditioning['method'], operator, noiser,
+                                          **sampling_config.conditioning_params(config.conditioning['params']),
+                                          **sample_pattern, **config.aux_loss)
+    sampler = create_sampler(**dict(config.diffusion, **diffusion_overrides), device=device)
+
+    return model, cond_method, sampler
+
+
+def run_osmosis(config, model, cond_method, sampler, measurement, seed=0, **kwargs):
+    """
+    Run a single osmosis sampling and return its outputs and run time in seconds.
+    """
+    torch.manual_seed(seed)
+    x_start_shape = list(measurement.shape)
+    x_start_shape[1] = 4
+    x_start = kwargs.pop('x_start', None)
+    x_start = torch.randn(x_start_shape, device=measurement.device) if x_start is None else x_start
+
+    sample_pattern = kwargs.pop('sample_pattern', config.sample_pattern)
+
+    start_time = time.perf_counter()
+    sample, variable_dict, loss, out_xstart = sampler.p_sample_loop(model=model, x_start=x_start,
+                                                                    measurement=measurement,
+                                                                    measurement_cond_fn=cond_method.conditioning,
+                                                                    record=False, save_root=None,
+                                                                    pretrain_model='osmosis',
+                                                                    sample_pattern=sample_pattern,
+                                                                    **kwargs)
+    _synchronize(measurement.device)
+    run_time = time.perf_counter() - start_time
+
+    return {'sample': sample, 'variables': variable_dict, 'loss': loss, 'pred_xstart': out_xstart}, run_time
+
+
+def compare_outputs(outputs, reference):
+    """
+    Mean absolute differences of the rgb [0,1], the depth [0,1] (min-max normalized) and the phi's.
+    """
+    rgb = torch.clamp(0.5 * (outputs['pred_xstart'][:, 0:3] + 1), 0, 1)
+    rgb_ref = torch.clamp(0.5 * (reference['pred_xstart'][:, 0:3] + 1), 0, 1)
+    depth = utilso.min_max_norm_range(outputs['pred_xstart'][:, 3:4])
+    depth_ref = utilso.min_max_norm_range(reference['pred_xstart'][:, 3:4])
+    phi_diff = max([(outputs['variables'][key_ii] - reference['variables'][key_ii]).abs().max().item()
+                    for key_ii in reference['variables'].keys()])
+
+    return {'rgb_l1': (rgb - rgb_ref).abs().mean().item(),
+            'depth_l1': (depth - depth_ref).abs().mean().item(),
+            'phi_max_diff': phi_diff}
+
+
+# %% respaced (DDIM) osmosis sampling - run time and difference from the full schedule
+
+def bench_respacing(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    measurement = load_measurement(config, args.batch_size, device)
+
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size)
+    reference, reference_time = run_osmosis(config, model, cond_method, sampler, measurement)
+    print(f"reference: {config.diffusion['sampler']}, {sampler.num_timesteps} steps, {reference_time:.1f} sec")
+
+    for respacing in args.respacing.split(","):
+        sampler_name = "ddim" if respacing.startswith("ddim") else args.sampler
+        _, cond_method, sampler = build_osmosis(config, device, args.batch_size, model=model,
+                                                sampler=sampler_name, timestep_respacing=respacing)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement)
+        differences = compare_outputs(outputs, reference)
+        print(f"{sampler_name}, {sampler.num_timesteps} steps: {run_time:.1f} sec "
+              f"(x{reference_time / run_time:.1f}), " +
+              ", ".join([f"{key_ii}: {value_ii:.4f}" for key_ii, value_ii in differences.items()]))
+
+
+# %% batched osmosis sampling - throughput (images per hour) as a function of the batch size
+
+def bench_batch(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+
+    model = None
+    for batch_size in [int(batch_size_ii) for batch_size_ii in args.batch_sizes.split(",")]:
+        measurement = load_measurement(config, batch_size, device)
+        model, cond_method, sampler = build_osmosis(config, device, batch_size, model=model, **diffusion_overrides)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement)
+        print(f"batch size {batch_size}, {sampler.num_timesteps} steps: {run_time:.1f} sec, "
+              f"{3600 * batch_size / run_time:.1f} images/hour, "
+              f"final loss per image: {np.round(outputs['loss'], decimals=3)}")
+
+
+# %% steps without guidance - inference mode fast path against the autograd path, and the guided steps
+
+def bench_fast_path(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size, **diffusion_overrides)
+
+    # no guidance at all - every step is a "non guided" step
+    no_guidance_pattern = dict(config.sample_pattern, start_guidance=-1, stop_guidance=-1)
+
+    # the cpu peak memory can not be reset - the runs are ordered from the expected lowest peak
+    runs = [('no guidance, inference mode', no_guidance_pattern, True),
+            ('no guidance, autograd', no_guidance_pattern, False),
+            ('guided', config.sample_pattern, True)]
+
+    print(f"per step time and peak memory ({sampler.num_timesteps} steps, batch size {args.batch_size}, "
+          f"device: {device})")
+    reference = None
+    for name, sample_pattern, fast_path in runs:
+        reset_peak_memory(device)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement,
+                                        sample_pattern=sample_pattern, inference_fast_path=fast_path)
+        line = f"    {name}: {1e3 * run_time / sampler.num_timesteps:.1f} ms/step, " \
+               f"peak memory: {peak_memory_mb(device):.0f} MB"
+        # the fast path should not change a deterministic (ddim, eta=0) sampling
+        if reference is None:
+            reference = outputs
+        elif sample_pattern is no_guidance_pattern and getattr(sampler, 'eta', None) == 0:
+            line += f", max difference: {(outputs['sample'] - reference['sample']).abs().max().item():.2e}"
+        print(line)
+
+
+# %% torch.compile - eager against compiled (the first compiled image includes the compilation)
+
+def bench_compile(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size, compile=False,
+                                                **diffusion_overrides)
+    reference, eager_time = run_osmosis(config, model, cond_method, sampler, measurement)
+    print(f"eager: {eager_time:.1f} sec ({sampler.num_timesteps} steps, device: {device})")
+
+    reset_compiled()
+    # the sampler and the operator are built once and reset per image, as in osmosis_inference - the step regions
+    # are compiled by the first image, the second one is the steady state
+    _, cond_method, sampler = build_osmosis(config, device, args.batch_size, model=model, compile=True,
+                                            **diffusion_overrides)
+    for image_ii in range(2):
+        cond_method.reset(batch_size=args.batch_size)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement)
+        differences = compare_outputs(outputs, reference)
+        print(f"compiled, image {image_ii}: {run_time:.1f} sec (x{eager_time / run_time:.2f}), " +
+              ", ".join([f"{key_ii}: {value_ii:.2e}" for key_ii, value_ii in differences.items()]))
+
+
+# %% attention backends - the einsum (materialized weights) against sdpa, on the configuration checkpoint
+
+def bench_attention(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size, **diffusion_overrides)
+
+    # a single unet forward and backward (as in a guided step)
+    x = torch.randn((args.batch_size, 4) + tuple(measurement.shape[2:]), device=device)
+    t = torch.tensor([sampler.num_timesteps // 2] * args.batch_size, device=device)
+
+    def unet_step():
+        x_ii = x.clone().requires_grad_()
+        out = model(x_ii, t)
+        return out.detach(), torch.autograd.grad(out.square().sum(), x_ii)[0]
+
+    # the cpu peak memory can not be reset - the runs are ordered from the expected lowest peak
+    print(f"attention backends ({sampler.num_timesteps} steps, batch size {args.batch_size}, device: {device})")
+    unet_outputs, reference = {}, None
+    for backend in ["sdpa", "einsum"]:
+        set_attention_backend(model, backend)
+        reset_peak_memory(device)
+        unet_outputs[backend] = unet_step()
+        step_time = time_function(unet_step, repeats=args.repeats, warmup=1, device=device)
+        _, cond_method, sampler = build_osmosis(config, device, args.batch_size, model=model, **diffusion_overrides)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement)
+        line = f"    {backend}: unet forward + backward {1e3 * step_time:.1f} ms, sampling {run_time:.1f} sec, " \
+               f"peak memory: {peak_memory_mb(device):.0f} MB"
+        if reference is None:
+            reference = outputs
+        else:
+            line += ", " + ", ".join([f"{key_ii}: {value_ii:.2e}"
+                                      for key_ii, value_ii in compare_outputs(outputs, reference).items()])
+        print(line)
+
+    # the numerical check of the unet itself (the sampling differences also grow along the steps)
+    for name, index in [('output', 0), ('input gradient', 1)]:
+        difference = (unet_outputs['sdpa'][index] - unet_outputs['einsum'][index]).abs().max().item()
+        scale = unet_outputs['einsum'][index].abs().max().item()
+        print(f"    unet {name} max difference: {difference:.2e} (max value {scale:.2e})")
+
+
+# %% activation checkpointing policies - unet forward + backward time and the kept activations
+
+def kept_activations_mb(model, x, t):
+    """
+    The activations which are kept for the backward of a unet call (each storage once, without the parameters).
+    """
+    param_keys = set([param.untyped_storage().data_ptr() for param in model.parameters()])
+    saved = {}
+
+    def pack(tensor):
+        key = tensor.untyped_storage().data_ptr()
+        if key not in param_keys:
+            saved[key] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    x = x.clone().requires_grad_()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(x, t)
+    return sum(saved.values()) / 2 ** 20
+
+
+def bench_checkpointing(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    model = create_model(**config.unet_model).to(device).eval()
+    image_size = config.unet_model['image_size']
+    sample_shape = (args.batch_size, 4, image_size, image_size)
+
+    x = torch.randn(sample_shape, device=device)
+    t = torch.tensor([500] * args.batch_size, device=device)
+
+    def unet_step():
+        x_ii = x.clone().requires_grad_()
+        return torch.autograd.grad(model(x_ii, t).square().sum(), x_ii)[0]
+
+    profile, other_bytes = profile_blocks(model, sample_shape, device)
+    print(f"unet blocks (batch size {args.batch_size}, image size {image_size}, device: {device}), "
+          f"activations outside the blocks {other_bytes / 2 ** 20:.0f} MB")
+    for block_ii in profile:
+        print(f"    {block_ii['name']} ({block_ii['type']}, {block_ii['resolution']}): "
+              f"{block_ii['saved_bytes'] / 2 ** 20:.0f} MB, {1e3 * block_ii['time']:.1f} ms")
+
+    policies = [('none', {}), ('select', {'block_types': ['attention']}), ('all', {})] + \
+               [('auto', {'memory_budget_mb': float(budget)}) for budget in args.memory_budget_mb.split(",")]
+    reference = None
+    for policy, policy_kwargs in policies:
+        names = apply_checkpoint_policy(model, policy, sample_shape=sample_shape, device=device, **policy_kwargs)
+        reset_peak_memory(device)
+        gradient = unet_step()
+        step_time = time_function(unet_step, repeats=args.repeats, warmup=1, device=device)
+        line = f"{policy} {policy_kwargs if policy_kwargs else ''}: {len(names)} blocks, " \
+               f"forward + backward {1e3 * step_time:.1f} ms, " \
+               f"kept activations {kept_activations_mb(model, x, t):.0f} MB"
+        if device.type == 'cuda':
+            line += f", peak memory {peak_memory_mb(device):.0f} MB"
+        if reference is None:
+            reference = gradient
+        else:
+            line += f", gradient max difference {(gradient - reference).abs().max().item():.2e}"
+        print(line)
+
+
+# %% analytic phi gradients - checked against autograd for every operator, and the inner loop run time
+
+PHI_OPERATORS = {'underwater_physical_revised': {'phi_a': "1.1,0.95,0.95", 'phi_b': "0.95,0.8,0.8",
+                                                 'phi_inf': "0.14,0.29,0.49"},
+                 'underwater_physical': {'phi_ab': "1.1,0.95,0.95", 'phi_inf': "0.14,0.29,0.49"},
+                 'haze_physical': {'phi_ab': "1.1", 'phi_inf': "0.6,0.6,0.6"}}
+
+
+def bench_phi_gradients(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    image_size = config.unet_model['image_size']
+    noiser = get_noise(**config.measurement['noise'])
+
+    torch.manual_seed(0)
+    x_0_hat = torch.tanh(torch.randn(args.batch_size, 4, image_size, image_size, device=device))
+    measurement = torch.tanh(torch.randn(args.batch_size, 3, image_size, image_size, device=device))
+
+    print(f"analytic phi gradients against autograd (batch size {args.batch_size}, image size {image_size}, "
+          f"device: {device})")
+    for operator_name, phi_values in PHI_OPERATORS.items():
+        for loss_function in ["norm", "mse"]:
+            for loss_weight in ["none", "depth"]:
+                operator = get_operator(name=operator_name, device=device, batch_size=args.batch_size,
+                                        optimizer="GD", depth_type="gamma", value="1.4,1.4,1", **phi_values)
+                # different phi's per image
+                with torch.no_grad():
+                    for variable_ii in operator.get_variable_list():
+                        variable_ii.mul_(1 + 0.1 * torch.randn_like(variable_ii))
+                cond_method = get_conditioning_method(config.conditioning['method'], operator, noiser,
+                                                      **dict(config.conditioning['params'],
+                                                             loss_function=loss_function, loss_weight=loss_weight,
+                                                             weight_function="gamma,1.4,1.4,1"))
+                variables = operator.get_variable_list()
+                operator.set_variable_gradients(value=True)
+
+                def autograd_gradients():
+                    _, loss, _ = cond_method.grad_and_value(x_prev=None, x_0_hat=x_0_hat, measurement=measurement)
+                    return torch.autograd.grad(loss, variables)
+
+                def analytic_gradients():
+                    for variable_ii in variables:
+                        variable_ii.grad = None
+                    cond_method.analytic_phi_gradients(**cond_method.analytic_terms(x_0_hat, measurement))
+                    return [variable_ii.grad for variable_ii in variables]
+
+                differences = [((analytic_ii - autograd_ii).abs().max() / autograd_ii.abs().max()).item()
+                               for analytic_ii, autograd_ii in zip(analytic_gradients(), autograd_gradients())]
+
+                # the inner loop - the analytic terms of x0 are computed once per step
+                def autograd_loop():
+                    for _ in range(args.n_iter):
+                        autograd_gradients()
+
+                def analytic_loop():
+                    analytic_terms = cond_method.analytic_terms(x_0_hat, measurement)
+                    for _ in range(args.n_iter):
+                        cond_method.analytic_phi_gradients(**analytic_terms)
+
+                autograd_time = time_function(autograd_loop, repeats=args.repeats, warmup=2, device=device)
+                analytic_time = time_function(analytic_loop, repeats=args.repeats, warmup=2, device=device)
+                print(f"    {operator_name}, {loss_function}, loss weight {loss_weight}: relative max difference " +
+                      ", ".join([f"{key_ii} {value_ii:.1e}" for key_ii, value_ii in
+                                 zip(operator.get_variable_gradients().keys(), differences)]) +
+                      f" - {args.n_iter} iterations: autograd {1e3 * autograd_time:.1f} ms, "
+                      f"analytic {1e3 * analytic_time:.1f} ms (x{autograd_time / analytic_time:.1f})")
+
+
+# %% phi solver (optimizer: lm) - recovering known phi's of a synthetic measurement, against sgd
+
+PHI_TRUTH = {'underwater_physical_revised': {'phi_a': "0.6,0.4,0.3", 'phi_b': "1.2,1.0,0.9", 'phi_inf': "0.1,0.4,0.6"},
+             'underwater_physical': {'phi_ab': "0.6,0.4,0.3", 'phi_inf': "0.1,0.4,0.6"},
+             'haze_physical': {'phi_ab': "0.5", 'phi_inf': "0.7,0.7,0.7"}}
+
+
+def bench_phi_solver(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    image_size = config.unet_model['image_size']
+    noiser = get_noise(**config.measurement['noise'])
+    operator_config = {'device': device, 'batch_size': args.batch_size, 'depth_type': "gamma", 'value': "1.4,1.4,1"}
+
+    torch.manual_seed(0)
+    x_0_hat = torch.tanh(torch.randn(args.batch_size, 4, image_size, image_size, device=device))
+
+    print(f"phi recovery from the initialization (batch size {args.batch_size}, image size {image_size}, "
+          f"{args.n_iter} iterations or lm steps per guided step, device: {device})")
+    for operator_name, phi_values in PHI_OPERATORS.items():
+        truth = get_operator(name=operator_name, optimizer="GD", **operator_config, **PHI_TRUTH[operator_name])
+        measurement = 2 * truth.forward(x_0_hat) - 1
+
+        for optimizer in ["sgd", "lm"]:
+            operator = get_operator(name=operator_name, optimizer=optimizer, lm_steps=args.n_iter,
+                                    **operator_config, **phi_values)
+            cond_method = get_conditioning_method(config.conditioning['method'], operator, noiser,
+                                                  **dict(config.conditioning['params'], loss_weight="none"),
+                                                  n_iter=args.n_iter)
+            x_0_step = x_0_hat.clone().requires_grad_()
+
+            # guided steps on the same x0 prediction - the phi's are carried over between the steps
+            start_time = time.perf_counter()
+            for step_ii in range(args.guided_steps):
+                cond_method.conditioning(x_prev=x_0_step, x_t=torch.zeros_like(x_0_hat), x_0_hat=x_0_step,
+                                         measurement=measurement)
+                x_0_step.grad = None
+            _synchronize(device)
+            run_time = time.perf_counter() - start_time
+
+            phi_error = max([(variable_ii - truth_ii).abs().max().item() for variable_ii, truth_ii in
+                             zip(operator.get_variable_list(), truth.get_variable_list())])
+            print(f"    {operator_name}, {optimizer}: {args.guided_steps} guided steps {1e3 * run_time:.0f} ms, "
+                  f"phi max error {phi_error:.2e}")
+
+
+# %% phi estimation on a pyramid level - run time and the difference from the full resolution estimation
+
+def bench_pyramid(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+
+    model, reference, reference_time = None, None, None
+    for level in [int(level_ii) for level_ii in args.levels.split(",")]:
+        sample_pattern = dict(config.sample_pattern, phi_pyramid_level=level)
+        model, cond_method, sampler = build_osmosis(config, device, args.batch_size, model=model,
+                                                    sample_pattern=sample_pattern, **diffusion_overrides)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement,
+                                        sample_pattern=sample_pattern)
+        line = f"level {level} ({config.unet_model['image_size'] // 2 ** level}px phi estimation): {run_time:.1f} sec"
+        if reference is None:
+            reference, reference_time = outputs, run_time
+        else:
+            line += f" (x{reference_time / run_time:.2f}), " + \
+                    ", ".join([f"{key_ii}: {value_ii:.4f}" for key_ii, value_ii in
+                               compare_outputs(outputs, reference).items()])
+        print(line + f", final loss per image: {np.round(outputs['loss'], decimals=3)}")
+
+
+# %% parsed configuration - per call overhead of the loss weight and the operator depth (strings vs parsed once)
+
+def bench_config(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    params = config.conditioning['params']
+    operator_config = config.measurement['operator']
+    x_0_hat = torch.rand(args.batch_size, 4, args.image_size, args.image_size, device=device) * 2 - 1
+
+    sampling_config = SamplingConfig.from_args(config, device)
+    weight_str, weight_parsed = params['weight_function'], sampling_config.weight_function
+    cases = {'loss weight': (lambda: utilso.set_loss_weight('depth', weight_function=weight_str, x_0_hat=x_0_hat),
+                             lambda: utilso.set_loss_weight('depth', weight_function=weight_parsed, x_0_hat=x_0_hat)),
+             'operator depth': (lambda: utilso.convert_depth(x_0_hat[:, 3:], depth_type=operator_config['depth_type'],
+                                                             value=operator_config['value']),
+                                lambda: sampling_config.depth(x_0_hat[:, 3:]))}
+
+    print(f"parsed config: {sampling_config}")
+    for name, (string_fn, parsed_fn) in cases.items():
+        string_time = time_function(string_fn, repeats=args.repeats, device=device)
+        parsed_time = time_function(parsed_fn, repeats=args.repeats, device=device)
+        diff = (string_fn() - parsed_fn()).abs().max().item()
+        print(f"{name}: string {1e6 * string_time:.1f} us, parsed {1e6 * parsed_time:.1f} us "
+              f"(x{string_time / parsed_time:.2f}), max difference {diff:.2e}")
+
+
+# %% per image setup - constructing the operator, conditioning and sampler vs resetting persistent ones
+
+def bench_setup(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    model = create_model(**config.unet_model).to(device).eval()
+    _, cond_method, _ = build_osmosis(config, device, args.batch_size, model=model)
+
+    construct_time = time_function(lambda: build_osmosis(config, device, args.batch_size, model=model),
+                                   repeats=args.repeats, warmup=2, device=device)
+    reset_time = time_function(lambda: cond_method.reset(batch_size=args.batch_size),
+                               repeats=args.repeats, warmup=2, device=device)
+    print(f"per image setup: construct {1e3 * construct_time:.2f} ms, reset {1e3 * reset_time:.3f} ms "
+          f"(x{construct_time / reset_time:.0f})")
+
+
+# %% sequence mode - every frame from pure noise vs from the previous frame (phi warm start and a noised start)
+
+def bench_sequence(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    frames = load_measurement(config, len(datao.ImagesFolder(config.data['root'])), device)
+    model, cond_method, sampler = build_osmosis(config, device, 1, **diffusion_overrides)
+
+    previous = None
+    for frame_ii in range(frames.shape[0]):
+        measurement = frames[frame_ii:frame_ii + 1]
+        cond_method.reset(batch_size=1)
+        full, full_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed)
+        line = f"frame {frame_ii}: from noise {sampler.num_timesteps} steps {full_time:.1f} sec, " \
+               f"loss {np.round(full['loss'], decimals=3)}"
+
+        # the first frame of the sequence starts from noise
+        if previous is None:
+            sequence = full
+        else:
+            cond_method.reset(batch_size=1, init_phi={key_ii: value_ii[-1:]
+                                                      for key_ii, value_ii in previous['variables'].items()})
+            torch.manual_seed(config.manual_seed)
+            x_start, start_steps = sampler.q_sample_start(previous['pred_xstart'].to(device), args.start_t)
+            sequence, sequence_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed,
+                                                  x_start=x_start, start_steps=start_steps)
+            line += f" | sequence {start_steps} steps {sequence_time:.1f} sec (x{full_time / sequence_time:.2f}), " \
+                    f"loss {np.round(sequence['loss'], decimals=3)}, " + \
+                    ", ".join([f"{key_ii}: {value_ii:.4f}" for key_ii, value_ii in
+                               compare_outputs(sequence, full).items()])
+        previous = sequence
+        print(line)
+
+
+# %% partial (SDEdit like) sampling from the measurement - quality against the number of steps
+
+def bench_sdedit(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size, **diffusion_overrides)
+
+    guess_config = getattr(config, 'initial_guess', None) or {}
+    prior = args.depth_prior or guess_config.get('depth_prior', 'constant')
+    x_0_guess = utilso.initial_rgbd_guess(measurement, prior=prior, patch_size=guess_config.get('patch_size', 15))
+
+    reference, reference_time = None, None
+    for start_t in [float(start_t_ii) for start_t_ii in args.start_ts.split(",")]:
+        cond_method.reset(batch_size=args.batch_size)
+        torch.manual_seed(config.manual_seed)
+        x_start, start_steps = sampler.q_sample_start(x_0_guess, start_t) if start_t < 1 else (None, None)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed,
+                                        x_start=x_start, start_steps=start_steps)
+
+        line = f"start_t {start_t} ({start_steps or sampler.num_timesteps} steps, {prior} depth): {run_time:.1f} sec"
+        if reference is None:
+            reference, reference_time = outputs, run_time
+        else:
+            line += f" (x{reference_time / run_time:.2f}), " + \
+                    ", ".join([f"{key_ii}: {value_ii:.4f}" for key_ii, value_ii in
+                               compare_outputs(outputs, reference).items()])
+        print(line + f", final loss per image: {np.round(outputs['loss'], decimals=3)}")
+
+
+# %% adaptive early termination - skipped steps, run time and difference from the full sampling
+
+def bench_early_termination(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size, **diffusion_overrides)
+
+    termination_config = dict(getattr(config, 'early_termination', None) or {}, enable=True)
+    if args.tol is not None:
+        termination_config['tol'] = args.tol
+
+    cond_method.reset(batch_size=args.batch_size)
+    reference, reference_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed)
+    print(f"full sampling: {sampler.num_timesteps} steps, {reference_time:.1f} sec, "
+          f"final loss per image: {np.round(reference['loss'], decimals=3)}")
+
+    for mode in ['stop', 'jump']:
+        convergence = ConvergenceMonitor(**dict(termination_config, mode=mode))
+        cond_method.reset(batch_size=args.batch_size)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed,
+                                        convergence=convergence)
+        if convergence.terminated_at is None:
+            print(f"{mode}: not converged (tol {convergence.tol}), {run_time:.1f} sec")
+            continue
+        print(f"{mode}: terminated at step {convergence.terminated_at}, skipped {convergence.skipped_steps} of "
+              f"{sampler.num_timesteps} steps, {run_time:.1f} sec (x{reference_time / run_time:.2f}), " +
+              ", ".join([f"{key_ii}: {value_ii:.4f}" for key_ii, value_ii in
+                         compare_outputs(outputs, reference).items()]))
+
+
+# %% DeepCache-style feature reuse of the unet - run time and difference from the full unet
+
+def bench_feature_cache(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size, **diffusion_overrides)
+
+    x = torch.randn(args.batch_size, 4, config.unet_model['image_size'], config.unet_model['image_size'], device=device)
+    t = torch.full((args.batch_size,), sampler.num_timesteps // 2, device=device)
+
+    reference, reference_time = None, None
+    for interval in [int(interval_ii) for interval_ii in args.cache_intervals.split(",")]:
+        set_feature_cache(model, interval=interval, depth=args.cache_depth)
+
+        # the unet call after a cache call - a reuse call (a full call for interval 1)
+        with torch.no_grad():
+            model.reset_feature_cache()
+            model(x, t)
+            forward_time = time_function(lambda: model(x, t), repeats=1, warmup=0, device=device)
+
+        cond_method.reset(batch_size=args.batch_size)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed)
+        line = f"interval {interval} (depth {args.cache_depth}): unet call {1e3 * forward_time:.1f} ms, " \
+               f"sampling {run_time:.1f} sec"
+        if reference is None:
+            reference, reference_time = outputs, run_time
+        else:
+            line += f" (x{reference_time / run_time:.2f}), " + \
+                    ", ".join([f"{key_ii}: {value_ii:.4f}" for key_ii, value_ii in
+                               compare_outputs(outputs, reference).items()])
+        print(line + f", final loss per image: {np.round(outputs['loss'], decimals=3)}")
+    set_feature_cache(model, interval=0)
+
+
+# %% frozen timestep embeddings - a unet call with the precomputed table against the computed embeddings
+
+def bench_timestep_table(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    model = create_model(**config.unet_model).to(device).eval()
+    sampler = create_sampler(**dict(config.diffusion, **diffusion_overrides, timestep_table=True), device=device)
+
+    x = torch.randn(args.batch_size, 4, config.unet_model['image_size'], config.unet_model['image_size'], device=device)
+    t = torch.tensor([sampler.num_timesteps // 2] * args.batch_size, device=device)
+
+    def unet_call():
+        with torch.no_grad():
+            return sampler.p_mean_variance(model, x, t)['pred_xstart']
+
+    start_time = time.perf_counter()
+    frozen = unet_call()
+    build_time = time.perf_counter() - start_time
+    frozen_time = time_function(unet_call, repeats=args.repeats, warmup=1, device=device)
+
+    table = model.timestep_table
+    model.unfreeze_timesteps()
+    sampler.timestep_table = False
+    computed = unet_call()
+    computed_time = time_function(unet_call, repeats=args.repeats, warmup=1, device=device)
+
+    print(f"timestep table ({len(table.timesteps)} timesteps, {len(table.blocks)} blocks, {table.size_mb():.1f} MB, "
+          f"built in {build_time:.2f} sec with the first call)")
+    print(f"    computed embeddings: {1e3 * computed_time:.2f} ms per unet call")
+    print(f"    frozen table: {1e3 * frozen_time:.2f} ms per unet call (x{computed_time / frozen_time:.2f}), "
+          f"max difference {(frozen - computed).abs().max().item():.2e}")
+
+
+# %% model loading - startup time and peak resident memory, every loader in a fresh process
+
+def bench_load(args):
+    config = utilso.arguments_from_file(args.config_file)
+    model_path = config.unet_model['model_path']
+    if not os.path.isfile(model_path):
+        print(f"load: the checkpoint {model_path} is not available")
+        return
+
+    # a single loader (the subprocess of the benchmark), flat - the converted flat checkpoint
+    if args.loader is not None:
+        if args.loader == 'flat':
+            config.unet_model['model_path'] = args.flat_path
+        start_time = time.perf_counter()
+        model = create_model(**dict(config.unet_model, low_memory_load=(args.loader != 'legacy')))
+        load_time = time.perf_counter() - start_time
+        num_params = sum([param.numel() for param in model.parameters()])
+        print(f"    {args.loader}: {load_time:.2f} sec, peak RSS {peak_memory_mb(torch.device('cpu')):.0f} MB "
+              f"({num_params * 4 / 2 ** 20:.0f} MB of float32 weights)")
+        return
+
+    print(f"load {model_path} ({os.path.getsize(model_path) / 2 ** 20:.0f} MB checkpoint)")
+    for loader in ['legacy', 'meta'] + (['flat'] if args.flat_path else []):
+        subprocess.run([sys.executable, __file__, 'load', '-c', args.config_file, '--loader', loader] +
+                       (['--flat_path', args.flat_path] if args.flat_path else []), check=True)
+
+
+# %% mixed precision sampling - run time and the accuracy guard against fp32 on the sample image
+
+PRECISION_TOLERANCES = {'rgb_l1': 'rgb_tol', 'depth_l1': 'depth_tol', 'phi_max_diff': 'phi_tol'}
+
+
+def bench_precision(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+
+    model, cond_method, sampler = build_osmosis(config, device, args.batch_size, precision='fp32',
+                                                **diffusion_overrides)
+    reference, reference_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed)
+    print(f"fp32: {sampler.num_timesteps} steps, {reference_time:.1f} sec")
+
+    failed = []
+    for precision in args.precisions.split(","):
+        _, cond_method, sampler = build_osmosis(config, device, args.batch_size, model=model, precision=precision,
+                                                **diffusion_overrides)
+        outputs, run_time = run_osmosis(config, model, cond_method, sampler, measurement, seed=config.manual_seed)
+        differences = compare_outputs(outputs, reference)
+        checks = {key_ii: differences[key_ii] <= getattr(args, tol_ii) for key_ii, tol_ii in PRECISION_TOLERANCES.items()}
+        print(f"{precision}: {run_time:.1f} sec (x{reference_time / run_time:.2f}), " +
+              ", ".join([f"{key_ii}: {value_ii:.4f} ({'ok' if checks[key_ii] else 'FAILED'})"
+                         for key_ii, value_ii in differences.items()]))
+        failed += [precision] if not all(checks.values()) else []
+
+    # the accuracy guard - a non zero exit code if a precision mode is out of the tolerances
+    if failed:
+        print(f"accuracy check failed: {failed} (tolerances rgb {args.rgb_tol}, depth {args.depth_tol}, "
+              f"phi {args.phi_tol})")
+        sys.exit(1)
+
+
+# %% weight-only int8 unet - unet forward + backward time, sampling time and difference from fp32
+
+def bench_quantization(args):
+    device = torch.device(args.device)
+    config = load_config(args)
+    diffusion_overrides = {} if args.timestep_respacing is None else {'timestep_respacing': args.timestep_respacing}
+    measurement = load_measurement(config, args.batch_size, device)
+    model = create_model(**dict(config.unet_model, quantize='none')).to(device).eval()
+    layers = [layer.strip() for layer in args.quantize_layers.split(",")]
+    quantized_model, count = quantize_unet(copy.deepcopy(model), layers=layers)
+
+    x = torch.randn((args.batch_size, 4) + tuple(measurement.shape[2:]), device=device)
+    t = torch.tensor([500] * args.batch_size, device=device)
+
+    print(f"weight-only int8 ({count} layers: {', '.join(layers)}, batch size {args.batch_size}, device: {device})")
+    reference, reference_times = None, None
+    for name, model_ii in [('fp32', model), ('int8', quantized_model)]:
+        # a single unet forward and backward (as in a guided step)
+        def unet_step():
+            x_ii = x.clone().requires_grad_()
+            out = model_ii(x_ii, t)
+            return out.detach(), torch.autograd.grad(out.square().sum(), x_ii)[0]
+
+        step_time = time_function(unet_step, repeats=args.repeats, warmup=1, device=device)
+        _, cond_method, sampler = build_osmosis(config, device, args.batch_size, model=model_ii, **diffusion_overrides)
+        outputs, run_time = run_osmosis(config, model_ii, cond_method, sampler, measurement, seed=config.manual_seed)
+        weights_mb = sum([tensor.numel() * tensor.element_size()
+                          for tensor in list(model_ii.parameters()) + list(model_ii.buffers())]) / 2 ** 20
+        line = f"    {name}: weights {weights_mb:.0f} MB, unet forward + backward {1e3 * step_time:.1f} ms, " \
+               f"sampling {run_time:.1f} sec"
+        if reference is None:
+            reference, reference_times = outputs, (step_time, run_time)
+        else:
+            line += f" (unet x{reference_times[0] / step_time:.2f}, sampling x{reference_times[1] / run_time:.2f}), " + \
+                    ", ".join([f"{key_ii}: {value_ii:.4f}" for key_ii, value_ii in
+                               compare_outputs(outputs, reference).items()])
+        print(line)
+
+
+BENCHMARKS = {'schedule': bench_schedule,
+              'respacing': bench_respacing,
+              'batch': bench_batch,
+              'fast_path': bench_fast_path,
+              'compile': bench_compile,
+              'attention': bench_attention,
+              'checkpointing': bench_checkpointing,
+              'phi_gradients': bench_phi_gradients,
+              'phi_solver': bench_phi_solver,
+              'pyramid': bench_pyramid,
+              'config': bench_config,
+              'setup': bench_setup,
+              'sequence': bench_sequence,
+              'sdedit': bench_sdedit,
+              'early_termination': bench_early_termination,
+              'feature_cache': bench_feature_cache,
+              'timestep_table': bench_timestep_table,
+              'load': bench_load,
+              'precision': bench_precision,
+              'quantization': bench_quantization}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()), help="Benchmark to run")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--steps", default=1000, type=int)
+    parser.add_argument("--noise_schedule", default="linear")
+    parser.add_argument("--image_size", default=None, type=int)
+    parser.add_argument("--batch_size", default=1, type=int)
+    parser.add_argument("--repeats", default=200, type=int)
+    # osmosis sampling benchmarks
+    parser.add_argument("-c", "--config_file", default="osmosis_sample.yaml", help="Configurations file")
+    parser.add_argument("--num_channels", default=None, type=int, help="override the unet number of channels")
+    parser.add_argument("--sampler", default="ddim", help="sampler of the respaced runs")
+    parser.add_argument("--respacing", default="ddim50,ddim100,ddim250")
+    parser.add_argument("--batch_sizes", default="1,2,4,8", help="batch sizes of the batch benchmark")
+    parser.add_argument("--timestep_respacing", default=None, help="override the respacing of the configuration")
+    parser.add_argument("--n_iter", default=20, type=int, help="inner phi iterations of the phi_gradients benchmark")
+    parser.add_argument("--guided_steps", default=10, type=int, help="guided steps of the phi_solver benchmark")
+    parser.add_argument("--start_t", default=0.4, type=float, help="start_t of the frames of the sequence benchmark")
+    parser.add_argument("--start_ts", default="1,0.8,0.6,0.4,0.2", help="start_t's of the sdedit benchmark (1 first)")
+    parser.add_argument("--depth_prior", default=None, help="override the depth prior of the sdedit benchmark")
+    parser.add_argument("--tol", default=None, type=float, help="override the tol of the early_termination benchmark")
+    parser.add_argument("--cache_intervals", default="1,2,3,5", help="intervals of the feature_cache benchmark (1 first)")
+    parser.add_argument("--cache_depth", default=1, type=int, help="shallow blocks of the feature_cache benchmark")
+    parser.add_argument("--loader", default=None, choices=['legacy', 'meta', 'flat'],
+                        help="a single loader of the load benchmark")
+    parser.add_argument("--flat_path", default=None, help="a flat checkpoint (flat_checkpoint.py) of the load benchmark")
+    parser.add_argument("--precisions", default="bf16", help="precision modes of the precision benchmark")
+    parser.add_argument("--rgb_tol", default=0.01, type=float, help="precision benchmark - max mean rgb difference")
+    parser.add_argument("--depth_tol", default=0.02, type=float, help="precision benchmark - max mean depth difference")
+    parser.add_argument("--phi_tol", default=0.02, type=float, help="precision benchmark - max phi difference")
+    parser.add_argument("--quantize_layers", default="attention,time_embed,resblock",
+                        help="quantized layers of the quantization benchmark")
+    parser.add_argument("--levels", default="0,1,2,3", help="pyramid levels of the pyramid benchmark")
+    parser.add_argument("--memory_budget_mb", default="2000,4000", help="budgets of the auto checkpointing policy")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
+    sys.exit(0)
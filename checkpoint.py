@@ -6,6 +6,7 @@ import math
 
 import torch as th
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint as th_checkpoint
 
 
 # PyTorch 1.7 has SiLU, but we support PyTorch 1.5.
@@ -126,45 +127,19 @@ def checkpoint(func, inputs, params, flag):
     Evaluate a function without caching intermediate activations, allowing for
     reduced memory at the expense of extra compute in the backward pass.
 
+    The non-reentrant torch.utils.checkpoint is used: it recomputes the function in the backward of the
+    outer graph (no nested backward under enable_grad), supports torch.autograd.grad w.r.t. the inputs only
+    (the guidance gradient) and tracks the parameters by itself.
+
     :param func: the function to evaluate.
     :param inputs: the argument sequence to pass to `func`.
     :param params: a sequence of parameters `func` depends on but does not
-                   explicitly take as arguments.
+                   explicitly take as arguments (not needed by the non-reentrant checkpoint).
     :param flag: if False, disable gradient checkpointing.
     """
-    if flag:
-        args = tuple(inputs) + tuple(params)
-        return CheckpointFunction.apply(func, len(inputs), *args)
+    # no activations are kept without grad (e.g. the inference mode steps), and the compiled graph plans its own
+    # memory - the checkpoint would only add overhead
+    if flag and th.is_grad_enabled() and not th.compiler.is_compiling():
+        return th_checkpoint(func, *inputs, use_reentrant=False)
     else:
         return func(*inputs)
-
-
-class CheckpointFunction(th.autograd.Function):
-    @staticmethod
-    def forward(ctx, run_function, length, *args):
-        ctx.run_function = run_function
-        ctx.input_tensors = list(args[:length])
-        ctx.input_params = list(args[length:])
-        with th.no_grad():
-            output_tensors = ctx.run_function(*ctx.input_tensors)
-        return output_tensors
-
-    @staticmethod
-    def backward(ctx, *output_grads):
-        ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
-        with th.enable_grad():
-            # Fixes a bug where the first op in run_function modifies the
-            # Tensor storage in place, which is not allowed for detach()'d
-            # Tensors.
-            shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
-            output_tensors = ctx.run_function(*shallow_copies)
-        input_grads = th.autograd.grad(
-            output_tensors,
-            ctx.input_tensors + ctx.input_params,
-            output_grads,
-            allow_unused=True,
-        )
-        del ctx.input_tensors
-        del ctx.input_params
-        del output_tensors
-        return (None, None) + input_grads
\ No newline at end of file
@@ -0,0 +1,277 @@
+"""
+Activation checkpointing policies of the unet blocks (the guidance backward through the unet) and a memory budget planner.
+"""
+
+import time
+
+import torch
+
+import logger
+from unet import AttentionBlock, Downsample, ResBlock, Upsample
+
+__POLICY__ = {}
+
+# the block types which can be checkpointed (both use checkpoint.checkpoint according to use_checkpoint)
+CHECKPOINT_BLOCKS = {'resblock': ResBlock, 'attention': AttentionBlock}
+
+
+def register_policy(name: str):
+    def wrapper(func):
+        if __POLICY__.get(name, None):
+            raise NameError(f"Name {name} is already registered!")
+        __POLICY__[name] = func
+        return func
+
+    return wrapper
+
+
+def get_policy(name: str):
+    if __POLICY__.get(name, None) is None:
+        raise NameError(f"Checkpoint policy {name} is not defined.")
+    return __POLICY__[name]
+
+
+def checkpoint_blocks(model):
+    """
+    The blocks of a model which can be checkpointed - a list of (name, block type, module).
+    """
+    blocks = []
+    for name, module in model.named_modules():
+        for block_type, block_class in CHECKPOINT_BLOCKS.items():
+            if isinstance(module, block_class):
+                blocks.append((name, block_type, module))
+    return blocks
+
+
+def set_checkpointing(model, names):
+    """
+    Checkpoint exactly the given blocks (by name) of a model.
+    """
+    names = set(names)
+    for name, _, module in checkpoint_blocks(model):
+        module.use_checkpoint = name in names
+    return model
+
+
+def block_resolutions(model, resolution):
+    """
+    The feature map size at the input of every checkpointable block (by name), from the downsample / upsample
+    layers of the unet input_blocks, middle_block and output_blocks - no forward pass.
+
+    :param resolution: the size of the unet input.
+    """
+    def scaled(module, resolution_ii):
+        if isinstance(module, Downsample):
+            # a stride 2 convolution (padding 1) or a 2x2 average pooling
+            return (resolution_ii + 1) // 2 if module.use_conv else resolution_ii // 2
+        if isinstance(module, Upsample):
+            return resolution_ii * 2
+        return resolution_ii
+
+    sequences = [(f"input_blocks.{ii}", block) for ii, block in enumerate(model.input_blocks)] + \
+                [("middle_block", model.middle_block)] + \
+                [(f"output_blocks.{ii}", block) for ii, block in enumerate(model.output_blocks)]
+    resolutions = {}
+    for prefix, sequence in sequences:
+        for index, module in enumerate(sequence):
+            if isinstance(module, (ResBlock, AttentionBlock)):
+                resolutions[f"{prefix}.{index}"] = resolution
+            # an up/down ResBlock resamples its output (h_upd)
+            resolution = scaled(module.h_upd if isinstance(module, ResBlock) else module, resolution)
+    return resolutions
+
+
+# %% profiling - resolution, kept activations and forward time of every block
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _storage_key(tensor):
+    return tensor.untyped_storage().data_ptr()
+
+
+def profile_blocks(model, sample_shape, device):
+    """
+    Run the unet on a random sample and profile its checkpointable blocks (without checkpointing).
+
+    The activations which are kept for the backward are counted with saved tensors hooks: every saved storage
+    (not a parameter) is counted once, for the block which saved it first, the storages which are saved outside
+    the blocks (e.g. the input and output convolutions) are counted as "other".
+
+    :param model: the unet.
+    :param sample_shape: the shape of the unet input [N x C x H x W] (the batch of the sampling).
+    :return: a list of dictionaries per block (name, type, resolution, saved_bytes - the kept activations,
+             input_bytes - kept by the block inputs, which are kept also when the block is checkpointed,
+             time - the forward time in seconds, which is the recomputation time) and the "other" saved bytes.
+    """
+    blocks = checkpoint_blocks(model)
+    use_checkpoint = {name: module.use_checkpoint for name, _, module in blocks}
+    set_checkpointing(model, [])
+
+    param_keys = set([_storage_key(param) for param in model.parameters()])
+    profile = {name: {'name': name, 'type': block_type, 'resolution': None, 'saved_bytes': 0, 'input_bytes': 0,
+                      'time': 0.} for name, block_type, _ in blocks}
+    saved_keys, input_keys = set(), {}
+    current = []
+    other_bytes = [0]
+
+    def pre_hook(name):
+        def hook(module, inputs):
+            x = inputs[0]
+            profile[name]['resolution'] = x.shape[-1]
+            input_keys[name] = set([_storage_key(input_ii) for input_ii in inputs if torch.is_tensor(input_ii)])
+            current.append(name)
+            _synchronize(device)
+            profile[name]['time'] = time.perf_counter()
+        return hook
+
+    def post_hook(name):
+        def hook(module, inputs, output):
+            _synchronize(device)
+            profile[name]['time'] = time.perf_counter() - profile[name]['time']
+            current.pop()
+        return hook
+
+    def pack(tensor):
+        key = _storage_key(tensor)
+        if key not in param_keys and key not in saved_keys:
+            saved_keys.add(key)
+            nbytes = tensor.untyped_storage().nbytes()
+            if len(current) == 0:
+                other_bytes[0] += nbytes
+            else:
+                profile[current[-1]]['saved_bytes'] += nbytes
+                if key in input_keys[current[-1]]:
+                    profile[current[-1]]['input_bytes'] += nbytes
+        return tensor
+
+    handles = []
+    for name, _, module in blocks:
+        handles.append(module.register_forward_pre_hook(pre_hook(name)))
+        handles.append(module.register_forward_hook(post_hook(name)))
+
+    x = torch.randn(sample_shape, device=device)
+    t = torch.zeros(sample_shape[0], dtype=torch.long, device=device)
+    try:
+        # the first run warms up the kernels (and the allocator), the second one is profiled
+        for _ in range(2):
+            saved_keys.clear()
+            other_bytes[0] = 0
+            for block_ii in profile.values():
+                block_ii['saved_bytes'], block_ii['input_bytes'] = 0, 0
+            x_ii = x.clone().requires_grad_()
+            with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                out = model(x_ii, t)
+            del out
+    finally:
+        for handle in handles:
+            handle.remove()
+        for name, _, module in blocks:
+            module.use_checkpoint = use_checkpoint[name]
+
+    return list(profile.values()), other_bytes[0]
+
+
+# %% policies - the names of the blocks to checkpoint
+
+@register_policy(name='none')
+def policy_none(model, **kwargs):
+    return []
+
+
+@register_policy(name='all')
+def policy_all(model, **kwargs):
+    return [name for name, _, _ in checkpoint_blocks(model)]
+
+
+@register_policy(name='select')
+def policy_select(model, sample_shape, device, block_types=('attention',), resolutions=None, **kwargs):
+    """
+    Checkpoint the blocks of the given types at the given resolutions (feature map sizes, None - all).
+
+    The resolutions of the blocks are derived from the model structure for the input size of sample_shape
+    (None - the model image_size).
+    """
+    for block_type in block_types:
+        if block_type not in CHECKPOINT_BLOCKS:
+            raise NameError(f"Unknown block type {block_type}, use one of {list(CHECKPOINT_BLOCKS.keys())}")
+    if resolutions is not None and not isinstance(resolutions, (list, tuple)):
+        resolutions = [int(res) for res in str(resolutions).split(",")]
+
+    block_resolution = block_resolutions(model, sample_shape[-1] if sample_shape is not None else model.image_size)
+    return [name for name, block_type, _ in checkpoint_blocks(model)
+            if block_type in block_types and (resolutions is None or block_resolution.get(name) in resolutions)]
+
+
+def plan_checkpointing(profile, other_bytes, memory_budget_mb):
+    """
+    Choose the blocks to checkpoint such that the activations of the guidance backward fit the memory budget
+    with as little recomputation as possible.
+
+    The kept activations of a checkpointed block are only its inputs, and its activations are recomputed
+    (and kept) during its own backward, hence the backward peak is estimated as the kept activations plus the
+    largest checkpointed block. The blocks are chosen greedily by the saved memory per recomputation time
+    (the fractional knapsack order).
+
+    :param profile: the blocks profile of profile_blocks.
+    :param other_bytes: the activations which are kept outside the blocks.
+    :param memory_budget_mb: the activations memory budget of the backward in MB.
+    :return: the names of the blocks to checkpoint, the estimated peak in MB and the recomputation time in seconds.
+    """
+    budget = memory_budget_mb * 2 ** 20
+    savings = {block_ii['name']: max(block_ii['saved_bytes'] - block_ii['input_bytes'], 0) for block_ii in profile}
+    kept = other_bytes + sum([block_ii['saved_bytes'] for block_ii in profile])
+
+    candidates = sorted([block_ii for block_ii in profile if savings[block_ii['name']] > 0],
+                        key=lambda block_ii: savings[block_ii['name']] / max(block_ii['time'], 1e-9), reverse=True)
+    selected, recompute_peak, recompute_time = [], 0, 0.
+    for block_ii in candidates:
+        if kept + recompute_peak <= budget:
+            break
+        selected.append(block_ii['name'])
+        kept -= savings[block_ii['name']]
+        recompute_peak = max(recompute_peak, savings[block_ii['name']])
+        recompute_time += block_ii['time']
+
+    peak_mb = (kept + recompute_peak) / 2 ** 20
+    if peak_mb > memory_budget_mb:
+        logger.log(f"checkpointing: the memory budget {memory_budget_mb} MB can not be met, "
+                   f"the estimated peak with all the blocks checkpointed is {peak_mb:.0f} MB")
+    return selected, peak_mb, recompute_time
+
+
+@register_policy(name='auto')
+def policy_auto(model, sample_shape, device, memory_budget_mb=None, **kwargs):
+    """
+    Plan the checkpointing according to a memory budget of the guidance backward activations.
+    """
+    if memory_budget_mb is None:
+        raise ValueError("The auto checkpoint policy requires memory_budget_mb")
+    profile, other_bytes = profile_blocks(model, sample_shape, device)
+    selected, peak_mb, recompute_time = plan_checkpointing(profile, other_bytes, memory_budget_mb)
+
+    total_mb = (other_bytes + sum([block_ii['saved_bytes'] for block_ii in profile])) / 2 ** 20
+    logger.log(f"checkpointing plan: activations {total_mb:.0f} MB without checkpointing, "
+               f"estimated peak {peak_mb:.0f} MB (budget {memory_budget_mb} MB), "
+               f"recomputation {1e3 * recompute_time:.1f} ms per backward")
+    return selected
+
+
+def apply_checkpoint_policy(model, policy='select', sample_shape=None, device=None, **policy_kwargs):
+    """
+    Set the activation checkpointing of the unet blocks according to a policy.
+
+    :param model: the unet.
+    :param policy: none, all, select (by block_types and resolutions) or auto (memory_budget_mb planner).
+    :param sample_shape: the shape of the unet input [N x C x H x W] - the batch of the sampling.
+    :param device: the device of the model.
+    :return: the names of the checkpointed blocks.
+    """
+    device = device if device is not None else next(model.parameters()).device
+    names = get_policy(policy)(model, sample_shape=sample_shape, device=device, **policy_kwargs)
+    set_checkpointing(model, names)
+
+    logger.log(f"checkpointing ({policy}): {len(names)} of {len(checkpoint_blocks(model))} blocks")
+    return names
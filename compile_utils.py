@@ -0,0 +1,90 @@
+"""
+Opt-in torch.compile of the sampling hot path with eager fallback - the per step regions of the sampler (the unet
+call and the posterior math as a single graph, see GaussianDiffusion.denoise_step and unguided_step) and the operator
+forward. The conditioning (the phi's optimization and the backward) runs eager between them.
+"""
+
+from functools import partial
+
+import torch
+
+import logger
+
+# compiled functions of the whole run - the cache is keyed by the function (the class function of a method), hence
+# a function is compiled once per process even if the sampler or the operator is built again (e.g. benchmarks)
+__COMPILED__ = {}
+
+
+def compile_errors():
+    """
+    The exceptions of a failed compilation (dynamo tracing or the backend), other errors are raised as they are.
+    """
+    import torch._dynamo.exc as dynamo_exc
+
+    errors = [dynamo_exc.TorchDynamoException]
+    errors += [getattr(dynamo_exc, name) for name in ("BackendCompilerFailed", "Unsupported")
+               if hasattr(dynamo_exc, name)]
+    try:
+        from torch._inductor.exc import InductorError
+        errors.append(InductorError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+class CompiledFunction:
+    """
+    A torch.compile'd function which falls back to the eager function when the compilation fails.
+
+    :param function: the function (or nn.Module) to compile.
+    :param name: the name of the function for the logging.
+    :param backend: the torch.compile backend, inductor generates C++/OpenMP kernels on the cpu.
+    """
+
+    def __init__(self, function, name, backend="inductor", **compile_kwargs):
+        self.function = function
+        self.name = name
+        self.compiled = torch.compile(function, backend=backend, **compile_kwargs)
+        self.failed = False
+
+    def __call__(self, *args, **kwargs):
+        if not self.failed:
+            try:
+                return self.compiled(*args, **kwargs)
+            except compile_errors() as error:
+                # e.g. no c++ compiler, an unsupported operation - the rest of the run is eager
+                self.failed = True
+                logger.log(f"torch.compile of {self.name} failed, falling back to eager: "
+                           f"{type(error).__name__}: {error}")
+        return self.function(*args, **kwargs)
+
+
+def compile_function(function, name=None, **compile_kwargs):
+    """
+    Compile a function (or a module) once per run, the compiled function is cached.
+    """
+    if function not in __COMPILED__:
+        name = name if name is not None else getattr(function, "__qualname__", type(function).__name__)
+        __COMPILED__[function] = CompiledFunction(function, name, **compile_kwargs)
+    return __COMPILED__[function]
+
+
+def compile_method(instance, method_name, **compile_kwargs):
+    """
+    Replace a method of an instance by the compiled (unbound) method of its class.
+
+    The class function is compiled, not the bound method, so another instance of the class (e.g. the operator
+    of another run configuration in a benchmark) reuses the same compiled code.
+    """
+    function = getattr(type(instance), method_name)
+    compiled = compile_function(function, name=f"{type(instance).__name__}.{method_name}", **compile_kwargs)
+    setattr(instance, method_name, partial(compiled, instance))
+    return instance
+
+
+def reset_compiled():
+    """
+    Clear the cached compiled functions and the dynamo caches (e.g. for benchmarks).
+    """
+    __COMPILED__.clear()
+    torch._dynamo.reset()
@@ -3,6 +3,8 @@ import torch
 import numpy as np
 import losses as losseso
 import utils as utilso
+from avg_pool_nd import avg_pool_nd
+from sampling_config import DepthConfig, GuidanceConfig
 import copy
 
 __CONDITIONING_METHOD__ = {}
@@ -29,6 +31,15 @@ class ConditioningMethod(ABC):
         self.operator = operator
         self.noiser = noiser
 
+    def reset(self, batch_size=None, init_phi=None):
+        """
+        Prepare the conditioning method for a new batch - a learnable operator is reset to the initial phi's (or
+        init_phi) of batch_size elements with a clean optimizer state, see LearnableOperator.reset.
+        """
+        if hasattr(self.operator, 'reset'):
+            self.operator.reset(batch_size=batch_size, init_phi=init_phi)
+        return self
+
     def project(self, data, noisy_measurement, **kwargs):
         return self.operator.project(data=data, measurement=noisy_measurement, **kwargs)
 
@@ -62,15 +73,10 @@ class ConditioningMethod(ABC):
 class PosteriorSamplingOsmosis(ConditioningMethod):
     def __init__(self, operator, noiser, **kwargs):
         super().__init__(operator, noiser)
-        input_scale_str = kwargs.get('scale', 1.0)
-
-        # in case scale is single for all channels
-        try:
-            self.scale = torch.tensor([float(input_scale_str)])
 
-        # in case there is a scale value for each channel
-        except ValueError:
-            self.scale = torch.tensor([float(num_str.strip()) for num_str in input_scale_str.split(',')])
+        # guidance scale (single for all channels or per channel) and gradient clipping - a parsed
+        # sampling_config.GuidanceConfig (guidance), or the scale and gradient_clip strings, parsed once
+        self.guidance = GuidanceConfig.from_kwargs(kwargs, device=getattr(operator, 'device', None))
 
         self.gradient_x_prev = kwargs.get('gradient_x_prev', False)
 
@@ -80,6 +86,8 @@ class PosteriorSamplingOsmosis(ConditioningMethod):
         self.local_M = kwargs.get('local_M', 1)
         self.n_iter = kwargs.get('n_iter', 1)
         self.update_start = kwargs.get('update_start', 1.0)
+        # scale the phi's learning rates by the number of original steps a respaced (e.g. DDIM) step covers
+        self.phi_lr_stride = kwargs.get('phi_lr_stride', False)
 
         # Auxiliary loss information
         aux_loss_dict = kwargs.get("aux_loss", None)
@@ -93,18 +101,28 @@ class PosteriorSamplingOsmosis(ConditioningMethod):
         # guiding loss function, loss weight (depth or none), is depth - what function and values
         self.loss_function = kwargs.get("loss_function", "norm")
         self.loss_weight = kwargs.get("loss_weight", None)
-        self.weight_function = kwargs.get("weight_function", None)
-
-        # use gradient clipping (or image clipping)
-        gradient_clip_tmp = kwargs.get("gradient_clip", "False")
-        gradient_clip_tmp = [num_str for num_str in gradient_clip_tmp.split(',')]
-        self.gradient_clip = utilso.str2bool(gradient_clip_tmp[0])
-
-        # if true - what values
-        if self.gradient_clip:
-            self.gradient_clip_value = float(gradient_clip_tmp[1].strip())
-        else:
-            self.gradient_clip_value = None
+        self.weight_function = DepthConfig.from_function(kwargs.get("weight_function", None))
+
+        # early stopping of the inner phi iterations (n_iter is the maximum) - when the relative change of the
+        # phi's (or of the loss) of every image is below phi_tol, 0 - always n_iter iterations
+        self.phi_tol = float(kwargs.get('phi_tol', 0))
+        self.phi_tol_criterion = kwargs.get('phi_tol_criterion', 'phi')
+        if self.phi_tol_criterion not in ['phi', 'loss']:
+            raise NotImplementedError(f"Unknown phi tolerance criterion: {self.phi_tol_criterion}")
+
+        # the phi only work (the inner iterations but the last one, or the lm solver) runs on an average pooled
+        # x0 prediction and measurement (downsampled by 2 ** phi_pyramid_level), 0 - full resolution
+        self.phi_pyramid_level = int(kwargs.get('phi_pyramid_level', 0))
+        self.phi_pool = avg_pool_nd(2, kernel_size=2 ** self.phi_pyramid_level) if self.phi_pyramid_level > 0 else None
+        # the phi gradients of the norm grow with the square root of the number of pixels, the pooled loss is scaled
+        # to keep the meaning of the phi learning rates (the mse is a mean)
+        self.phi_loss_scale = 2 ** self.phi_pyramid_level if self.loss_function == 'norm' else 1
+
+        # phi gradients of the inner optimization iterations (all but the last one, which is also w.r.t. x):
+        # autograd, or analytic - hand derived gradients of the operator, no graph is built
+        self.phi_gradients = kwargs.get("phi_gradients", "autograd")
+        if self.phi_gradients not in ["autograd", "analytic"]:
+            raise NotImplementedError(f"Unknown phi gradients: {self.phi_gradients}")
 
     def grad_and_value(self, x_prev, x_0_hat, measurement, **kwargs):
 
@@ -125,17 +143,19 @@ class PosteriorSamplingOsmosis(ConditioningMethod):
 
         # loss function - norm2
         if self.loss_function == 'norm':
-            loss = torch.linalg.norm(differance)
-            # calculated for visualization
-            sep_loss = torch.norm(differance.detach().cpu(), p=2, dim=[1, 2, 3]).numpy()
+            # norm of each image separately and summed - the images of a batch do not affect each other gradients
+            sep_norm = torch.linalg.vector_norm(differance, ord=2, dim=(1, 2, 3))
+            loss = sep_norm.sum()
+            # calculated for visualization - kept on the device, copied to the host by the sampler telemetry
+            sep_loss = sep_norm.detach()
 
         # Mean square error
         elif self.loss_function == "mse":
             mse = differance ** 2
             mse = mse.mean(dim=(1, 2, 3))
             loss = mse.sum()
-            # calculated for visualization
-            sep_loss = mse.detach().cpu().numpy()
+            # calculated for visualization - kept on the device, copied to the host by the sampler telemetry
+            sep_loss = mse.detach()
 
         # No other loss
         else:
@@ -143,10 +163,88 @@ class PosteriorSamplingOsmosis(ConditioningMethod):
 
         return sep_loss, loss, degraded_image_tmp.detach()
 
+    def analytic_terms(self, x_0_hat, measurement):
+        """
+        The terms of the analytic phi gradients which do not depend on the phi's, computed once per step.
+        """
+        x_0_hat = x_0_hat.detach()
+        rgb_norm, depth = self.operator.split_rgbd(x_0_hat)
+        degraded_image_tmp, _ = self.operator.forward_terms(rgb_norm, depth)
+        # the loss weights depend only on the x0 prediction
+        loss_weight = utilso.set_loss_weight(loss_weight_type=self.loss_weight,
+                                             weight_function=self.weight_function,
+                                             degraded_image=degraded_image_tmp,
+                                             x_0_hat=x_0_hat)
+        return {'rgb_norm': rgb_norm, 'depth': depth, 'loss_weight': loss_weight, 'measurement': measurement}
+
+    @torch.no_grad()
+    def analytic_phi_gradients(self, rgb_norm, depth, loss_weight, measurement, loss_scale=1):
+        """
+        Accumulate the gradients of the guidance loss w.r.t. the phi's, the same as the autograd of grad_and_value,
+        and return the loss of every image.
+
+        With the residual r = (y - (2 * A(x0) - 1)) * w, the gradient w.r.t. the operator output A(x0) is
+        -2 * w * dL/dr, where dL/dr = r / ||r|| for the norm, and 2 * r / (C * H * W) for the mse (per image).
+        """
+        degraded_image_tmp, terms = self.operator.forward_terms(rgb_norm, depth)
+        residual = (measurement - (2 * degraded_image_tmp - 1)) * loss_weight
+
+        if self.loss_function == 'norm':
+            sep_norm = torch.linalg.vector_norm(residual, ord=2, dim=(1, 2, 3), keepdim=True)
+            grad_residual = torch.where(sep_norm > 0, residual / sep_norm, torch.zeros_like(residual))
+            sep_loss = sep_norm.view(-1)
+        elif self.loss_function == "mse":
+            grad_residual = 2 * residual / residual[0].numel()
+            sep_loss = (residual ** 2).mean(dim=(1, 2, 3))
+        else:
+            raise NotImplementedError
+
+        grad_output = -2 * loss_scale * loss_weight * grad_residual
+        gradients = self.operator.analytic_gradients(grad_output, rgb_norm, depth, terms)
+
+        for variable_ii, gradient_ii in zip(self.operator.get_variable_list(), gradients):
+            if variable_ii.requires_grad:
+                if variable_ii.grad is None:
+                    variable_ii.grad = gradient_ii
+                else:
+                    variable_ii.grad.add_(gradient_ii)
+
+        return loss_scale * sep_loss
+
+    def inner_converged(self, previous_variables, previous_loss, sep_loss, update_mask=None):
+        """
+        Check if the inner phi iterations converged - the relative change of the phi's (or the loss) of every
+        updated image is below phi_tol. A single host synchronization per iteration.
+        """
+        if self.phi_tol_criterion == 'phi':
+            relative_change = torch.stack([((variable_ii.detach() - previous_ii).abs().amax(dim=(1, 2, 3)) /
+                                            previous_ii.abs().amax(dim=(1, 2, 3)).clamp_min(1e-12))
+                                           for variable_ii, previous_ii in
+                                           zip(self.operator.get_variable_list(), previous_variables)]).amax(dim=0)
+        else:
+            if previous_loss is None:
+                return False
+            relative_change = (sep_loss - previous_loss).abs() / previous_loss.abs().clamp_min(1e-12)
+
+        # the images which are not updated are converged
+        if update_mask is not None:
+            relative_change = torch.where(update_mask, relative_change, torch.zeros_like(relative_change))
+        return bool(relative_change.amax() < self.phi_tol)
+
     def conditioning(self, x_prev, x_t, x_0_hat, measurement, **kwargs):
 
         freeze_phi = kwargs.get("freeze_phi", False)
         time_index = kwargs.get("time_index", None)
+        # a python number, or a [B] tensor when the batch elements are at different timesteps (continuous batching)
+        step_stride = kwargs.get("step_stride", 1)
+        if self.phi_lr_stride:
+            lr_scale = step_stride.float() if torch.is_tensor(step_stride) else float(step_stride)
+        else:
+            lr_scale = 1.0
+        # [B] bool tensor of the elements which update their phi's, None - all the batch (according to freeze_phi)
+        update_mask = kwargs.get("update_mask", None)
+        # SamplingTelemetry - records the number of inner phi iterations
+        telemetry = kwargs.get("telemetry", None)
 
         # when the gradient is w.r.t x0, the x_prev gradients and history of the x0 prediction are not required
         if not self.gradient_x_prev:
@@ -155,9 +253,25 @@ class PosteriorSamplingOsmosis(ConditioningMethod):
             x_0_hat = x_0_hat.to(x_0_hat.device)
             x_prev.requires_grad_(False)
 
+        # the pyramid level of the phi only work, the last iteration (the x gradient) is at full resolution
+        if self.phi_pool is not None and not freeze_phi:
+            x_0_phi = self.phi_pool(x_0_hat.detach())
+            measurement_phi = self.phi_pool(measurement)
+        else:
+            x_0_phi, measurement_phi = x_0_hat, measurement
+
         # calculate the losses
         with torch.set_grad_enabled(True):
 
+            # optimizer: lm - the phi's are solved once per step (instead of the inner iterations),
+            # the guidance iteration is then only w.r.t. x
+            if getattr(self.operator, 'solver', None) == "lm" and not freeze_phi:
+                solver_terms = self.analytic_terms(x_0_hat=x_0_phi, measurement=measurement_phi)
+                self.operator.solve_phi(rgb_norm=solver_terms['rgb_norm'], depth=solver_terms['depth'],
+                                        target=0.5 * (measurement_phi + 1), weight=solver_terms['loss_weight'],
+                                        update_mask=update_mask)
+                freeze_phi = True
+
             # phi's require gradients when we update them, hence when freeze_phi is False
             self.operator.set_variable_gradients(value=not freeze_phi)
 
@@ -165,36 +279,81 @@ class PosteriorSamplingOsmosis(ConditioningMethod):
             # since there is no optimizing at all in this case
             inner_optimize_length = 1 if freeze_phi else self.n_iter
 
-            for optimize_ii in range(inner_optimize_length):
+            # the analytic phi gradients share the terms which depend only on x0 along the inner iterations
+            analytic_flag = self.phi_gradients == "analytic" and inner_optimize_length > 1
+            if analytic_flag:
+                analytic_terms = self.analytic_terms(x_0_hat=x_0_phi, measurement=measurement_phi)
+                analytic_terms['loss_scale'] = self.phi_loss_scale
 
-                # compute the loss after applying the operator, sep_loss is relevant for multiple images
-                sep_loss, loss, degraded_image_01 = self.grad_and_value(x_prev=x_prev,
-                                                                        x_0_hat=x_0_hat,
-                                                                        measurement=measurement,
-                                                                        time_index=time_index)
+            # early stopping - the phi's start from the previous timestep (warm start), hence close to the
+            # convergence the inner loop ends long before n_iter
+            early_stop_flag = self.phi_tol > 0 and inner_optimize_length > 1
+            previous_loss = None
+            converged = False
+
+            for optimize_ii in range(inner_optimize_length):
+                # the last iteration is also w.r.t. x
+                last_flag = converged or optimize_ii == (inner_optimize_length - 1)
+                if early_stop_flag:
+                    previous_variables = [variable_ii.detach().clone() for variable_ii in
+                                          self.operator.get_variable_list()]
+
+                # phi only iteration - the auxiliary loss does not depend on the phi's
+                if analytic_flag and not last_flag:
+                    sep_loss = self.analytic_phi_gradients(**analytic_terms)
+
+                # phi only iteration on the pyramid level
+                elif self.phi_pool is not None and not last_flag:
+                    sep_loss, loss, _ = self.grad_and_value(x_prev=x_prev,
+                                                            x_0_hat=x_0_phi,
+                                                            measurement=measurement_phi,
+                                                            time_index=time_index)
+                    (self.phi_loss_scale * loss).backward(inputs=self.operator.get_variable_list())
+                    sep_loss = self.phi_loss_scale * sep_loss
 
-                # total loss refers to the original loss or to the loss of the x
-                if self.aux_loss is not None:
-                    aux_loss, aux_loss_dict = self.aux_loss.forward(x_0_hat)
-                    total_loss = loss + aux_loss
                 else:
-                    aux_loss_dict = None
-                    total_loss = loss
-
-                # calculate the backward graph
-                if optimize_ii == (inner_optimize_length - 1):
-                    if freeze_phi:
-                        # calculate graph w.r.t x_prev
-                        total_loss.backward(inputs=[x_prev])
+                    # compute the loss after applying the operator, sep_loss is relevant for multiple images
+                    sep_loss, loss, degraded_image_01 = self.grad_and_value(x_prev=x_prev,
+                                                                            x_0_hat=x_0_hat,
+                                                                            measurement=measurement,
+                                                                            time_index=time_index)
+
+                    # total loss refers to the original loss or to the loss of the x
+                    if self.aux_loss is not None:
+                        aux_loss, aux_loss_dict = self.aux_loss.forward(x_0_hat)
+                        total_loss = loss + aux_loss
                     else:
-                        # calculate graph w.r.t x_prev and phi's
-                        total_loss.backward(inputs=[x_prev] + self.operator.get_variable_list())
-                else:
-                    # when optimize only the phi's, we specify it for faster run time
-                    total_loss.backward(inputs=self.operator.get_variable_list())
+                        aux_loss_dict = None
+                        total_loss = loss
+
+                    # calculate the backward graph
+                    if last_flag:
+                        if freeze_phi:
+                            # calculate graph w.r.t x_prev
+                            total_loss.backward(inputs=[x_prev])
+                        else:
+                            # calculate graph w.r.t x_prev and phi's
+                            total_loss.backward(inputs=[x_prev] + self.operator.get_variable_list())
+                    else:
+                        # when optimize only the phi's, we specify it for faster run time
+                        total_loss.backward(inputs=self.operator.get_variable_list())
 
                 # optimize phi's, in case of freeze phi true - optimization is not done
-                variables_dict = self.operator.optimize(freeze_phi=freeze_phi)
+                if update_mask is None or freeze_phi:
+                    variables_dict = self.operator.optimize(freeze_phi=freeze_phi, lr_scale=lr_scale)
+                else:
+                    variables_dict = self.operator.masked_optimize(update_mask, lr_scale=lr_scale)
+
+                if last_flag:
+                    break
+                if early_stop_flag:
+                    converged = self.inner_converged(previous_variables, previous_loss, sep_loss, update_mask)
+                    previous_loss = sep_loss
+
+            # the phi iterations of the step against the n_iter budget
+            if telemetry is not None and not freeze_phi:
+                telemetry.accumulate('phi_iterations', optimize_ii + 1)
+                telemetry.accumulate('phi_iterations_budget', inner_optimize_length)
 
             # update x_t
             with torch.no_grad():
@@ -207,26 +366,27 @@ class PosteriorSamplingOsmosis(ConditioningMethod):
                 # # reshape the scale according to [b,c,h,w]
                 # guidance_scale = scale_norm * self.scale[None, ..., None, None].to(x_prev.device)
 
-                # reshape the scale according to [b,c,h,w]
-                guidance_scale = self.scale[None, ..., None, None].to(x_prev.device)
+                # the scale is [1,c,1,1], preallocated on the device (moved only if the sampling device differs)
+                self.guidance = self.guidance.to(x_prev.device)
+                guidance_scale = self.guidance.scale
 
                 # update x_t - gradient w.r.t x_t
                 if self.gradient_x_prev:
 
-                    if self.gradient_clip:
+                    if self.guidance.gradient_clip:
                         grads = torch.clamp(x_prev.grad,
-                                            min=-self.gradient_clip_value,
-                                            max=self.gradient_clip_value)
+                                            min=-self.guidance.gradient_clip_value,
+                                            max=self.guidance.gradient_clip_value)
                     else:
                         grads = x_prev.grad
 
                     x_t -= guidance_scale * grads
-                    gradients = x_prev.grad.cpu()
+                    gradients = x_prev.grad.detach()
 
                 # update x_t - gradient w.r.t x_0_pred
                 else:
                     x_t -= guidance_scale * x_0_hat.grad
-                    gradients = x_0_hat.grad.cpu()
+                    gradients = x_0_hat.grad.detach()
 
         return x_t, sep_loss, variables_dict, gradients, aux_loss_dict
 
@@ -236,16 +396,12 @@ class PosteriorSampling(ConditioningMethod):
     def __init__(self, operator, noiser, **kwargs):
         super().__init__(operator, noiser)
 
-        input_scale_str = kwargs.get('scale', 1.0)
-        # in case scale is single for all channels
-        try:
-            self.scale = torch.tensor([float(input_scale_str)])
-        # in case there is a scale value for each channel
-        except ValueError:
-            self.scale = torch.tensor([float(num_str.strip()) for num_str in input_scale_str.split(',')])
+        # guidance scale - single for all channels or per channel, parsed once
+        self.guidance = GuidanceConfig.from_kwargs(kwargs, device=getattr(operator, 'device', None))
 
     def conditioning(self, x_prev, x_t, x_0_hat, measurement, **kwargs):
         norm_grad, norm = self.grad_and_value(x_prev=x_prev, x_0_hat=x_0_hat, measurement=measurement, **kwargs)
-        x_t -= norm_grad * self.scale[None, ..., None, None].to(x_prev.device)
+        self.guidance = self.guidance.to(x_prev.device)
+        x_t -= norm_grad * self.guidance.scale
 
         return x_t, norm
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+Adaptive early termination of the sampling - monitor the convergence of the x0 prediction and the phi's.
+"""
+
+import torch
+
+from avg_pool_nd import avg_pool_nd
+
+TERMINATION_MODES = ('stop', 'jump')
+
+
+class ConvergenceMonitor:
+    """
+    Convergence of the x0 prediction (and of the phi's) between consecutive sampling steps.
+
+    The statistics are computed on the device: the relative L2 change of the average pooled x0 prediction and the
+    maximal relative change of the phi's, per image. The only host synchronization is a single flag per step,
+    and only for the steps below start (a fraction of the timesteps), the early steps are never monitored.
+
+    :param tol: the relative change of the pooled x0 prediction between consecutive steps.
+    :param phi_tol: the relative change of the phi's between consecutive steps, None - not checked.
+    :param window: the number of consecutive steps both criteria should hold for every image of the batch.
+    :param pool: the downsampling factor of the x0 prediction statistic.
+    :param start: the monitor is active for the steps below this fraction of the timesteps.
+    :param mode: stop - return the x0 prediction, jump - finish with unguided DDIM jumps of jump_stride steps.
+    :param jump_stride: the number of steps of every jump (mode jump).
+    """
+
+    def __init__(self, tol=2e-3, phi_tol=1e-3, window=3, pool=4, start=0.3, mode='stop', jump_stride=5, **kwargs):
+        if mode not in TERMINATION_MODES:
+            raise NotImplementedError(f"Unknown early termination mode {mode}, use one of {list(TERMINATION_MODES)}")
+        self.tol = float(tol)
+        self.phi_tol = None if phi_tol is None else float(phi_tol)
+        self.window = max(int(window), 1)
+        self.pool = avg_pool_nd(2, kernel_size=int(pool)) if int(pool) > 1 else None
+        self.start = float(start)
+        self.mode = mode
+        self.jump_stride = max(int(jump_stride), 1)
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the statistics, called at the beginning of every sampling loop.
+        """
+        self.previous_x0 = None
+        self.previous_variables = None
+        self.streak = None
+        self.streak_start = None
+        self.terminated_at = None
+        self.total_steps = None
+        self.skipped_steps = 0
+
+    def is_active(self, original_idx, num_timesteps):
+        return original_idx <= self.start * num_timesteps
+
+    def update(self, idx, pred_xstart, variables=None):
+        """
+        Update the per image statistics with the x0 prediction (and the phi's) of step idx - device only.
+        """
+        x0 = pred_xstart.detach()
+        x0 = self.pool(x0) if self.pool is not None else x0
+        variables = {key_ii: value_ii.detach().clone() for key_ii, value_ii in (variables or {}).items()}
+
+        if self.previous_x0 is None:
+            self.previous_x0, self.previous_variables = x0, variables
+            self.streak = torch.zeros(x0.shape[0], dtype=torch.long, device=x0.device)
+            self.streak_start = torch.full_like(self.streak, idx)
+            return
+
+        delta = torch.linalg.vector_norm(x0 - self.previous_x0, dim=(1, 2, 3)) / \
+            torch.linalg.vector_norm(self.previous_x0, dim=(1, 2, 3)).clamp(min=1e-8)
+        converged = delta < self.tol
+
+        if self.phi_tol is not None:
+            for key_ii, value_ii in variables.items():
+                previous_ii = self.previous_variables.get(key_ii, None)
+                if previous_ii is None or previous_ii.shape != value_ii.shape:
+                    continue
+                drift = ((value_ii - previous_ii).abs() / previous_ii.abs().clamp(min=1e-8)).flatten(1).amax(dim=1)
+                converged = converged & (drift < self.phi_tol)
+
+        # the first step of the current streak of every image
+        self.streak_start = torch.where(self.streak == 0, torch.full_like(self.streak_start, idx), self.streak_start)
+        self.streak = torch.where(converged, self.streak + 1, torch.zeros_like(self.streak))
+        self.previous_x0, self.previous_variables = x0, variables
+
+    def converged(self):
+        """
+        True if the criteria hold for window steps for every image of the batch (a host synchronization).
+        """
+        return self.streak is not None and bool((self.streak >= self.window).all())
+
+    def tail(self, idx):
+        """
+        The remaining steps after the termination at step idx - a dictionary {step: next step} of the jumps
+        (mode jump, the next step of the last one is -1, the x0 prediction), or None (mode stop).
+        """
+        if self.mode == 'stop':
+            return None
+        steps = list(range(idx - 1, -1, -self.jump_stride))
+        if steps and steps[-1] != 0:
+            steps.append(0)
+        return {step_ii: next_ii for step_ii, next_ii in zip(steps, steps[1:] + [-1])}
+
+    def terminate(self, idx, total_steps, tail=None):
+        """
+        Keep the termination step and the number of skipped steps (the remaining steps which are not sampled).
+        """
+        self.terminated_at = idx
+        self.total_steps = total_steps
+        self.skipped_steps = idx - (len(tail) if tail is not None else 0)
+
+    def summary(self, file_names=None):
+        """
+        Per image text of the last sampling - the step its criteria hold from and the skipped steps.
+        """
+        if self.terminated_at is None:
+            return []
+        streak_start = self.streak_start.tolist()
+        file_names = file_names or [f"image_{batch_ii}" for batch_ii in range(len(streak_start))]
+        return [f"{file_name_ii}: converged from step {start_ii}, terminated at step {self.terminated_at} ({self.mode}), "
+                f"skipped {self.skipped_steps} of {self.total_steps} steps"
+                for file_name_ii, start_ii in zip(file_names, streak_start)]
@@ -0,0 +1,186 @@
+"""
+A flat, memory mappable checkpoint format of the unet - no unpickling, the tensors are zero-copy views of the file.
+
+A file is a magic, the length of a json header (8 bytes, little endian), the json header (the name, dtype, shape and
+offset of every tensor, the sha256 of the buffers and metadata) and the raw tensor buffers, every one aligned to
+ALIGNMENT bytes. A large checkpoint may be split into shards - files <stem>-00001-of-00003<suffix>, each one with
+its own header.
+
+Convert a checkpoint (the tensors are stored in the final layout of create_model, e.g. the RGBD convolutions):
+    python flat_checkpoint.py -c osmosis_sample.yaml -o ./models/osmosis_outdoor.osm --dtype fp16
+and set unet_model model_path to the converted file (the first shard of a sharded checkpoint).
+"""
+
+import glob
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+from argparse import ArgumentParser
+
+import torch as th
+
+MAGIC = b"OSMFLAT1"
+ALIGNMENT = 64
+DTYPES = {'fp32': th.float32, 'fp16': th.float16, 'bf16': th.bfloat16}
+DTYPE_NAMES = {th.float32: 'float32', th.float16: 'float16', th.bfloat16: 'bfloat16', th.float64: 'float64',
+               th.int64: 'int64', th.int32: 'int32', th.int8: 'int8', th.uint8: 'uint8', th.bool: 'bool'}
+DTYPES_BY_NAME = {name: dtype for dtype, name in DTYPE_NAMES.items()}
+SHARD_PATTERN = re.compile(r"^(?P<stem>.+)-(?P<index>\d{5})-of-(?P<count>\d{5})$")
+
+
+def is_flat_checkpoint(path):
+    """
+    True if path is a flat checkpoint file (or a shard of one) - checked by the magic, not by the file name.
+    """
+    if not path or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _shard_paths(path):
+    """
+    All the shards of a checkpoint from the path of one of them (a single file is its own shard).
+    """
+    root, suffix = os.path.splitext(path)
+    match = SHARD_PATTERN.match(root)
+    if match is None:
+        return [path]
+    count = int(match.group('count'))
+    paths = sorted(glob.glob(f"{glob.escape(match.group('stem'))}-?????-of-{count:05d}{suffix}"))
+    if len(paths) != count:
+        raise FileNotFoundError(f"{path}: expected {count} shards, found {len(paths)}")
+    return paths
+
+
+def save_flat_checkpoint(state_dict, path, dtype=None, shard_size_mb=0, metadata=None):
+    """
+    Write a state dict as a flat checkpoint.
+
+    :param state_dict: a dictionary of tensors.
+    :param path: the output file, with shards the shard index is added to its name.
+    :param dtype: pre-cast the floating point tensors (e.g. th.float16), None - as they are.
+    :param shard_size_mb: the maximal size of a shard, 0 - a single file.
+    :param metadata: a json serializable dictionary kept in the header (e.g. the model configuration).
+    :return: the paths of the written files.
+    """
+    tensors = {}
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor.contiguous()
+
+    # the tensors are kept in the state dict order, a new shard whenever the current one is full
+    shards, shard_bytes = [[]], 0
+    for name, tensor in tensors.items():
+        nbytes = _aligned(tensor.numel() * tensor.element_size())
+        if shard_size_mb > 0 and shards[-1] and shard_bytes + nbytes > shard_size_mb * 2 ** 20:
+            shards.append([])
+            shard_bytes = 0
+        shards[-1].append(name)
+        shard_bytes += nbytes
+
+    root, suffix = os.path.splitext(path)
+    paths = [path] if len(shards) == 1 else \
+        [f"{root}-{shard_ii + 1:05d}-of-{len(shards):05d}{suffix}" for shard_ii in range(len(shards))]
+
+    for shard_path, names in zip(paths, shards):
+        entries, offset, digest = {}, 0, hashlib.sha256()
+        for name in names:
+            tensor = tensors[name]
+            nbytes = tensor.numel() * tensor.element_size()
+            entries[name] = {'dtype': DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape),
+                             'offset': offset, 'nbytes': nbytes}
+            offset = _aligned(offset + nbytes)
+
+        buffers = [(entries[name]['offset'], tensors[name]) for name in names]
+        for _, tensor in buffers:
+            digest.update(_tensor_bytes(tensor))
+        header = json.dumps({'tensors': entries, 'sha256': digest.hexdigest(),
+                             'metadata': metadata or {}}).encode("utf-8")
+        data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+        with open(shard_path, "wb") as f:
+            f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+            for buffer_offset, tensor in buffers:
+                f.seek(data_start + buffer_offset)
+                f.write(_tensor_bytes(tensor))
+            f.truncate(data_start + offset)
+    return paths
+
+
+def _tensor_bytes(tensor):
+    # the raw bytes of any dtype (numpy has no bfloat16)
+    return tensor.reshape(-1).view(th.uint8).numpy().tobytes() if tensor.numel() else b""
+
+
+def load_flat_checkpoint(path, verify=True, dtype=None):
+    """
+    Load a flat checkpoint as a state dict of tensors which are views of the (copy on write) memory mapped files.
+
+    :param path: the checkpoint file, or any shard of a sharded checkpoint.
+    :param verify: check the sha256 of the buffers (reads the whole file once).
+    :param dtype: None - the tensors as they are stored (zero-copy), a dtype - the floating point tensors of another
+                  dtype (pre-cast) are converted to it (a copy of these tensors).
+    """
+    state_dict = {}
+    for shard_path in _shard_paths(path):
+        with open(shard_path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{shard_path}: not a flat checkpoint")
+        header_len = struct.unpack("<Q", buffer[len(MAGIC):len(MAGIC) + 8])[0]
+        header = json.loads(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_len].decode("utf-8"))
+        data_start = _aligned(len(MAGIC) + 8 + header_len)
+
+        view = memoryview(buffer)
+        if verify:
+            digest = hashlib.sha256()
+            for entry in header['tensors'].values():
+                start = data_start + entry['offset']
+                digest.update(view[start:start + entry['nbytes']])
+            if digest.hexdigest() != header['sha256']:
+                raise ValueError(f"{shard_path}: sha256 mismatch, the checkpoint is corrupted")
+
+        for name, entry in header['tensors'].items():
+            tensor_dtype = DTYPES_BY_NAME[entry['dtype']]
+            numel = entry['nbytes'] // th.empty(0, dtype=tensor_dtype).element_size()
+            if numel == 0:
+                tensor = th.empty(entry['shape'], dtype=tensor_dtype)
+            else:
+                tensor = th.frombuffer(buffer, dtype=tensor_dtype, count=numel,
+                                       offset=data_start + entry['offset']).view(entry['shape'])
+            if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+                tensor = tensor.to(dtype)
+            state_dict[name] = tensor
+    return state_dict
+
+
+if __name__ == "__main__":
+    import utils as utilso
+    from unet import create_model
+
+    parser = ArgumentParser(description="Convert the unet checkpoint of a configuration into a flat checkpoint")
+    parser.add_argument("-c", "--config_file", default="osmosis_sample.yaml", help="Configurations file")
+    parser.add_argument("-o", "--output", required=True, help="the flat checkpoint file")
+    parser.add_argument("--dtype", default="fp32", choices=list(DTYPES.keys()), help="pre-cast the weights")
+    parser.add_argument("--shard_size_mb", default=0, type=int, help="the maximal shard size, 0 - a single file")
+    args = parser.parse_args()
+
+    config = utilso.arguments_from_file(args.config_file)
+    # the model as create_model loads it - the tensors are stored in the final (e.g. RGBD) layout
+    model = create_model(**config.unet_model)
+    metadata = {key_ii: str(value_ii) for key_ii, value_ii in config.unet_model.items() if key_ii != 'model_path'}
+    paths = save_flat_checkpoint(model.state_dict(), args.output, dtype=DTYPES[args.dtype],
+                                 shard_size_mb=args.shard_size_mb, metadata=metadata)
+    load_flat_checkpoint(paths[0], verify=True)
+    print(f"saved {config.unet_model['model_path']} into {', '.join(paths)} ({args.dtype})")
@@ -13,12 +13,19 @@ from torchvision.utils import make_grid
 import torchvision.transforms.functional as tvtf
 
 from posterior_mean_variance import get_mean_processor, get_var_processor
+from schedule_tables import ScheduleTables
+from compile_utils import compile_method
 
 import utils as utilso
+from telemetry import SamplingTelemetry
 
 __SAMPLER__ = {}
 
 
+# the autocast dtype of the unet calls per precision mode, fp32 - no autocast
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
 def register_sampler(name: str):
     def wrapper(cls):
         if __SAMPLER__.get(name, None):
@@ -48,6 +55,11 @@ def create_sampler(sampler,
     sampler = get_sampler(name=sampler)
 
     annealing_time = kwargs.get('annealing_time', False)
+    device = kwargs.get('device', None)
+    eta = kwargs.get('eta', 0.0)
+    compile_flag = kwargs.get('compile', False)
+    timestep_table = kwargs.get('timestep_table', False)
+    precision = kwargs.get('precision', 'fp32')
     betas = get_named_beta_schedule(noise_schedule, steps)
     if not timestep_respacing:
         timestep_respacing = [steps]
@@ -59,7 +71,12 @@ def create_sampler(sampler,
                    dynamic_threshold=dynamic_threshold,
                    clip_denoised=clip_denoised,
                    rescale_timesteps=rescale_timesteps,
-                   annealing_time=annealing_time)
+                   annealing_time=annealing_time,
+                   device=device,
+                   eta=eta,
+                   compile=compile_flag,
+                   timestep_table=timestep_table,
+                   precision=precision)
 
 
 class GaussianDiffusion:
@@ -81,6 +98,10 @@ class GaussianDiffusion:
         self.num_timesteps = int(self.betas.shape[0])
         self.rescale_timesteps = rescale_timesteps
 
+        # the original timesteps (before respacing) of the diffusion process
+        self.timestep_map = list(kwargs.get("timestep_map", None) or range(self.num_timesteps))
+        self.original_num_steps = kwargs.get("original_num_steps", self.num_timesteps)
+
         alphas = 1.0 - self.betas
         self.alphas_cumprod = np.cumprod(alphas, axis=0)
         self.alphas_cumprod_prev = np.append(1.0, self.alphas_cumprod[:-1])
@@ -112,13 +133,52 @@ class GaussianDiffusion:
                 / (1.0 - self.alphas_cumprod)
         )
 
+        # all the coefficients above as device tensors, built once and shared with the processors
+        self.tables = ScheduleTables(betas,
+                                     timestep_map=kwargs.get("timestep_map", None),
+                                     device=kwargs.get("device", None))
+
         self.mean_processor = get_mean_processor(model_mean_type,
                                                  betas=betas,
                                                  dynamic_threshold=dynamic_threshold,
-                                                 clip_denoised=clip_denoised)
+                                                 clip_denoised=clip_denoised,
+                                                 tables=self.tables)
 
         self.var_processor = get_var_processor(model_var_type,
-                                               betas=betas)
+                                               betas=betas,
+                                               tables=self.tables)
+
+        # opt-in torch.compile of the per step regions (the unet call and the posterior math as a single graph, see
+        # denoise_step and unguided_step), compiled once per run (not per image)
+        self.compile = kwargs.get("compile", False)
+        if self.compile:
+            compile_method(self, "denoise_step")
+            compile_method(self, "unguided_step")
+
+        # frozen inference - the unet timestep embeddings of the schedule timesteps are precomputed once
+        self.timestep_table = kwargs.get("timestep_table", False)
+
+        # mixed precision - the unet calls (and their guidance backward) run under autocast, the schedule math and
+        # the phi's optimization stay in float32
+        self.precision = kwargs.get("precision", "fp32")
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {self.precision}, use one of {list(PRECISIONS.keys())}")
+
+    def check_precision(self, sample_pattern):
+        """
+        Raise for fp16 with guidance - the guidance backward through the unet has no loss scaling, the small
+        gradients underflow in fp16 (bf16 has the float32 range).
+
+        :param sample_pattern: the sample pattern configuration (the guidance window).
+        """
+        if self.precision != 'fp16':
+            return
+        guided = (sample_pattern['pattern'] == 'original') or (sample_pattern['pattern'] is None) or \
+                 any(sample_pattern['start_guidance'] * self.original_num_steps >= original_idx >=
+                     sample_pattern['stop_guidance'] * self.original_num_steps for original_idx in self.timestep_map)
+        if guided:
+            raise ValueError("precision fp16 is not supported with guidance (the guidance backward has no loss "
+                             "scaling), use bf16 or fp32")
 
     def q_mean_variance(self, x_start, t):
         """
@@ -129,9 +189,9 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
 
-        mean = extract_and_expand(self.sqrt_alphas_cumprod, t, x_start) * x_start
-        variance = extract_and_expand(1.0 - self.alphas_cumprod, t, x_start)
-        log_variance = extract_and_expand(self.log_one_minus_alphas_cumprod, t, x_start)
+        mean = self.tables.extract('sqrt_alphas_cumprod', t, x_start) * x_start
+        variance = self.tables.extract('one_minus_alphas_cumprod', t, x_start)
+        log_variance = self.tables.extract('log_one_minus_alphas_cumprod', t, x_start)
 
         return mean, variance, log_variance
 
@@ -149,11 +209,34 @@ class GaussianDiffusion:
         noise = torch.randn_like(x_start)
         assert noise.shape == x_start.shape
 
-        coef1 = extract_and_expand(self.sqrt_alphas_cumprod, t, x_start)
-        coef2 = extract_and_expand(self.sqrt_one_minus_alphas_cumprod, t, x_start)
+        coef1 = self.tables.extract('sqrt_alphas_cumprod', t, x_start)
+        coef2 = self.tables.extract('sqrt_one_minus_alphas_cumprod', t, x_start)
 
         return coef1 * x_start + coef2 * noise
 
+    def start_steps(self, start_t):
+        """
+        The number of (respaced) sampling steps of a sampling which starts at a fraction start_t of the original
+        timesteps - the steps whose original timestep is at most start_t * original_num_steps (at least one).
+        """
+        if not 0 < start_t <= 1:
+            raise ValueError(f"start_t should be in (0, 1], got {start_t}")
+        original_t = start_t * self.original_num_steps
+        return max(sum([1 for timestep_ii in self.timestep_map if timestep_ii <= original_t]), 1)
+
+    def q_sample_start(self, x_0, start_t):
+        """
+        A partially noised starting point of the sampling (instead of pure noise at T) - x_0 diffused by q_sample
+        to the last timestep of the sampling which starts at start_t (a fraction of the timesteps).
+
+        :param x_0: the initial guess, in the unet output range [-1, 1].
+        :param start_t: the fraction of the diffusion timesteps to sample, 1 - the whole diffusion.
+        :return: the noisy x_t and the number of sampling steps left (start_steps of p_sample_loop).
+        """
+        start_steps = self.start_steps(start_t)
+        t = torch.full((x_0.shape[0],), start_steps - 1, dtype=torch.long, device=x_0.device)
+        return self.q_sample(x_0, t), start_steps
+
     def q_posterior_mean_variance(self, x_start, x_t, t):
         """
         Compute the mean and variance of the diffusion posterior:
@@ -162,11 +245,11 @@ class GaussianDiffusion:
 
         """
         assert x_start.shape == x_t.shape
-        coef1 = extract_and_expand(self.posterior_mean_coef1, t, x_start)
-        coef2 = extract_and_expand(self.posterior_mean_coef2, t, x_t)
+        coef1 = self.tables.extract('posterior_mean_coef1', t, x_start)
+        coef2 = self.tables.extract('posterior_mean_coef2', t, x_t)
         posterior_mean = coef1 * x_start + coef2 * x_t
-        posterior_variance = extract_and_expand(self.posterior_variance, t, x_t)
-        posterior_log_variance_clipped = extract_and_expand(self.posterior_log_variance_clipped, t, x_t)
+        posterior_variance = self.tables.extract('posterior_variance', t, x_t)
+        posterior_log_variance_clipped = self.tables.extract('posterior_log_variance_clipped', t, x_t)
 
         assert (
                 posterior_mean.shape[0]
@@ -191,149 +274,226 @@ class GaussianDiffusion:
                       **kwargs):
         """
         The function used for sampling from noise.
+
+        With start_steps (kwargs) only the last start_steps steps are sampled, x_start is then a partially noised
+        image at step start_steps - 1 (see q_sample_start).
+
+        With convergence (kwargs, a ConvergenceMonitor) the sampling terminates once the x0 prediction (and the phi's)
+        converged - it returns the x0 prediction (mode stop) or finishes with unguided DDIM jumps (mode jump).
         """
 
+        if measurement_cond_fn is not None:
+            self.check_precision(sample_pattern)
+
         img = x_start
         device = x_start.device
         global_iteration = kwargs.get("global_iteration", False)
+        # a file name per image of the batch
         original_file_name = kwargs.get("original_file_name", "image_0")
+        if isinstance(original_file_name, str):
+            original_file_name = [original_file_name] if x_start.shape[0] == 1 else \
+                [f"{original_file_name}_{batch_ii}" for batch_ii in range(x_start.shape[0])]
         save_grids_path = kwargs.get("save_grids_path", None)
 
-        time_val_list = []
-        loss_process = []
+        # per step values are kept on the device and flushed to the host (pbar and logger) every few steps
+        telemetry = kwargs.get("telemetry", None)
+        if telemetry is None:
+            telemetry = SamplingTelemetry(flush_every=1)
 
         if record:
-            rgb_record_list = []
-            depth_record_list = []
-
-        total_steps = self.num_timesteps
+            # lists of the recorded images per image of the batch
+            rgb_record_list = [[] for _ in range(x_start.shape[0])]
+            depth_record_list = [[] for _ in range(x_start.shape[0])]
+
+        # a partially noised start samples only the last steps of the diffusion, the sample pattern fractions (guidance,
+        # phi update and alternating windows) are rescaled to the truncated schedule
+        total_steps = kwargs.get("start_steps", None) or self.num_timesteps
+        pattern_steps = self.timestep_map[total_steps - 1] + 1 if total_steps < self.num_timesteps \
+            else self.original_num_steps
         pbar = tqdm(list(range(total_steps))[::-1])
+        telemetry.reset(pbar=pbar)
+
+        loss, variable_dict, aux_loss = None, None, None
+
+        # run the steps without guidance under torch.inference_mode (no autograd state at all)
+        fast_path = kwargs.get("inference_fast_path", True)
+
+        # adaptive early termination - the convergence of the x0 prediction (and the phi's) in the late steps
+        convergence = kwargs.get("convergence", None)
+        if convergence is not None:
+            convergence.reset()
+        tail = None
+
+        # the deep features cached by the unet (feature_cache_interval) belong to the previous sampling
+        if hasattr(model, "reset_feature_cache"):
+            model.reset_feature_cache()
+
+        # the model of the per step regions, wrapped (and its timesteps frozen) once per sampling
+        step_model = self.wrap_model(model)
 
         # loop over the timestep
         for idx in pbar:
 
             time = torch.tensor([idx] * img.shape[0], device=device)
-            time_val_list.append(time.cpu().item())
 
-            # flag (bool) for non guidance
+            # the sample pattern fractions refer to the original timesteps - relevant for respaced (e.g. DDIM) sampling
+            original_idx = self.timestep_map[idx]
+            # the number of original timesteps this (respaced) step covers
+            step_stride = original_idx - self.timestep_map[idx - 1] if idx > 0 else original_idx + 1
+
+            # flag (bool) for non guidance - python values only, no device synchronization
             guidance_flag = (sample_pattern['pattern'] == 'original') or \
                             (sample_pattern['pattern'] is None) or \
-                            (sample_pattern['start_guidance'] * self.num_timesteps >= time >= sample_pattern[
-                                'stop_guidance'] * self.num_timesteps)
+                            (sample_pattern['start_guidance'] * pattern_steps >= original_idx >=
+                             sample_pattern['stop_guidance'] * pattern_steps)
 
             # setting the alternate len (M from the gibbsDDRM paper)
-            alternate_len = utilso.set_alternate_length(sample_pattern, idx, self.num_timesteps)
+            alternate_len = utilso.set_alternate_length(sample_pattern, original_idx, pattern_steps)
 
             # for osmosis use alternate_len=1, means - no alternating
             for alternate_ii in range(alternate_len):
 
-                img.requires_grad = True if guidance_flag else False
+                # fast path - a step without guidance needs no gradients, no graph building and in-place update.
+                # the (unused) noisy measurement is not sampled - one randn less per step, hence the global random
+                # stream differs from inference_fast_path=False from the first unguided step on. the samples are the
+                # same only for a deterministic sampler (ddim, eta=0) without guidance
+                if fast_path and not guidance_flag:
+                    with torch.inference_mode():
+                        # the x_t noise is sampled also when t == 0, as in the autograd path below
+                        noise = torch.randn_like(img)
+                        img, pred_xstart = self.unguided_step(step_model, img, time, noise, idx != 0)
+                        out = {'pred_xstart': pred_xstart}
 
-                if rgb_guidance:
-                    out = self.p_sample(x=img, t=time, model=model)
+                    if alternate_ii == (alternate_len - 1) and loss is not None:
+                        telemetry.record(idx, loss=loss, aux_loss=aux_loss, variables=variable_dict)
 
                 else:
-                    # "clean" the noise with the unet
-                    out = self.p_mean_variance(model=model, x=img, t=time)
-                    out['sample'] = out['mean']
+                    # tensors of the fast path can not be used by autograd, a normal copy for the guided steps
+                    if img.is_inference():
+                        img = img.clone()
 
-                # there is no use of the noisy measurement, do we need it? I don't know yet
-                noisy_measurement = self.q_sample(measurement, t=time)
+                    img.requires_grad = True if guidance_flag else False
 
-                # Give condition. -> guiding
-                if pretrain_model == 'osmosis' and not rgb_guidance:
+                    if rgb_guidance:
+                        out = self.p_sample(x=img, t=time, model=model)
 
-                    # check if there is a sampling method and check the idx to check if to freeze phis
-                    freeze_phi = utilso.is_freeze_phi(sample_pattern, idx, self.num_timesteps)
+                    else:
+                        # "clean" the noise with the unet, the mean and noise std are according to the sampler (DDPM/DDIM)
+                        out = self.denoise_step(step_model, img, time)
+                        out['sample'] = out['mean']
 
-                    if guidance_flag:
+                    # there is no use of the noisy measurement, do we need it? I don't know yet
+                    noisy_measurement = self.q_sample(measurement, t=time)
 
-                        # conditioning function (guidance)
-                        img, loss, variable_dict, gradients, aux_loss = \
-                            measurement_cond_fn(x_t=out['sample'],
-                                                measurement=measurement,
-                                                noisy_measurement=noisy_measurement,
-                                                x_prev=img,
-                                                x_0_hat=out['pred_xstart'],
-                                                freeze_phi=freeze_phi,
-                                                time_index=float(idx) / self.num_timesteps)
+                    # Give condition. -> guiding
+                    if pretrain_model == 'osmosis' and not rgb_guidance:
 
-                    else:
-                        # no guidance
-                        img = out['sample']
+                        # check if there is a sampling method and check the idx to check if to freeze phis
+                        freeze_phi = utilso.is_freeze_phi(sample_pattern, original_idx, pattern_steps)
 
-                    # sampling new img after guidance
-                    noise = torch.randn_like(img, device=img.device)
-                    if time != 0:  # no noise when t == 0
-                        img += torch.exp(0.5 * out['log_variance']) * noise
-
-                    # detach result from graph, for the next iteration
-                    img.detach_()
-
-                    # update pbar for the last alternating process
-                    if alternate_ii == (alternate_len - 1):
-
-                        loss_process.append(loss[0].item())
-                        # print and log values
-                        pbar_print_dictionary = {}
-                        pbar_print_dictionary['time'] = time.cpu().tolist()
-                        pbar_print_dictionary['loss'] = loss
-                        # print auxiliary loss to the pbar
-                        if aux_loss is not None:
-                            pbar_print_dictionary['aux'] = np.round(
-                                [ii.item() for ii in list(aux_loss.values())], decimals=4)
-
-                        # print variables to pbar
-                        for key_ii, value_ii in variable_dict.items():
-                            current_var_value = np.round(value_ii.cpu().detach().squeeze().tolist(), decimals=3)
-                            # in case the variable is a matrix
-                            if len(current_var_value.shape) > 1:
-                                current_var_value = \
-                                    np.round([current_var_value.mean(), current_var_value.std()], decimals=3)
-                            pbar_print_dictionary[key_ii] = current_var_value
-
-                        # print the pbar
-                        pbar.set_postfix(pbar_print_dictionary, refresh=False)
-
-                # almost original dps code - rgb_guidance
-                else:
-                    img, loss = measurement_cond_fn(x_t=out['sample'],
+                        if guidance_flag:
+
+                            # conditioning function (guidance)
+                            img, loss, variable_dict, gradients, aux_loss = \
+                                measurement_cond_fn(x_t=out['sample'],
                                                     measurement=measurement,
                                                     noisy_measurement=noisy_measurement,
                                                     x_prev=img,
-                                                    x_0_hat=out['pred_xstart'])
-                    img = img.detach_()
-                    pbar.set_postfix({'loss': loss.detach().cpu().item()}, refresh=False)
+                                                    x_0_hat=out['pred_xstart'],
+                                                    freeze_phi=freeze_phi,
+                                                    time_index=float(original_idx) / pattern_steps,
+                                                    step_stride=step_stride,
+                                                    telemetry=telemetry)
+
+                        else:
+                            # no guidance
+                            img = out['sample']
+
+                        # sampling new img after guidance
+                        noise = torch.randn_like(img, device=img.device)
+                        if idx != 0:  # no noise when t == 0
+                            img += out['std'] * noise
+
+                        # detach result from graph, for the next iteration
+                        img.detach_()
+
+                        # record the values (pbar and logger) for the last alternating process
+                        if alternate_ii == (alternate_len - 1) and loss is not None:
+                            telemetry.record(idx, loss=loss, aux_loss=aux_loss, variables=variable_dict)
+
+                    # almost original dps code - rgb_guidance
+                    else:
+                        img, loss = measurement_cond_fn(x_t=out['sample'],
+                                                        measurement=measurement,
+                                                        noisy_measurement=noisy_measurement,
+                                                        x_prev=img,
+                                                        x_0_hat=out['pred_xstart'])
+                        img = img.detach_()
+                        telemetry.record(idx, loss=loss)
 
                 # save the images during the diffusion process
-                if record and (alternate_ii == (alternate_len - 1)) and \
-                        ((idx % record_every == 0) or (idx == 0) or (idx == 999)):
+                # the record steps are according to the original timesteps
+                record_step = (idx == 0) or (idx == total_steps - 1) or \
+                              (original_idx // record_every != self.timestep_map[idx - 1] // record_every)
+                if record and (alternate_ii == (alternate_len - 1)) and record_step:
                     # the RGBD image
                     mid_x_0_pred_tmp = out['pred_xstart'].detach().cpu()
 
-                    # split into RGB and Depth images
-                    rgb_record_tmp = 0.5 * (mid_x_0_pred_tmp[0, 0:3, :, :] + 1)
-                    rgb_record_tmp_clip = torch.clamp(rgb_record_tmp, 0, 1)
+                    for batch_ii in range(mid_x_0_pred_tmp.shape[0]):
+                        # split into RGB and Depth images
+                        rgb_record_tmp = 0.5 * (mid_x_0_pred_tmp[batch_ii, 0:3, :, :] + 1)
+                        rgb_record_tmp_clip = torch.clamp(rgb_record_tmp, 0, 1)
+
+                        # Depth
+                        depth_record_tmp = mid_x_0_pred_tmp[batch_ii, 3, :, :].unsqueeze(0)
+                        # percentile + min max norm for the depth image
+                        depth_record_tmp_pmm = utilso.min_max_norm_range_percentile(depth_record_tmp,
+                                                                                    percent_low=0.05,
+                                                                                    percent_high=0.99)
+                        depth_record_tmp_pmm_color = utilso.depth_tensor_to_color_image(depth_record_tmp_pmm)
+
+                        rgb_record_list[batch_ii].append(rgb_record_tmp_clip)
+                        depth_record_list[batch_ii].append(depth_record_tmp_pmm_color)
+
+            # the statistics are on the device, a single host synchronization per monitored step
+            if convergence is not None and idx > 0 and convergence.is_active(original_idx, pattern_steps):
+                convergence.update(idx, out['pred_xstart'], variable_dict)
+                if convergence.converged():
+                    tail = convergence.tail(idx)
+                    convergence.terminate(idx, total_steps, tail)
+                    pbar.close()
+                    break
+
+        # early termination - the x0 prediction of the last step, or the remaining steps as unguided DDIM jumps
+        if convergence is not None and convergence.terminated_at is not None:
+            if tail is None:
+                img = out['pred_xstart'].detach().clone()
+            else:
+                img = img.detach().clone()
+                with torch.no_grad():
+                    for step_ii, next_ii in tail.items():
+                        out = self.ddim_jump(model, img, step_ii, next_ii)
+                        img = out['sample']
 
-                    # Depth
-                    depth_record_tmp = mid_x_0_pred_tmp[:, 3, :, :]
-                    # percentile + min max norm for the depth image
-                    depth_record_tmp_pmm = utilso.min_max_norm_range_percentile(depth_record_tmp, percent_low=0.05,
-                                                                                percent_high=0.99)
-                    depth_record_tmp_pmm_color = utilso.depth_tensor_to_color_image(depth_record_tmp_pmm)
+        # the frozen timestep table lookups of the sampling (counted on the device)
+        if self.timestep_table and hasattr(model, "check_timesteps"):
+            model.check_timesteps()
 
-                    rgb_record_list.append(rgb_record_tmp_clip)
-                    depth_record_list.append(depth_record_tmp_pmm_color)
+        # flush the last values of the telemetry to the host
+        telemetry.close()
 
         # save the recorded images
         if record and (save_grids_path is not None):
             # save rgb and depth information - images are clipped, depth is percentiled + min-max normalized
-            mid_grid = make_grid(rgb_record_list + depth_record_list, nrow=len(rgb_record_list))
-            mid_grid_pil = tvtf.to_pil_image(mid_grid)
-            mid_grid_pil.save(pjoin(save_grids_path, f'{original_file_name}_process.png'))
+            for rgb_records, depth_records, file_name_ii in zip(rgb_record_list, depth_record_list,
+                                                                original_file_name):
+                mid_grid = make_grid(rgb_records + depth_records, nrow=len(rgb_records))
+                mid_grid_pil = tvtf.to_pil_image(mid_grid)
+                mid_grid_pil.save(pjoin(save_grids_path, f'{file_name_ii}_process.png'))
 
         # return the relevant things
         if pretrain_model == 'osmosis' and not rgb_guidance:
+            loss = loss.detach().cpu().numpy() if loss is not None else None
             return img, variable_dict, loss, out['pred_xstart'].detach().cpu()
 
         else:
@@ -342,6 +502,38 @@ class GaussianDiffusion:
     def p_sample(self, model, x, t):
         raise NotImplementedError
 
+    # %% the per step regions - tensors in and out (no host synchronization and no python branching on tensor
+    # values), the regions which are compiled with compile. the python control of the sampling (sample pattern,
+    # conditioning, recording, convergence) stays in p_sample_loop
+
+    def wrap_model(self, model):
+        """
+        The model as the per step regions call it, wrapped once per sampling (SpacedDiffusion - the timestep map).
+        """
+        return model
+
+    def denoise_step(self, model, x, t):
+        """
+        The region of a guided step before the conditioning - the unet call and the posterior mean, std and x0
+        prediction (p_mean_std), with the autograd graph of x.
+
+        :param model: the model of wrap_model.
+        """
+        return self.p_mean_std(model=model, x=x, t=t)
+
+    def unguided_step(self, model, x, t, noise, add_noise):
+        """
+        A step without guidance - x_{t-1} = mean + std * noise.
+
+        :param model: the model of wrap_model.
+        :param noise: the x_t noise, sampled by the caller (the random stream of eager and compiled is the same).
+        :param add_noise: a python bool, False at the last step (t == 0).
+        :return: x_{t-1} and the x0 prediction.
+        """
+        out = self.p_mean_std(model=model, x=x, t=t)
+        sample = out['mean'] + out['std'] * noise if add_noise else out['mean']
+        return sample, out['pred_xstart']
+
     def p_mean_variance(self, model, x, t):
         model_output = model(x, self._scale_timesteps(t))
 
@@ -364,6 +556,39 @@ class GaussianDiffusion:
                 'log_variance': model_log_variance,
                 'pred_xstart': pred_xstart}
 
+    def p_mean_std(self, model, x, t):
+        """
+        Get the mean of x_{t-1} before adding the noise, and the std of that noise.
+
+        Used by the guided (osmosis) sampling, which updates the mean before adding the noise.
+        For DDPM these are the posterior mean and std.
+        """
+        out = self.p_mean_variance(model, x, t)
+        out['std'] = torch.exp(0.5 * out['log_variance'])
+        return out
+
+    def ddim_jump(self, model, x, step, next_step):
+        """
+        An unguided deterministic DDIM step (eta 0) from step to an earlier next_step, -1 - the x0 prediction.
+
+        Used for the tail of an early terminated sampling (mode jump), hence next_step may skip several steps.
+        """
+        t = torch.full((x.shape[0],), step, dtype=torch.long, device=x.device)
+        out = self.p_mean_variance(model, x, t)
+        if next_step < 0:
+            out['sample'] = out['pred_xstart']
+            return out
+
+        eps = self.predict_eps_from_x_start(x, t, out['pred_xstart'])
+        alpha_bar_next = self.tables.extract('alphas_cumprod', torch.full_like(t, next_step), x)
+        out['sample'] = out['pred_xstart'] * torch.sqrt(alpha_bar_next) + torch.sqrt(1 - alpha_bar_next) * eps
+        return out
+
+    def predict_eps_from_x_start(self, x_t, t, pred_xstart):
+        coef1 = self.tables.extract('sqrt_recip_alphas_cumprod', t, x_t)
+        coef2 = self.tables.extract('sqrt_recipm1_alphas_cumprod', t, x_t)
+        return (coef1 * x_t - pred_xstart) / coef2
+
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
             return t.float() * (1000.0 / self.num_timesteps)
@@ -439,16 +664,21 @@ class SpacedDiffusion(GaussianDiffusion):
         self.timestep_map = []
         self.original_num_steps = len(kwargs["betas"])
 
-        base_diffusion = GaussianDiffusion(**kwargs)  # pylint: disable=missing-kwoa
+        # only the cumulative alphas of the base diffusion process are needed (the same float64 math as
+        # GaussianDiffusion), constructing it would build all its tables for nothing
+        base_alphas_cumprod = np.cumprod(1.0 - np.array(kwargs["betas"], dtype=np.float64), axis=0)
         last_alpha_cumprod = 1.0
         new_betas = []
-        for i, alpha_cumprod in enumerate(base_diffusion.alphas_cumprod):
+        for i, alpha_cumprod in enumerate(base_alphas_cumprod):
             if i in self.use_timesteps:
                 new_betas.append(1 - alpha_cumprod / last_alpha_cumprod)
                 last_alpha_cumprod = alpha_cumprod
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
+        kwargs["timestep_map"] = self.timestep_map
+        kwargs["original_num_steps"] = self.original_num_steps
         super().__init__(**kwargs)
+        self._wrapped_model = None
 
     def p_mean_variance(self, model, *args, **kwargs):  # pylint: disable=signature-differs
         return super().p_mean_variance(self._wrap_model(model), *args, **kwargs)
@@ -462,12 +692,20 @@ class SpacedDiffusion(GaussianDiffusion):
     def condition_score(self, cond_fn, *args, **kwargs):
         return super().condition_score(self._wrap_model(cond_fn), *args, **kwargs)
 
+    def wrap_model(self, model):
+        return self._wrap_model(model)
+
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
-        return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
-        )
+        # the wrapper is kept between steps so the timestep map is not rebuilt on every call
+        if self._wrapped_model is None or self._wrapped_model.source_model is not model:
+            self._wrapped_model = _WrappedModel(
+                model, self.tables, self.rescale_timesteps, self.original_num_steps, precision=self.precision
+            )
+        if self.timestep_table:
+            self._wrapped_model.freeze_timesteps()
+        return self._wrapped_model
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
@@ -475,18 +713,57 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, tables, rescale_timesteps, original_num_steps, precision='fp32'):
+        self.source_model = model
         self.model = model
-        self.timestep_map = timestep_map
+        self.tables = tables
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.frozen_timesteps = None
+        self.autocast_dtype = PRECISIONS[precision]
+
+    @property
+    def timestep_map(self):
+        return self.tables.timestep_map.tolist()
+
+    def model_timesteps(self):
+        """
+        The timesteps the model is called with - the timestep map, rescaled as in __call__.
+        """
+        new_ts = self.tables.timestep_map
+        if self.rescale_timesteps:
+            new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
+        return new_ts.tolist()
+
+    def freeze_timesteps(self):
+        """
+        Precompute the timestep embeddings of the model for the schedule timesteps, unless the model already holds
+        them (e.g. frozen by another sampler of the same model).
+        """
+        if not hasattr(self.source_model, "freeze_timesteps"):
+            return
+        if self.frozen_timesteps is None:
+            self.frozen_timesteps = sorted(set(float(timestep_ii) for timestep_ii in self.model_timesteps()))
+        table = self.source_model.timestep_table
+        if table is None or table.timesteps != self.frozen_timesteps:
+            if self.autocast_dtype is None:
+                self.source_model.freeze_timesteps(self.frozen_timesteps)
+                return
+            # as the unet calls - the weights may be stored in half precision (a pre-cast flat checkpoint)
+            device = next(self.source_model.parameters()).device
+            with torch.autocast(device_type=device.type, dtype=self.autocast_dtype):
+                self.source_model.freeze_timesteps(self.frozen_timesteps)
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = torch.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = self.tables.timestep_map.to(ts.device)[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
-        return self.model(x, new_ts, **kwargs)
+        if self.autocast_dtype is None:
+            return self.model(x, new_ts, **kwargs)
+        # the backward of the guidance follows the dtypes of the forward, the output is float32 again
+        with torch.autocast(device_type=x.device.type, dtype=self.autocast_dtype):
+            out = self.model(x, new_ts, **kwargs)
+        return out.float()
 
 
 @register_sampler(name='ddpm')
@@ -504,35 +781,40 @@ class DDPM(SpacedDiffusion):
 
 @register_sampler(name='ddim')
 class DDIM(SpacedDiffusion):
-    def p_sample(self, model, x, t, eta=0.0):
+    def __init__(self, use_timesteps, **kwargs):
+        super().__init__(use_timesteps, **kwargs)
+        self.eta = kwargs.get("eta", 0.0)
+
+    def p_mean_std(self, model, x, t, eta=None):
+        eta = self.eta if eta is None else eta
         out = self.p_mean_variance(model, x, t)
 
         eps = self.predict_eps_from_x_start(x, t, out['pred_xstart'])
 
-        alpha_bar = extract_and_expand(self.alphas_cumprod, t, x)
-        alpha_bar_prev = extract_and_expand(self.alphas_cumprod_prev, t, x)
+        alpha_bar = self.tables.extract('alphas_cumprod', t, x)
+        alpha_bar_prev = self.tables.extract('alphas_cumprod_prev', t, x)
         sigma = (
                 eta
                 * torch.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
                 * torch.sqrt(1 - alpha_bar / alpha_bar_prev)
         )
         # Equation 12.
-        noise = torch.randn_like(x)
-        mean_pred = (
+        out['mean'] = (
                 out["pred_xstart"] * torch.sqrt(alpha_bar_prev)
                 + torch.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
         )
+        out['std'] = sigma
 
-        sample = mean_pred
-        if t != 0:
-            sample += sigma * noise
+        return out
 
-        return {"sample": sample, "pred_xstart": out["pred_xstart"]}
+    def p_sample(self, model, x, t, eta=None):
+        out = self.p_mean_std(model, x, t, eta)
 
-    def predict_eps_from_x_start(self, x_t, t, pred_xstart):
-        coef1 = extract_and_expand(self.sqrt_recip_alphas_cumprod, t, x_t)
-        coef2 = extract_and_expand(self.sqrt_recipm1_alphas_cumprod, t, x_t)
-        return (coef1 * x_t - pred_xstart) / coef2
+        sample = out['mean']
+        if t[0] != 0:
+            sample += out['std'] * torch.randn_like(x)
+
+        return {"sample": sample, "pred_xstart": out["pred_xstart"]}
 
 
 # =================
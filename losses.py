@@ -57,7 +57,8 @@ class Value_Loss(nn.Module):
     def forward(self, rgbd, **kwargs):
         rgb = (rgbd[:, 0:3, :, :])
         value = kwargs.get("value", 0.7)
-        val_loss = (torch.maximum(rgb.abs() - value, torch.zeros_like(rgb)) ** 2).mean()
+        # mean of each image separately and summed (as the guidance loss) - independent samples in a batch
+        val_loss = (torch.maximum(rgb.abs() - value, torch.zeros_like(rgb)) ** 2).mean(dim=(1, 2, 3)).sum()
 
         return val_loss
 
@@ -75,9 +76,13 @@ class AuxiliaryLoss(nn.Module):
     def forward(self, x):
         aux_loss = 0
         aux_loss_dict = {}
+        # the gammas are moved to the device only once
+        if self.loss_gammas and self.loss_gammas[0].device != x.device:
+            self.loss_gammas = [gamma_ii.to(x.device) for gamma_ii in self.loss_gammas]
+
         # summing the losses according to their gammas
         for gamma_ii, loss_ii, loss_name_ii in zip(self.loss_gammas, self.losses_list, self.losses_dictionary):
             cur_loss = loss_ii.forward(x)
-            aux_loss += gamma_ii.to(x.device) * cur_loss
-            aux_loss_dict[loss_name_ii] = cur_loss.detach().cpu()
+            aux_loss += gamma_ii * cur_loss
+            aux_loss_dict[loss_name_ii] = cur_loss.detach()
         return aux_loss, aux_loss_dict
\ No newline at end of file
@@ -8,6 +8,7 @@ import numpy as np
 from torchvision import torch
 
 import utils as utilso
+from sampling_config import DepthConfig
 
 # =================
 # Operation classes
@@ -96,44 +97,305 @@ class RGBGuidanceOperator(LinearOperator):
         return data
 
 
+# the phi's solvers of masked_optimize (continuous batching) - their state is per element (e.g. the momentum of sgd),
+# the optimizers with a step counter in their update (e.g. the bias correction of adam) are shared by the batch
+MASKED_SOLVERS = ('gd', 'lm', 'sgd', 'rmsprop')
+
+
 # osmosis - learnable Operator
 class LearnableOperator(ABC):
+    def __init__(self, device, **kwargs):
+        self.device = device
+        # the depth conversion (depth_type and value, or a parsed sampling_config.DepthConfig - depth), parsed once
+        self.depth = DepthConfig.from_kwargs(kwargs)
+
+        # the phi's optimizer by name - GD (the default), a torch optimizer or lm - the per step phi solver
+        self.solver = str(kwargs.get("optimizer", None) or "GD").lower()
+        # optimizer: lm - the number of Levenberg-Marquardt steps per guided step, the initial damping and the upper
+        # bound of the attenuation coefficients (the solver may otherwise explain a noisy x0 prediction by an extreme
+        # attenuation)
+        self.lm_steps = int(kwargs.get("lm_steps", 3))
+        self.lm_damping = float(kwargs.get("lm_damping", 1e-3))
+        self.lm_max_attenuation = float(kwargs.get("lm_max_attenuation", 5.0))
+
+    def set_optimizer(self, model_parameters):
+        """
+        Create the torch optimizer of the phi's (param groups in the order of get_variable_list) and keep the
+        initialization values - the optimizer is None for GD and for the lm solver.
+        """
+        self.optimizer = utilso.get_optimizer(optimizer_name=self.solver, model_parameters=model_parameters)
+        self.store_initial_variables()
 
     @abstractmethod
     def forward(self, data, **kwargs):
         pass
 
-
-@register_operator(name='haze_physical')
-class HazePhysicalOperator(LearnableOperator):
-    def __init__(self, device, phi_ab, phi_inf, phi_ab_eta=1e-5, phi_inf_eta=1e-5,
-                 phi_ab_learn_flag=True, phi_inf_learn_flag=True,
-                 batch_size=1, **kwargs):
-
-        self.device = device
-        self.depth_type = kwargs.get("depth_type", None)
-        tmp_value = kwargs.get("value", None)
-        self.value = utilso.get_depth_value(tmp_value)
-
-        # initialization values
-        self.phi_ab = torch.tensor(float(phi_ab)).to(device)
-        self.phi_ab = self.phi_ab.repeat(batch_size, 1).unsqueeze(-1).unsqueeze(-1)
-
-        self.phi_inf = torch.tensor(np.fromstring(phi_inf, dtype=float, sep=','), dtype=torch.float, device=device)
-        self.phi_inf = self.phi_inf.repeat(batch_size, 1).unsqueeze(-1).unsqueeze(-1)
-
-        self.phi_ab_learn_flag = phi_ab_learn_flag
-        self.phi_inf_learn_flag = phi_inf_learn_flag
-
-        # coefficients for the Gradient descend step size
-        self.phi_ab_eta = float(phi_ab_eta) if phi_ab_learn_flag else float(0)
-        self.phi_inf_eta = float(phi_inf_eta) if phi_inf_learn_flag else float(0)
-
-        # set optimizer
-        optimizer = kwargs.get("optimizer", None)
-        self.optimizer = utilso.get_optimizer(optimizer_name=optimizer,
-                                              model_parameters=[{'params': self.phi_ab, "lr": self.phi_ab_eta},
-                                                                {'params': self.phi_inf, "lr": self.phi_inf_eta}])
+    def scale_learning_rates(self, lr_scale=1.0):
+        # scale the optimizer learning rates relative to their initial values
+        if not isinstance(self.optimizer, torch.optim.Optimizer):
+            return
+        for param_group in self.optimizer.param_groups:
+            param_group.setdefault('base_lr', param_group['lr'])
+            param_group['lr'] = param_group['base_lr'] * lr_scale
+
+    def store_initial_variables(self):
+        # keep the initialization values, used for resetting part of the batch (continuous batching)
+        self.initial_variables = [variable_ii.detach().clone() for variable_ii in self.get_variable_list()]
+
+    def reset_variables(self, index):
+        """
+        Reset the phi's (and their optimizer state) of the batch elements in index to the initialization values.
+        """
+        with torch.no_grad():
+            for variable_ii, initial_ii in zip(self.get_variable_list(), self.initial_variables):
+                variable_ii[index] = initial_ii[index]
+                if variable_ii.grad is not None:
+                    variable_ii.grad[index] = 0
+
+                # the damping of the phi solver
+                if getattr(self, 'damping', None) is not None:
+                    self.damping[index] = self.lm_damping
+
+                # optimizer state per element (e.g. momentum) has the shape of the variable
+                if isinstance(self.optimizer, torch.optim.Optimizer):
+                    for state_ii in self.optimizer.state.get(variable_ii, {}).values():
+                        if torch.is_tensor(state_ii) and state_ii.shape == variable_ii.shape:
+                            state_ii[index] = 0
+
+    def reset(self, batch_size=None, init_phi=None):
+        """
+        Prepare the operator for a new batch, the operator is constructed once and reused for all the images.
+
+        The phi's of every element are set to the initialization values (or to init_phi), and their gradients, the
+        optimizer state, the learning rates and the damping of the phi solver are cleared, so nothing leaks from the
+        previous images. The phi's are reallocated (and the optimizer is pointed to them) only if the batch size changes.
+
+        :param batch_size: the new batch size, None - unchanged.
+        :param init_phi: a dictionary of initial phi's {name: [B x C x 1 x 1] or [C] values}, None - the
+                         initialization values of the configuration (the phi's which are not in it as well).
+        """
+        names = list(self.get_variable_gradients().keys())
+        init_phi = {} if init_phi is None else init_phi
+        for name in init_phi.keys():
+            if name not in names:
+                raise KeyError(f"Unknown phi {name}, the phi's of the operator are {names}")
+
+        current_size = self.initial_variables[0].shape[0]
+        batch_size = current_size if batch_size is None else int(batch_size)
+
+        with torch.no_grad():
+            if batch_size != current_size:
+                # every row of the initialization values is the same - the configuration values
+                self.initial_variables = [initial_ii[:1].repeat(batch_size, 1, 1, 1)
+                                          for initial_ii in self.initial_variables]
+                for name, variable_ii, initial_ii in zip(names, self.get_variable_list(), self.initial_variables):
+                    setattr(self, name, initial_ii.clone().requires_grad_(variable_ii.requires_grad))
+
+            for name, variable_ii, initial_ii in zip(names, self.get_variable_list(), self.initial_variables):
+                value = initial_ii if name not in init_phi else \
+                    torch.as_tensor(init_phi[name], dtype=variable_ii.dtype, device=variable_ii.device)
+                variable_ii.copy_(value.view(-1, variable_ii.shape[1], 1, 1).expand_as(variable_ii))
+                variable_ii.grad = None
+
+        # the damping of the phi solver is allocated again for the batch on the first guided step
+        self.damping = None
+
+        # the optimizer state is per variable tensor, the param groups are in the order of the variable list
+        if isinstance(self.optimizer, torch.optim.Optimizer):
+            self.optimizer.state.clear()
+            for param_group, variable_ii in zip(self.optimizer.param_groups, self.get_variable_list()):
+                param_group['params'] = [variable_ii]
+                param_group['lr'] = param_group.get('base_lr', param_group['lr'])
+
+        return self
+
+    def check_masked_solver(self):
+        """
+        Raise if the phi's of the batch elements can not be optimized independently (see MASKED_SOLVERS).
+        """
+        if self.solver not in MASKED_SOLVERS:
+            raise ValueError(f"The optimizer {self.solver} has a step counter which is shared by the batch, the phi's "
+                             f"of a pool (continuous batching) are optimized with one of {list(MASKED_SOLVERS)}")
+
+    def _element_state(self):
+        # the optimizer state per element (e.g. momentum) - the state tensors which have the shape of the variable
+        if not isinstance(self.optimizer, torch.optim.Optimizer):
+            return []
+        return [(variable_ii, key_ii, state_ii) for variable_ii in self.get_variable_list()
+                for key_ii, state_ii in self.optimizer.state.get(variable_ii, {}).items()
+                if torch.is_tensor(state_ii) and state_ii.shape == variable_ii.shape]
+
+    def masked_optimize(self, update_mask, lr_scale=1.0, **kwargs):
+        """
+        Optimize the phi's of the batch elements in update_mask only, the rest keep their values and their
+        optimizer state, as if the step did not happen for them.
+
+        The guidance loss is a sum over the batch, so the gradients of every element are independent.
+        :param update_mask: a [B] bool tensor of the elements to update.
+        :param lr_scale: a scalar or a [B] tensor of learning rate factors - a per element factor scales
+                         the gradients, which is equal to scaling the learning rate for GD and SGD.
+        """
+        self.check_masked_solver()
+        variables_list = self.get_variable_list()
+        previous_variables = [variable_ii.detach().clone() for variable_ii in variables_list]
+        # the state of a first step is created by the step, the elements which are not updated keep a zero state
+        previous_state = {(variable_ii, key_ii): state_ii.clone()
+                          for variable_ii, key_ii, state_ii in self._element_state()}
+
+        mask = update_mask.view(-1, 1, 1, 1)
+        scale = lr_scale.view(-1, 1, 1, 1) if torch.is_tensor(lr_scale) else 1.0
+        with torch.no_grad():
+            for variable_ii in variables_list:
+                if variable_ii.grad is not None:
+                    variable_ii.grad.copy_(torch.where(mask, variable_ii.grad * scale, 0))
+        lr_scale = 1.0 if torch.is_tensor(lr_scale) else lr_scale
+
+        variables_dict = self.optimize(freeze_phi=False, lr_scale=lr_scale, **kwargs)
+
+        with torch.no_grad():
+            for variable_ii, previous_ii in zip(variables_list, previous_variables):
+                variable_ii.copy_(torch.where(mask, variable_ii, previous_ii))
+            for variable_ii, key_ii, state_ii in self._element_state():
+                previous_ii = previous_state.get((variable_ii, key_ii), torch.zeros_like(state_ii))
+                state_ii.copy_(torch.where(mask, state_ii, previous_ii))
+
+        return variables_dict
+
+    # %% analytic phi gradients - the inner phi optimization without autograd
+
+    def split_rgbd(self, data):
+        """
+        The rgb in [0,1] and the converted depth of an rgbd (unet prediction in [-1,1]).
+        """
+        rgb_norm = 0.5 * (data[:, 0:-1, :, :] + 1)
+        depth = self.depth(data[:, -1, :, :].unsqueeze(1))
+        return rgb_norm, depth
+
+    def forward_terms(self, rgb_norm, depth):
+        """
+        The forward of a split rgbd and the (attenuation) terms which are shared with analytic_gradients.
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no analytic gradients")
+
+    def analytic_gradients(self, grad_output, rgb_norm, depth, terms):
+        """
+        The gradients of a loss w.r.t. the phi's (in the order of get_variable_list), given the gradient of the loss
+        w.r.t. the forward output.
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no analytic gradients")
+
+    # %% per step phi solver (optimizer: lm) - closed form phi_inf and Levenberg-Marquardt for the attenuation
+
+    def linear_terms(self, rgb_norm, depth, terms):
+        """
+        The forward is linear in phi_inf: forward = direct + phi_inf * basis, return (direct, basis).
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no phi solver")
+
+    def attenuation_jacobians(self, rgb_norm, depth, terms):
+        """
+        The attenuation variables which are learned and the derivatives of the forward w.r.t. them (per pixel).
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no phi solver")
+
+    def _solve_phi_inf(self, rgb_norm, depth, target, weight2, terms):
+        # weighted least squares of phi_inf per image and channel (for the current attenuation)
+        direct, basis = self.linear_terms(rgb_norm, depth, terms)
+        if self.phi_inf_learn_flag:
+            numerator = (weight2 * (target - direct) * basis).sum_to_size(self.phi_inf.shape)
+            denominator = (weight2 * basis ** 2).sum_to_size(self.phi_inf.shape)
+            # the backscatter is an intensity - kept in [0,1]
+            self.phi_inf.copy_(torch.clamp(numerator / denominator.clamp_min(1e-12), min=0, max=1))
+        return direct + self.phi_inf * basis
+
+    @torch.no_grad()
+    def solve_phi(self, rgb_norm, depth, target, weight=1, update_mask=None):
+        """
+        Solve the phi's of the current x0 prediction - the weighted least squares of the forward against the
+        measurement, which has the same minimum as the norm and the mse guidance losses.
+
+        phi_inf is solved in closed form for the current attenuation, and the attenuation coefficients take
+        lm_steps Levenberg-Marquardt steps (a damped Gauss-Newton step with phi_inf eliminated, accepted per image
+        only when the cost decreases). All the images and channels are solved together with batched small systems.
+
+        :param rgb_norm: the rgb of the x0 prediction in [0,1].
+        :param depth: the converted depth of the x0 prediction.
+        :param target: the measurement in [0,1].
+        :param weight: the loss weights.
+        :param update_mask: a [B] bool tensor of the images to solve, None - all.
+        """
+        variables = self.get_variable_list()
+        previous_variables = [variable_ii.clone() for variable_ii in variables]
+        weight2 = (torch.ones_like(target) * weight) ** 2
+        batch_size = target.shape[0]
+
+        def cost(forward_ii):
+            return (weight2 * (target - forward_ii) ** 2).sum(dim=(1, 2, 3))
+
+        _, terms = self.forward_terms(rgb_norm, depth)
+        forward = self._solve_phi_inf(rgb_norm, depth, target, weight2, terms)
+        current_cost = cost(forward)
+        # the damping of every image is carried over to the next guided step
+        if getattr(self, 'damping', None) is None:
+            self.damping = torch.full((batch_size,), self.lm_damping, device=target.device)
+        damping = self.damping
+
+        for _ in range(self.lm_steps):
+            jacobians = self.attenuation_jacobians(rgb_norm, depth, terms)
+            if len(jacobians) == 0:
+                break
+            shape = jacobians[0][0].shape
+            # phi_inf is stepped jointly when it has the shape of the attenuation (per channel), which takes its
+            # coupling with the attenuation into account, and is then re-solved in closed form
+            if self.phi_inf_learn_flag and self.phi_inf.shape == shape:
+                jacobians.append((self.phi_inf, self.linear_terms(rgb_norm, depth, terms)[1]))
+            error = target - forward
+
+            # the normal equations per image (and channel) - [... x K x K] and [... x K]
+            hessian = torch.stack([torch.stack([(weight2 * jacobian_ii * jacobian_jj).sum_to_size(shape)
+                                                for _, jacobian_jj in jacobians], dim=-1)
+                                   for _, jacobian_ii in jacobians], dim=-2)
+            gradient = torch.stack([(weight2 * jacobian_ii * error).sum_to_size(shape)
+                                    for _, jacobian_ii in jacobians], dim=-1)
+            # Marquardt scaling, a vanishing direction (e.g. an attenuation which already zeroed its term) is damped
+            # relative to the largest one, such that the system stays regular
+            diagonal = torch.diagonal(hessian, dim1=-2, dim2=-1)
+            diagonal = torch.maximum(diagonal, 1e-6 * diagonal.amax(dim=-1, keepdim=True) + 1e-12)
+            damped = hessian + torch.diag_embed(damping.view(-1, 1, 1, 1, 1) * diagonal)
+            delta = torch.nan_to_num(torch.linalg.solve(damped, gradient), nan=0.0, posinf=0.0, neginf=0.0)
+
+            step_variables = [variable_ii.clone() for variable_ii in variables]
+            for kk, (variable_ii, _) in enumerate(jacobians):
+                # the attenuation coefficients are kept in a physical range, phi_inf in [0,1]
+                max_value = 1 if variable_ii is self.phi_inf else self.lm_max_attenuation
+                variable_ii.add_(delta[..., kk]).clamp_(min=0, max=max_value)
+            _, terms = self.forward_terms(rgb_norm, depth)
+            step_forward = self._solve_phi_inf(rgb_norm, depth, target, weight2, terms)
+            step_cost = cost(step_forward)
+
+            # accept the step per image, otherwise increase the damping (towards gradient descent)
+            accept = torch.isfinite(step_cost) & (step_cost < current_cost)
+            for variable_ii, step_variable_ii in zip(variables, step_variables):
+                variable_ii.copy_(torch.where(accept.view(-1, 1, 1, 1), variable_ii, step_variable_ii))
+            damping = torch.where(accept, damping / 10, damping * 10)
+            current_cost = torch.where(accept, step_cost, current_cost)
+            forward, terms = self.forward_terms(rgb_norm, depth)
+
+        if update_mask is not None:
+            for variable_ii, previous_ii in zip(variables, previous_variables):
+                variable_ii.copy_(torch.where(update_mask.view(-1, 1, 1, 1), variable_ii, previous_ii))
+            damping = torch.where(update_mask, damping, self.damping)
+        self.damping = damping
+
+        return {key_ii: variable_ii.detach() for key_ii, variable_ii in zip(self.get_variable_gradients().keys(),
+                                                                           variables)}
+
+
+class AttenuationOperator(LearnableOperator):
+    """
+    The image formation model with a single attenuation phi_ab of the direct signal and the backscatter:
+    rgb * exp(-phi_ab * depth) + phi_inf * (1 - exp(-phi_ab * depth)) - the haze and the underwater operators.
+    """
 
     def forward(self, data, **kwargs):
 
@@ -143,7 +405,7 @@ class HazePhysicalOperator(LearnableOperator):
         depth_tmp = data[:, -1, :, :].unsqueeze(1)
 
         # convert depth to relevant coordinates
-        depth = utilso.convert_depth(depth=depth_tmp, depth_type=self.depth_type, value=self.value)
+        depth = self.depth(depth_tmp)
 
         # the underwater image formation model
         uw_image = rgb_norm * torch.exp(-self.phi_ab * depth) + self.phi_inf * (1 - torch.exp(-self.phi_ab * depth))
@@ -153,23 +415,25 @@ class HazePhysicalOperator(LearnableOperator):
     def optimize(self, **kwargs):
 
         freeze_phi = kwargs.get("freeze_phi", False)
+        # learning rate factor, e.g. a respaced step covers several original steps
+        lr_scale = kwargs.get("lr_scale", 1.0)
 
         # update only part of the variables - in this case: self.optimizer == "GD"
         update_phi_ab = self.phi_ab.requires_grad
         update_phi_inf = self.phi_inf.requires_grad
 
-        # when freeze_phi is True that means no optimization is required
-        if not freeze_phi:
+        # when freeze_phi is True that means no optimization is required, the lm solver sets the phi's by solve_phi
+        if not freeze_phi and self.solver != "lm":
 
             # no optimizer was specified - GD is the default
-            if self.optimizer is None or self.optimizer == "GD" or self.optimizer == "":
+            if self.optimizer is None:
 
                 # classic gradient descend
                 with torch.no_grad():
                     if update_phi_ab:
-                        self.phi_ab.add_(self.phi_ab.grad, alpha=-self.phi_ab_eta)
+                        self.phi_ab.add_(self.phi_ab.grad, alpha=-self.phi_ab_eta * lr_scale)
                     if update_phi_inf:
-                        self.phi_inf.add_(self.phi_inf.grad, alpha=-self.phi_inf_eta)
+                        self.phi_inf.add_(self.phi_inf.grad, alpha=-self.phi_inf_eta * lr_scale)
                 # zero the gradients so they will not accumulate
                 if update_phi_ab:
                     self.phi_ab.grad.zero_()
@@ -178,6 +442,7 @@ class HazePhysicalOperator(LearnableOperator):
 
             # optimizer was specified
             else:
+                self.scale_learning_rates(lr_scale)
                 self.optimizer.step()
                 self.optimizer.zero_grad()
 
@@ -207,6 +472,56 @@ class HazePhysicalOperator(LearnableOperator):
 
         return [self.phi_ab, self.phi_inf]
 
+    def forward_terms(self, rgb_norm, depth):
+        # the attenuation is shared by the forward and the phi gradients
+        exp_ab = torch.exp(-self.phi_ab * depth)
+        uw_image = rgb_norm * exp_ab + self.phi_inf * (1 - exp_ab)
+        return uw_image, exp_ab
+
+    def analytic_gradients(self, grad_output, rgb_norm, depth, terms):
+        exp_ab = terms
+        # d/d(phi_ab) = -depth * exp(-phi_ab * depth) * (rgb - phi_inf), d/d(phi_inf) = 1 - exp(-phi_ab * depth),
+        # summed over the pixels (and the channels of a single phi_ab)
+        grad_phi_ab = -(grad_output * depth * exp_ab * (rgb_norm - self.phi_inf)).sum_to_size(self.phi_ab.shape)
+        grad_phi_inf = (grad_output * (1 - exp_ab)).sum_to_size(self.phi_inf.shape)
+        return [grad_phi_ab, grad_phi_inf]
+
+    def linear_terms(self, rgb_norm, depth, terms):
+        exp_ab = terms
+        return rgb_norm * exp_ab, 1 - exp_ab
+
+    def attenuation_jacobians(self, rgb_norm, depth, terms):
+        exp_ab = terms
+        if not self.phi_ab_learn_flag:
+            return []
+        return [(self.phi_ab, -depth * exp_ab * (rgb_norm - self.phi_inf))]
+
+
+@register_operator(name='haze_physical')
+class HazePhysicalOperator(AttenuationOperator):
+    def __init__(self, device, phi_ab, phi_inf, phi_ab_eta=1e-5, phi_inf_eta=1e-5,
+                 phi_ab_learn_flag=True, phi_inf_learn_flag=True,
+                 batch_size=1, **kwargs):
+        super().__init__(device, **kwargs)
+
+        # initialization values
+        self.phi_ab = torch.tensor(float(phi_ab)).to(device)
+        self.phi_ab = self.phi_ab.repeat(batch_size, 1).unsqueeze(-1).unsqueeze(-1)
+
+        self.phi_inf = torch.tensor(np.fromstring(phi_inf, dtype=float, sep=','), dtype=torch.float, device=device)
+        self.phi_inf = self.phi_inf.repeat(batch_size, 1).unsqueeze(-1).unsqueeze(-1)
+
+        self.phi_ab_learn_flag = phi_ab_learn_flag
+        self.phi_inf_learn_flag = phi_inf_learn_flag
+
+        # coefficients for the Gradient descend step size
+        self.phi_ab_eta = float(phi_ab_eta) if phi_ab_learn_flag else float(0)
+        self.phi_inf_eta = float(phi_inf_eta) if phi_inf_learn_flag else float(0)
+
+        # set optimizer
+        self.set_optimizer([{'params': self.phi_ab, "lr": self.phi_ab_eta},
+                            {'params': self.phi_inf, "lr": self.phi_inf_eta}])
+
 
 @register_operator(name='underwater_physical_revised')
 class UnderWaterPhysicalRevisedOperator(LearnableOperator):
@@ -214,12 +529,7 @@ class UnderWaterPhysicalRevisedOperator(LearnableOperator):
                  phi_a_eta=1e-5, phi_b_eta=1e-5, phi_inf_eta=1e-5,
                  phi_a_learn_flag=True, phi_b_learn_flag=True, phi_inf_learn_flag=True,
                  batch_size=1, **kwargs):
-
-        self.device = device
-
-        self.depth_type = kwargs.get("depth_type", None)
-        tmp_value = kwargs.get("value", None)
-        self.value = utilso.get_depth_value(tmp_value)
+        super().__init__(device, **kwargs)
 
         # initialization values
         self.phi_a = torch.tensor(np.fromstring(phi_a, dtype=float, sep=','), dtype=torch.float, device=device)
@@ -242,11 +552,9 @@ class UnderWaterPhysicalRevisedOperator(LearnableOperator):
         self.phi_inf_eta = float(phi_inf_eta) if phi_inf_learn_flag else float(0)
 
         # set optimizer
-        optimizer = kwargs.get("optimizer", None)
-        self.optimizer = utilso.get_optimizer(optimizer_name=optimizer,
-                                              model_parameters=[{'params': self.phi_a, "lr": self.phi_a_eta},
-                                                                {'params': self.phi_b, "lr": self.phi_b_eta},
-                                                                {'params': self.phi_inf, "lr": self.phi_inf_eta}])
+        self.set_optimizer([{'params': self.phi_a, "lr": self.phi_a_eta},
+                            {'params': self.phi_b, "lr": self.phi_b_eta},
+                            {'params': self.phi_inf, "lr": self.phi_inf_eta}])
 
     def forward(self, data, **kwargs):
 
@@ -256,7 +564,7 @@ class UnderWaterPhysicalRevisedOperator(LearnableOperator):
         depth_tmp = data[:, -1, :, :].unsqueeze(1)
 
         # convert depth to relevant coordinates
-        depth = utilso.convert_depth(depth=depth_tmp, depth_type=self.depth_type, value=self.value)
+        depth = self.depth(depth_tmp)
 
         # the underwater image formation model
         uw_image = rgb_norm * torch.exp(-self.phi_a * depth) + self.phi_inf * (1 - torch.exp(-self.phi_b * depth))
@@ -266,26 +574,28 @@ class UnderWaterPhysicalRevisedOperator(LearnableOperator):
     def optimize(self, **kwargs):
 
         freeze_phi = kwargs.get("freeze_phi", False)
+        # learning rate factor, e.g. a respaced step covers several original steps
+        lr_scale = kwargs.get("lr_scale", 1.0)
 
         # update only part of the variables - in this case: self.optimizer == "GD"
         update_phi_a = self.phi_a.requires_grad
         update_phi_b = self.phi_b.requires_grad
         update_phi_inf = self.phi_inf.requires_grad
 
-        # when freeze_phi is True that means no optimization is required
-        if not freeze_phi:
+        # when freeze_phi is True that means no optimization is required, the lm solver sets the phi's by solve_phi
+        if not freeze_phi and self.solver != "lm":
 
             # no optimizer was specified - GD is the default
-            if self.optimizer is None or self.optimizer == "GD" or self.optimizer == "":
+            if self.optimizer is None:
 
                 # classic gradient descend
                 with torch.no_grad():
                     if update_phi_a:
-                        self.phi_a.add_(self.phi_a.grad, alpha=-self.phi_a_eta)
+                        self.phi_a.add_(self.phi_a.grad, alpha=-self.phi_a_eta * lr_scale)
                     if update_phi_b:
-                        self.phi_b.add_(self.phi_b.grad, alpha=-self.phi_b_eta)
+                        self.phi_b.add_(self.phi_b.grad, alpha=-self.phi_b_eta * lr_scale)
                     if update_phi_inf:
-                        self.phi_inf.add_(self.phi_inf.grad, alpha=-self.phi_inf_eta)
+                        self.phi_inf.add_(self.phi_inf.grad, alpha=-self.phi_inf_eta * lr_scale)
 
                 # zero the gradients so they will not accumulate
                 if update_phi_a:
@@ -297,6 +607,7 @@ class UnderWaterPhysicalRevisedOperator(LearnableOperator):
 
             else:
 
+                self.scale_learning_rates(lr_scale)
                 self.optimizer.step()
                 self.optimizer.zero_grad()
 
@@ -328,17 +639,43 @@ class UnderWaterPhysicalRevisedOperator(LearnableOperator):
 
         return [self.phi_a, self.phi_b, self.phi_inf]
 
+    def forward_terms(self, rgb_norm, depth):
+        # the attenuation and the backscatter exponents are shared by the forward and the phi gradients
+        exp_a = torch.exp(-self.phi_a * depth)
+        exp_b = torch.exp(-self.phi_b * depth)
+        uw_image = rgb_norm * exp_a + self.phi_inf * (1 - exp_b)
+        return uw_image, (exp_a, exp_b)
+
+    def analytic_gradients(self, grad_output, rgb_norm, depth, terms):
+        exp_a, exp_b = terms
+        # d/d(phi_a) = -depth * rgb * exp(-phi_a * depth), d/d(phi_b) = phi_inf * depth * exp(-phi_b * depth),
+        # d/d(phi_inf) = 1 - exp(-phi_b * depth), summed over the pixels
+        grad_depth = grad_output * depth
+        grad_phi_a = -(grad_depth * rgb_norm * exp_a).sum_to_size(self.phi_a.shape)
+        grad_phi_b = (grad_depth * exp_b).sum_to_size(self.phi_b.shape) * self.phi_inf
+        grad_phi_inf = (grad_output * (1 - exp_b)).sum_to_size(self.phi_inf.shape)
+        return [grad_phi_a, grad_phi_b, grad_phi_inf]
+
+    def linear_terms(self, rgb_norm, depth, terms):
+        exp_a, exp_b = terms
+        return rgb_norm * exp_a, 1 - exp_b
+
+    def attenuation_jacobians(self, rgb_norm, depth, terms):
+        exp_a, exp_b = terms
+        jacobians = []
+        if self.phi_a_learn_flag:
+            jacobians.append((self.phi_a, -depth * rgb_norm * exp_a))
+        if self.phi_b_learn_flag:
+            jacobians.append((self.phi_b, self.phi_inf * depth * exp_b))
+        return jacobians
+
 
 @register_operator(name='underwater_physical')
-class UnderWaterPhysicalOperator(LearnableOperator):
+class UnderWaterPhysicalOperator(AttenuationOperator):
     def __init__(self, device, phi_ab, phi_inf, phi_ab_eta=1e-5, phi_inf_eta=1e-5,
                  phi_ab_learn_flag=True, phi_inf_learn_flag=True,
                  batch_size=1, **kwargs):
-
-        self.device = device
-        self.depth_type = kwargs.get("depth_type", None)
-        tmp_value = kwargs.get("value", None)
-        self.value = utilso.get_depth_value(tmp_value)
+        super().__init__(device, **kwargs)
 
         # initialization values
         self.phi_ab = torch.tensor(np.fromstring(phi_ab, dtype=float, sep=','), dtype=torch.float, device=device)
@@ -355,82 +692,8 @@ class UnderWaterPhysicalOperator(LearnableOperator):
         self.phi_inf_eta = float(phi_inf_eta) if phi_inf_learn_flag else float(0)
 
         # set optimizer
-        optimizer = kwargs.get("optimizer", None)
-        self.optimizer = utilso.get_optimizer(optimizer_name=optimizer,
-                                              model_parameters=[{'params': self.phi_ab, "lr": self.phi_ab_eta},
-                                                                {'params': self.phi_inf, "lr": self.phi_inf_eta}])
-
-    def forward(self, data, **kwargs):
-
-        # split into rgb and depth
-        rgb = data[:, 0:-1, :, :]
-        rgb_norm = 0.5 * (rgb + 1)
-        depth_tmp = data[:, -1, :, :].unsqueeze(1)
-
-        # convert depth to relevant coordinates
-        depth = utilso.convert_depth(depth=depth_tmp, depth_type=self.depth_type, value=self.value)
-
-        # the underwater image formation model
-        uw_image = rgb_norm * torch.exp(-self.phi_ab * depth) + self.phi_inf * (1 - torch.exp(-self.phi_ab * depth))
-
-        return uw_image
-
-    def optimize(self, **kwargs):
-
-        freeze_phi = kwargs.get("freeze_phi", False)
-
-        # update only part of the variables - in this case: self.optimizer == "GD"
-        update_phi_ab = self.phi_ab.requires_grad
-        update_phi_inf = self.phi_inf.requires_grad
-
-        # when freeze_phi is True that means no optimization is required
-        if not freeze_phi:
-
-            # no optimizer was specified - GD is the default
-            if self.optimizer is None or self.optimizer == "GD" or self.optimizer == "":
-
-                # classic gradient descend
-                with torch.no_grad():
-                    if update_phi_ab:
-                        self.phi_ab.add_(self.phi_ab.grad, alpha=-self.phi_ab_eta)
-                    if update_phi_inf:
-                        self.phi_inf.add_(self.phi_inf.grad, alpha=-self.phi_inf_eta)
-                # zero the gradients so they will not accumulate
-                if update_phi_ab:
-                    self.phi_ab.grad.zero_()
-                if update_phi_inf:
-                    self.phi_inf.grad.zero_()
-
-            # optimizer was specified
-            else:
-                self.optimizer.step()
-                self.optimizer.zero_grad()
-
-        # return self.beta.detach(), self.b_inf.detach()
-        return {'phi_ab': self.phi_ab.detach(), 'phi_inf': self.phi_inf.detach()}
-
-    def get_variable_gradients(self, **kwargs):
-
-        grad_enable_dict = {"phi_ab": self.phi_ab.requires_grad,
-                            "phi_inf": self.phi_inf.requires_grad}
-
-        return grad_enable_dict
-
-    def set_variable_gradients(self, value=None, **kwargs):
-
-        if value is None:
-            raise ValueError("A value should be specified (True or False for general or dictionary)")
-
-        if isinstance(value, dict):
-            self.phi_ab.requires_grad_(value["phi_ab"])
-            self.phi_inf.requires_grad_(value["phi_inf"])
-        else:
-            self.phi_ab.requires_grad_(value)
-            self.phi_inf.requires_grad_(value)
-
-    def get_variable_list(self, **kwargs):
-
-        return [self.phi_ab, self.phi_inf]
+        self.set_optimizer([{'params': self.phi_ab, "lr": self.phi_ab_eta},
+                            {'params': self.phi_inf, "lr": self.phi_inf_eta}])
 
 
 # =============
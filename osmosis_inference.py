@@ -18,17 +18,346 @@ from noise import get_noise, get_operator
 from condition import get_conditioning_method   
 from unet import create_model
 from gaussian_diffusion import create_sampler
+from telemetry import SamplingTelemetry
+from batch_scheduler import ContinuousBatchingScheduler
+from compile_utils import compile_method
+from checkpoint_policy import apply_checkpoint_policy
+from sampling_config import SamplingConfig
+from convergence import ConvergenceMonitor
 import logger
 import utils as utilso
 import data as datao
 
 
+def save_osmosis_results(args, out_xstart, variable_dict, loss, ref_img, orig_file_names, global_ii, save_paths,
+                         gt_images=None):
+    """
+    Log the phi's and losses and save the result images of every image of a sampled batch.
+
+    :param out_xstart: the [B x 4 x H x W] final RGBD prediction.
+    :param variable_dict: the phi's of the operator, [B x 3 x 1 x 1] each.
+    :param loss: the final guidance loss, one value per image.
+    :param ref_img: the [B x 3 x H x W] input (reference) images in [-1,1].
+    :param orig_file_names: the file names (without extension) of the images.
+    :param global_ii: the global iteration (used in the grid file names), or a list with one per image.
+    :param save_paths: a dictionary of the saving directories.
+    :param gt_images: None, or the ground truth rgb images and the colored ground truth depth images.
+    """
+    measure_config = args.measurement
+    gt_flag = gt_images is not None
+    if gt_flag:
+        gt_rgb_img_01, gt_depth_img_01 = gt_images
+
+    out_path = save_paths['out_path']
+    save_input_path = save_paths['input']
+    save_rgb_path = save_paths['rgb']
+    save_depth_pmm_color_path = save_paths['depth_color']
+    save_depth_mm_path = save_paths['depth_raw']
+    save_grids_path = save_paths['grids']
+
+    # prepare reference images for visualization
+    ref_img = ref_img.detach().cpu()
+    ref_imgs_01 = 0.5 * (ref_img + 1)
+
+    # per sample results - the batch shares the sampling, each image is saved and logged separately
+    for batch_ii in range(out_xstart.shape[0]):
+
+        orig_file_name = orig_file_names[batch_ii]
+        ref_img_01 = ref_imgs_01[batch_ii]
+        global_name = global_ii[batch_ii] if isinstance(global_ii, (list, tuple)) else global_ii
+
+        # output from the network without guidance - split into rgb and depth image
+        sample_rgb = out_xstart[batch_ii, 0:-1, :, :]
+        sample_depth_tmp = out_xstart[batch_ii, -1, :, :].unsqueeze(0)
+        sample_depth_tmp_rep = sample_depth_tmp.repeat(3, 1, 1)
+
+        # "move" the rgb predicted image to start from 0
+        sample_rgb_01 = 0.5 * (sample_rgb + 1)
+        sample_rgb_01_clip = torch.clamp(sample_rgb_01, min=0, max=1)
+
+        # "move" the depth predicted image to start from 0
+        sample_depth_mm = utilso.min_max_norm_range(sample_depth_tmp[0].unsqueeze(0))
+        sample_depth_vis_pmm = utilso.min_max_norm_range_percentile(sample_depth_tmp,
+                                                                    vmin=0, vmax=1,
+                                                                    percent_low=0.03,
+                                                                    percent_high=0.99,
+                                                                    is_uint8=False)
+        sample_depth_vis_pmm_color = utilso.depth_tensor_to_color_image(sample_depth_vis_pmm)
+
+        # depth for calculations
+        sample_depth_calc = args.sampling_config.depth(sample_depth_tmp_rep)
+
+        # phi inf image - relevant for both underwater and haze
+        phi_inf = variable_dict['phi_inf'].cpu()[batch_ii]
+        phi_inf_image = phi_inf * torch.ones_like(sample_rgb, device=torch.device('cpu'))
+
+        # underwater model
+        if 'underwater_physical_revised' in args.measurement['operator']['name']:
+
+            # create the ingredients for the underwater image
+            phi_a = variable_dict['phi_a'].cpu()[batch_ii]
+            phi_a_image = phi_a * torch.ones_like(sample_rgb, device=torch.device('cpu'))
+            phi_b = variable_dict['phi_b'].cpu()[batch_ii]
+            phi_b_image = phi_b * torch.ones_like(sample_rgb, device=torch.device('cpu'))
+
+            # calculate the underwater parts
+            backscatter_image = phi_inf_image * (1 - torch.exp(-phi_b_image * sample_depth_calc))
+            attenuation_image = torch.exp(-phi_a_image * sample_depth_calc)
+            forward_predicted_image = sample_rgb_01 * attenuation_image + backscatter_image
+
+            # calculate norm lost for visualization - degraded_images and ref_img values should be [-1,1]
+            degraded_image = 2 * forward_predicted_image - 1
+            norm_loss_final = np.round([torch.linalg.norm(
+                degraded_image - ref_img[batch_ii].detach().cpu()).numpy()], decimals=3)
+
+            # calculate the "clean" image from the predicted phi's and ref image
+            attenuation_flip_image = torch.exp(phi_a_image * sample_depth_calc)
+            sample_rgb_recon = attenuation_flip_image * (ref_img_01 - backscatter_image)
+
+            # logging values of phi's
+            print_phi_a = [np.round(i, decimals=3) for i in phi_a.cpu().squeeze().tolist()]
+            print_phi_b = [np.round(i, decimals=3) for i in phi_b.cpu().squeeze().tolist()]
+            print_phi_inf = [np.round(i, decimals=3) for i in phi_inf.cpu().squeeze().tolist()]
+
+            log_value_txt = f"\nImage: {orig_file_name} (g{global_name})" \
+                            f"\nInitialized values: " \
+                            f"\nphi_a: [{measure_config['operator']['phi_a']}], lr: {measure_config['operator']['phi_a_eta']}" \
+                            f"\nphi_b: [{measure_config['operator']['phi_b']}], lr: {measure_config['operator']['phi_b_eta']}" \
+                            f"\nphi_inf: [{measure_config['operator']['phi_inf']}], lr: {measure_config['operator']['phi_inf_eta']}" \
+                            f"\n\nResults values: " \
+                            f"\nphi_a: {print_phi_a}" \
+                            f"\nphi_b: {print_phi_b}" \
+                            f"\nphi_inf: {print_phi_inf}" \
+                            f"\n\nNorm loss: {norm_loss_final}" \
+                            f"\nFinal loss: {np.round(np.array(loss[batch_ii]), decimals=3)}"
+
+            # log results for parameters
+            logger.log(log_value_txt)
+
+        # haze model
+        elif ('haze' in args.measurement['operator']['name']) or (
+                'underwater_physical' in args.measurement['operator']['name']):
+
+            # create the ingredients for the hazed image
+            phi_ab = variable_dict['phi_ab'].cpu()[batch_ii]
+            phi_ab_image = phi_ab * torch.ones_like(sample_rgb, device=torch.device('cpu'))
+            backscatter_image = phi_inf_image * (1 - torch.exp(-phi_ab_image * sample_depth_calc))
+            attenuation_image = torch.exp(-phi_ab_image * sample_depth_calc)
+            forward_predicted_image = sample_rgb_01 * attenuation_image + backscatter_image
+
+            # calculate the "clean" image from the predicted phis, phi_inf and ref image
+            attenuation_flip_image = torch.exp(phi_ab_image * sample_depth_calc)
+            sample_rgb_recon = attenuation_flip_image * (ref_img_01 - backscatter_image)
+
+            # calculate norm lost for visualization - both degraded_images and ref_img values should be [-1,1]
+            degraded_image = 2 * forward_predicted_image - 1
+            norm_loss_final = np.round(
+                [torch.linalg.norm(degraded_image.cpu() - ref_img[batch_ii].detach().cpu()).numpy()],
+                decimals=3)
+
+            # logging values of phi and phi_inf
+            print_phi_ab = np.round(phi_ab.cpu().squeeze(), decimals=3)
+            print_phi_inf = np.round(phi_inf.cpu().squeeze(), decimals=3)
+            log_value_txt = f"\nImage: {orig_file_name} (g{global_name})" \
+                            f"\nInitialized values: " \
+                            f"\nphi_ab: [{measure_config['operator']['phi_ab']}], lr: {measure_config['operator']['phi_ab_eta']}" \
+                            f"\nphi_inf: [{measure_config['operator']['phi_inf']}], lr: {measure_config['operator']['phi_inf_eta']}" \
+                            f"\n\nResults values: " \
+                            f"\nphi_ab: {print_phi_ab}" \
+                            f"\nphi_inf: {print_phi_inf}" \
+                            f"\n\nNorm loss: {norm_loss_final}" \
+                            f"\nFinal loss: {np.round(np.array(loss[batch_ii]), decimals=5)}"
+
+            # log results for parameters
+            logger.log(log_value_txt)
+
+        else:
+            raise NotImplementedError("Operator can be for 'underwater' or 'haze' ")
+
+        # saving single images (reference (input), rgb (restored image), depth (depth estimation))
+        if args.save_singles:
+            # input - reference image
+            ref_im_pil = tvtf.to_pil_image(ref_img_01)
+            # ref_im_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_ref.png'))
+            ref_im_pil.save(pjoin(save_input_path, f'{orig_file_name}.png'))
+
+            # rgb clip - sample_rgb_01_clip
+            sample_rgb_01_clip_pil = tvtf.to_pil_image(sample_rgb_01_clip)
+            # sample_rgb_01_clip_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_rgb.png'))
+            sample_rgb_01_clip_pil.save(pjoin(save_rgb_path, f'{orig_file_name}.png'))
+
+            # depth percentile min-max - sample_depth_vis_percentile_norm
+            sample_depth_vis_pmm_color_pil = tvtf.to_pil_image(sample_depth_vis_pmm_color)
+            # sample_depth_vis_pmm_color_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_depth.png'))
+            sample_depth_vis_pmm_color_pil.save(pjoin(save_depth_pmm_color_path, f'{orig_file_name}.png'))
+
+            # depth percentile min-max - sample_depth_vis_percentile_norm
+            sample_depth_vis_mm_pil = tvtf.to_pil_image(sample_depth_mm)
+            # sample_depth_vis_mm_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_depth_raw.png'))
+            sample_depth_vis_mm_pil.save(pjoin(save_depth_mm_path, f'{orig_file_name}.png'))
+
+        # save extended results in the grid
+        if args.save_grids:
+
+            grid_list = [ref_img_01, sample_rgb_01_clip, sample_depth_vis_pmm_color]
+
+            # there is ground truth in the case of simulation
+            if gt_flag:
+                grid_list += [torch.zeros_like(sample_rgb_01, device=torch.device('cpu')),
+                              gt_rgb_img_01[batch_ii], gt_depth_img_01[batch_ii]]
+
+            results_grid = make_grid(grid_list, nrow=3, pad_value=1.)
+            results_grid = utilso.clip_image(results_grid, scale=False, move=False, is_uint8=True) \
+                .permute(1, 2, 0).numpy()
+            results_pil = Image.fromarray(results_grid, mode="RGB")
+
+            # save the image
+            results_pil.save(pjoin(save_grids_path, f'{orig_file_name}_g{global_name}_grid.png'))
+
+        if args.save_singles or args.save_grids:
+            logger.log(f"result images was saved into: {out_path}")
+
+def save_osmosis_chains(args, out_xstart, variable_dict, loss, ref_img, orig_file_names, num_chains, save_paths,
+                        gt_images=None):
+    """
+    Save the results of parallel global_N chains - every chain and the selected (or aggregated) result per image.
+
+    The chains results are logged and saved in the grids as global iterations, the single images are
+    the selected (or aggregated) result, and the per-pixel depth variance between the chains is saved as well.
+    """
+    aggregate = args.sample_pattern.get('chains_aggregate', "min_loss")
+
+    # every chain - the chains of an image are consecutive in the batch
+    chains_gt_images = None
+    if gt_images is not None:
+        chains_gt_images = (gt_images[0].repeat_interleave(num_chains, dim=0),
+                            [gt_depth_ii for gt_depth_ii in gt_images[1] for _ in range(num_chains)])
+    chains_file_names = [file_name_ii for file_name_ii in orig_file_names for _ in range(num_chains)]
+    save_osmosis_results(args, out_xstart, variable_dict, loss, ref_img.repeat_interleave(num_chains, dim=0),
+                         chains_file_names, list(range(num_chains)) * len(orig_file_names), save_paths,
+                         gt_images=chains_gt_images)
+
+    # the selected (or aggregated) chain
+    out_xstart, variable_dict, loss, depth_variance, selected = \
+        utilso.aggregate_chains(out_xstart, variable_dict, loss, num_chains, method=aggregate)
+    if selected is not None:
+        logger.log(f"\nSelected chains (lowest final loss): {dict(zip(orig_file_names, selected.tolist()))}")
+    else:
+        logger.log(f"\nChains aggregation: {aggregate} of {num_chains} chains")
+
+    save_osmosis_results(args, out_xstart, variable_dict, loss, ref_img, orig_file_names, aggregate, save_paths,
+                         gt_images=gt_images)
+
+    # per-pixel depth variance between the chains - min-max normalized for visualization
+    if args.save_singles:
+        save_depth_variance_path = pjoin(save_paths['out_path'], "single_images", "depth_variance")
+        os.makedirs(save_depth_variance_path, exist_ok=True)
+        for depth_variance_ii, file_name_ii in zip(depth_variance.cpu(), orig_file_names):
+            depth_variance_vis = utilso.min_max_norm_range(depth_variance_ii)
+            depth_variance_color = utilso.depth_tensor_to_color_image(depth_variance_vis)
+            tvtf.to_pil_image(depth_variance_color).save(pjoin(save_depth_variance_path, f'{file_name_ii}.png'))
+
+
+def log_phi_iterations(telemetry):
+    """
+    Log the inner phi iterations of the last sampling against the n_iter budget (early stopping, phi_tol).
+    """
+    budget = telemetry.total('phi_iterations_budget')
+    if budget > 0:
+        iterations = telemetry.total('phi_iterations')
+        logger.log(f"phi iterations: {iterations} of {budget} ({100 * iterations / budget:.1f}% of the n_iter budget)")
+
+
+def log_convergence(convergence, file_names):
+    """
+    Log the early termination of the last sampling - the converged step and the skipped steps per image.
+    """
+    if convergence is None:
+        return
+    summary = convergence.summary(file_names)
+    if summary:
+        logger.log("early termination:\n" + "\n".join(summary))
+    else:
+        logger.log("early termination: not converged, all the steps were sampled")
+
+
+def run_continuous_batching(args, model, loader, device, gt_flag, save_paths, telemetry):
+    """
+    Osmosis sampling of the whole dataset with a pool of in-flight images at different timesteps.
+    """
+    if args.rgb_guidance or args.unet_model['pretrain_model'] != 'osmosis':
+        raise ValueError("Continuous batching is supported only for the osmosis sampling")
+    if args.sample_pattern['pattern'] == "pcgs" and args.sample_pattern['global_N'] > 1:
+        raise ValueError("Continuous batching does not support global_N > 1")
+
+    pool_size = args.continuous_batching['pool_size']
+
+    # a single operator for the whole pool, every slot has its own phi's
+    measure_config = dict(args.sampling_config.operator_params(args.measurement['operator']), batch_size=pool_size)
+    operator = get_operator(device=device, **measure_config)
+    if args.diffusion.get('compile', False):
+        compile_method(operator, "forward")
+    noiser = get_noise(**args.measurement['noise'])
+    cond_method = get_conditioning_method(args.conditioning['method'], operator, noiser,
+                                          **args.sampling_config.conditioning_params(args.conditioning['params']),
+                                          **args.sample_pattern, **args.aux_loss)
+    sampler = create_sampler(**args.diffusion, device=device)
+    scheduler = ContinuousBatchingScheduler(sampler, model, cond_method, args.sample_pattern, pool_size=pool_size,
+                                            seed=args.manual_seed, telemetry=telemetry)
+
+    # the images are admitted one by one from the loader batches
+    def image_stream():
+        for i, (ref_img, ref_img_name) in enumerate(loader):
+
+            # stop the run before getting to the last image
+            if i == args.data['stop_after']:
+                break
+
+            if gt_flag:
+                gt_rgb_img_01 = 0.5 * (ref_img[1] + 1)
+                gt_depth_img_01 = 0.5 * (ref_img[2] + 1)
+                ref_img = ref_img[0]
+
+            for batch_ii in range(ref_img.shape[0]):
+                ref_img_ii = ref_img[batch_ii:batch_ii + 1]
+
+                # add noise to the image and degamma the input image - use it for haze
+                y_n = noiser(ref_img_ii.to(device))
+                if args.degamma_input:
+                    y_n = 2 * torch.pow(0.5 * (y_n + 1), 2.2) - 1
+
+                gt_images = None
+                if gt_flag:
+                    gt_images = (gt_rgb_img_01[batch_ii:batch_ii + 1],
+                                 [utilso.depth_tensor_to_color_image(gt_depth_img_01[batch_ii].squeeze())])
+
+                info = {'ref_img': ref_img_ii, 'name': ref_img_name[batch_ii], 'gt_images': gt_images,
+                        'start_time': datetime.datetime.now()}
+                yield y_n[0], info
+
+    for result in scheduler.run(image_stream()):
+        info = result['info']
+        logger.log(f"\nInference image: {info['name']}\n")
+
+        save_osmosis_results(args, result['pred_xstart'].unsqueeze(0),
+                             {key_ii: value_ii.unsqueeze(0) for key_ii, value_ii in result['variables'].items()},
+                             result['loss'][None], info['ref_img'], [os.path.splitext(info['name'])[0]], 0,
+                             save_paths, gt_images=info['gt_images'])
+
+        # the run time of an image includes the waiting for a free slot in the pool
+        logger.log(f"Run time: {datetime.datetime.now() - info['start_time']}")
+
+    log_phi_iterations(telemetry)
+
+
 def main():
     args = utilso.arguments_from_file(CONFIG_FILE)
     args.image_size = args.unet_model['image_size']
     args.unet_model['model_path'] = os.path.abspath(args.unet_model['model_path'])
     # print(f"\nArguments from inside main:\n{args}\n")
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device('cpu')
+    # the comma separated strings of the configuration (depth, loss weight, guidance) are parsed and validated once
+    args.sampling_config = SamplingConfig.from_args(args, device)
     # print(args.unet_model)
     # Prepare dataloader
     data_config = args.data
@@ -62,7 +391,9 @@ def main():
     #     image = tvtf.to_pil_image(image)
     #     image.show()
 
-    model = create_model(**args.unet_model)
+    # a pre-cast (fp16/bf16) flat checkpoint keeps its dtype (zero-copy) under the autocast precisions, fp32 casts it
+    checkpoint_dtype = torch.float32 if args.diffusion.get('precision', 'fp32') == 'fp32' else None
+    model = create_model(**args.unet_model, checkpoint_dtype=checkpoint_dtype)
     model = model.to(device)
     model.eval()
     measure_config = args.measurement
@@ -95,6 +426,7 @@ def main():
         os.makedirs(save_depth_mm_path)
     else:
         save_singles_path = None
+        save_input_path, save_rgb_path, save_depth_pmm_color_path, save_depth_mm_path = None, None, None, None
 
     # directory for the results a grid
     if args.save_grids:
@@ -102,6 +434,10 @@ def main():
         os.makedirs(save_grids_path)
     else:
         save_grids_path = None
+
+    save_paths = {'out_path': out_path, 'input': save_input_path, 'rgb': save_rgb_path,
+                  'depth_color': save_depth_pmm_color_path, 'depth_raw': save_depth_mm_path,
+                  'grids': save_grids_path}
     
     #Logging
     logger.configure(dir=out_path)
@@ -111,43 +447,119 @@ def main():
         log_txt_tmp = utilso.log_text(args=args)
         logger.log(log_txt_tmp)
 
+    # per step values of the sampling, flushed from the device every few steps
+    telemetry_config = getattr(args, 'telemetry', None) or {}
+    telemetry = SamplingTelemetry(flush_every=telemetry_config.get('flush_every', 1),
+                                  log_to_logger=telemetry_config.get('log', False))
+
+    # continuous batching - a pool of in-flight images, each one at its own timestep
+    continuous_config = getattr(args, 'continuous_batching', None) or {}
+
+    # activation checkpointing of the unet blocks, planned for the batch of a single unet call
+    checkpoint_config = getattr(args, 'checkpointing', None) or {}
+    if checkpoint_config:
+        if continuous_config.get('enable', False):
+            unet_batch_size = continuous_config.get('pool_size', 4)
+        elif args.sample_pattern.get('parallel_chains', False) and args.sample_pattern['pattern'] == "pcgs":
+            unet_batch_size = data_config['batch_size'] * args.sample_pattern['global_N']
+        else:
+            unet_batch_size = data_config['batch_size']
+        unet_channels = 4 if args.unet_model["pretrain_model"] == 'osmosis' else 3
+        apply_checkpoint_policy(model, sample_shape=(unet_batch_size, unet_channels, args.image_size, args.image_size),
+                                device=device, **checkpoint_config)
+
+    if continuous_config.get('enable', False):
+        # the images of the pool are at different timesteps and are replaced, the cached deep features are not valid
+        if args.unet_model.get('feature_cache_interval', 0) > 1:
+            raise ValueError("The unet feature cache (feature_cache_interval) is not supported with continuous batching")
+        run_continuous_batching(args, model, loader, device, gt_flag, save_paths, telemetry)
+        logger.get_current().close()
+        return
     
+    # sampling noise for the begging of the diffusion model
+    if args.sample_pattern['pattern'] == "original":
+        global_N = 1
+    elif args.sample_pattern['pattern'] == "pcgs":
+        global_N = args.sample_pattern['global_N']
+    else:
+        raise ValueError(f"Unrecognized sample pattern: {args.sample_pattern['pattern']}")
+
+    # parallel chains - the global_N chains of every image are sampled together in one batch,
+    # the chains of an image are consecutive in the batch and have independent noise and phi's
+    parallel_chains = global_N > 1 and args.sample_pattern.get('parallel_chains', False) and \
+                      args.unet_model["pretrain_model"] == 'osmosis' and not args.rgb_guidance
+    num_chains = global_N if parallel_chains else 1
+
+    # the operator, noise, conditioning and sampler are constructed once for the whole run and reset for every batch
+    # prepare operator for noise - phi's per image (and chain) of the batch
+    measure_config['operator']['batch_size'] = data_config['batch_size'] * num_chains
+    operator = get_operator(device=device, **args.sampling_config.operator_params(measure_config['operator']))
+    # the operator forward is compiled with the sampling step (compiled once, reused by the next images)
+    if diffusion_config.get('compile', False):
+        compile_method(operator, "forward")
+    noiser = get_noise(**measure_config['noise'])
+
+    # Prepare conditioning - guidance method
+    cond_method = get_conditioning_method(cond_config['method'], operator, noiser,
+                                          **args.sampling_config.conditioning_params(cond_config['params']),
+                                          **sample_pattern_config, **aux_loss_config)
+    measurement_cond_fn = cond_method.conditioning
+
+    # Load diffusion sampler
+    sampler = create_sampler(**diffusion_config, device=device)
+    sampler.check_precision(sample_pattern_config)
+
+    # sequence mode - the images are consecutive video frames, every batch starts from the previous batch results
+    sequence_config = getattr(args, 'sequence', None) or {}
+    sequence_mode = sequence_config.get('enable', False)
+    if sequence_mode and (args.rgb_guidance or args.unet_model['pretrain_model'] != 'osmosis' or global_N > 1 or
+                          continuous_config.get('enable', False)):
+        raise ValueError("The sequence mode is supported only for the osmosis sampling with global_N = 1 "
+                         "(without continuous batching)")
+    # the final phi's and x0 prediction of the last image of the previous batch
+    previous_frame = None
+
+    # partial (SDEdit like) sampling from an initial RGBD guess
+    guess_config = getattr(args, 'initial_guess', None) or {}
+
+    # adaptive early termination when the x0 prediction (and the phi's) converged
+    termination_config = getattr(args, 'early_termination', None) or {}
+    convergence = ConvergenceMonitor(**termination_config) if termination_config.get('enable', False) else None
+
     for i, (ref_img, ref_img_name) in enumerate(loader):
         # in case there is a GT image (if ground truth is used)
         if gt_flag:
-            gt_rgb_img = ref_img[1].squeeze()
+            gt_rgb_img = ref_img[1]
             gt_rgb_img_01 = 0.5 * (gt_rgb_img + 1)
 
-            gt_depth_img = ref_img[2].squeeze()
+            gt_depth_img = ref_img[2]
             gt_depth_img_01 = 0.5 * (gt_depth_img + 1)
-            gt_depth_img_01 = utilso.depth_tensor_to_color_image(gt_depth_img_01)
+            gt_depth_img_01 = [utilso.depth_tensor_to_color_image(gt_depth_ii.squeeze())
+                               for gt_depth_ii in gt_depth_img_01]
 
             ref_img = ref_img[0]
 
         start_run_time_ii = datetime.datetime.now()
 
-        # prepare reference image for visualization
-        ref_img_01 = 0.5 * (ref_img.detach().cpu()[0] + 1)
-        ref_img_name = ref_img_name[0]
-        orig_file_name = os.path.splitext(ref_img_name)[0]
+        # prepare reference images for visualization - the whole batch is sampled together
+        batch_size = ref_img.shape[0]
+        ref_imgs_01 = 0.5 * (ref_img.detach().cpu() + 1)
+        orig_file_names = [os.path.splitext(ref_img_name_ii)[0] for ref_img_name_ii in ref_img_name]
+        ref_img_name = ", ".join(ref_img_name)
 
         # stop the run before getting to the last image
         if i == args.data['stop_after']:
             break
         
-        # prepare operator for noise 
-        measure_config['operator']['batch_size'] = args.data['batch_size']
-        operator = get_operator(device=device, **measure_config['operator'])
-        noiser = get_noise(**measure_config['noise'])
+        chains_file_names = [f"{file_name_ii}_g{chain_ii}" if parallel_chains else file_name_ii
+                             for file_name_ii in orig_file_names for chain_ii in range(num_chains)]
 
+        # a fresh start of the persistent operator - the configured phi's (or the previous frame phi's in the sequence
+        # mode) and no optimizer state for every image and chain of the batch (the last batch may be smaller)
+        warm_start = sequence_mode and previous_frame is not None
+        init_phi = previous_frame['phi'] if warm_start and sequence_config.get('warm_start_phi', True) else None
+        cond_method.reset(batch_size=batch_size * num_chains, init_phi=init_phi)
 
-        # Prepare conditioning - guidance method
-        cond_method = get_conditioning_method(cond_config['method'], operator, noiser, **cond_config['params'],
-                                              **sample_pattern_config, **aux_loss_config)
-        measurement_cond_fn = cond_method.conditioning
-
-        # Load diffusion sampler and pass the required arguments
-        sampler = create_sampler(**diffusion_config)
         # passing the "stable" arguments with the partial method
         sample_fn = partial(sampler.p_sample_loop, model=model, measurement_cond_fn=measurement_cond_fn,
                             pretrain_model=args.unet_model['pretrain_model'], rgb_guidance=args.rgb_guidance,
@@ -155,8 +567,10 @@ def main():
                             record=args.record_process,
                             save_root=out_path, image_idx=i,
                             record_every=args.record_every,
-                            original_file_name=orig_file_name,
-                            save_grids_path=save_grids_path)
+                            original_file_name=chains_file_names,
+                            save_grids_path=save_grids_path,
+                            telemetry=telemetry,
+                            convergence=convergence)
         
         logger.log(f"\nInference image {i}: {ref_img_name}\n")
         ref_img = ref_img.to(device)
@@ -169,27 +583,40 @@ def main():
             y_n_tmp = 0.5 * (y_n + 1)
             y_n = 2 * torch.pow(y_n_tmp, 2.2) - 1
 
+        # every chain guided by the same measurement
+        if parallel_chains:
+            y_n = y_n.repeat_interleave(num_chains, dim=0)
+
         # Sampling
-        x_start_shape = list(ref_img.shape)
+        x_start_shape = list(y_n.shape)
         # in case of sampling for osmosis the input model channel is 4 (RGBD)
         x_start_shape[1] = 4 if (args.unet_model["pretrain_model"] == 'osmosis') else x_start_shape[1]
 
-        # sampling noise for the begging of the diffusion model
-        if args.sample_pattern['pattern'] == "original":
-            global_N = 1
-        elif args.sample_pattern['pattern'] == "pcgs":
-            global_N = args.sample_pattern['global_N']
-        else:
-            raise ValueError(f"Unrecognized sample pattern: {args.sample_pattern['pattern']}")
-
-        # loop according the value of global N (from gibbsDDRM)
-        for global_ii in range(global_N):
+        # loop according the value of global N (from gibbsDDRM), a single loop for parallel chains
+        for global_ii in range(1 if parallel_chains else global_N):
 
             logger.log(f"global iteration: {global_ii}\n")
             torch.manual_seed(args.manual_seed)
 
-            # the x_T - Gaussian Noise
-            x_start = torch.randn(x_start_shape, device=device).requires_grad_()
+            # the x_T - Gaussian Noise, or in the sequence mode the previous frame result noised to start_t,
+            # or the initial RGBD guess (the measurement and a depth prior) noised to start_t
+            start_t = sequence_config.get('start_t', 1)
+            if warm_start and start_t < 1:
+                x_0_previous = previous_frame['x0'].to(device).repeat(x_start_shape[0], 1, 1, 1)
+                x_start, start_steps = sampler.q_sample_start(x_0_previous, start_t)
+                x_start = x_start.requires_grad_()
+                logger.log(f"sequence: starting from the previous frame, {start_steps} of {sampler.num_timesteps} steps")
+            elif guess_config.get('start_t', 1) < 1 and args.unet_model["pretrain_model"] == 'osmosis' and \
+                    not args.rgb_guidance:
+                x_0_guess = utilso.initial_rgbd_guess(y_n, prior=guess_config.get('depth_prior', 'constant'),
+                                                      patch_size=guess_config.get('patch_size', 15))
+                x_start, start_steps = sampler.q_sample_start(x_0_guess, guess_config['start_t'])
+                x_start = x_start.requires_grad_()
+                logger.log(f"initial guess: starting from the measurement ({guess_config.get('depth_prior')} depth), "
+                           f"{start_steps} of {sampler.num_timesteps} steps")
+            else:
+                x_start = torch.randn(x_start_shape, device=device).requires_grad_()
+                start_steps = None
 
             # this is the osmosis project additional code
             if args.unet_model["pretrain_model"] == 'osmosis' and not args.rgb_guidance:
@@ -197,158 +624,24 @@ def main():
                 # sampling function which adapted to osmosis project
 
                 sample, variable_dict, loss, out_xstart = sample_fn(x_start=x_start, measurement=y_n,
-                                                                    global_iteration=global_ii)
-
-                # output from the network without guidance - split into rgb and depth image
-                sample_rgb = out_xstart[0, 0:-1, :, :]
-                sample_depth_tmp = out_xstart[0, -1, :, :].unsqueeze(0)
-                sample_depth_tmp_rep = sample_depth_tmp.repeat(3, 1, 1)
-
-                # "move" the rgb predicted image to start from 0
-                sample_rgb_01 = 0.5 * (sample_rgb + 1)
-                sample_rgb_01_clip = torch.clamp(sample_rgb_01, min=0, max=1)
-
-                # "move" the depth predicted image to start from 0
-                sample_depth_mm = utilso.min_max_norm_range(sample_depth_tmp[0].unsqueeze(0))
-                sample_depth_vis_pmm = utilso.min_max_norm_range_percentile(sample_depth_tmp,
-                                                                            vmin=0, vmax=1,
-                                                                            percent_low=0.03,
-                                                                            percent_high=0.99,
-                                                                            is_uint8=False)
-                sample_depth_vis_pmm_color = utilso.depth_tensor_to_color_image(sample_depth_vis_pmm)
-
-                # depth for calculations
-                sample_depth_calc = utilso.convert_depth(sample_depth_tmp_rep,
-                                                         depth_type=args.measurement['operator']['depth_type'],
-                                                         value=args.measurement['operator']['value'])
-
-                # phi inf image - relevant for both underwater and haze
-                phi_inf = variable_dict['phi_inf'].cpu().squeeze(0)
-                phi_inf_image = phi_inf * torch.ones_like(sample_rgb, device=torch.device('cpu'))
-
-                # underwater model
-                if 'underwater_physical_revised' in args.measurement['operator']['name']:
-
-                    # create the ingredients for the underwater image
-                    phi_a = variable_dict['phi_a'].cpu().squeeze(0)
-                    phi_a_image = phi_a * torch.ones_like(sample_rgb, device=torch.device('cpu'))
-                    phi_b = variable_dict['phi_b'].cpu().squeeze(0)
-                    phi_b_image = phi_b * torch.ones_like(sample_rgb, device=torch.device('cpu'))
-
-                    # calculate the underwater parts
-                    backscatter_image = phi_inf_image * (1 - torch.exp(-phi_b_image * sample_depth_calc))
-                    attenuation_image = torch.exp(-phi_a_image * sample_depth_calc)
-                    forward_predicted_image = sample_rgb_01 * attenuation_image + backscatter_image
-
-                    # calculate norm lost for visualization - degraded_images and ref_img values should be [-1,1]
-                    degraded_image = 2 * forward_predicted_image - 1
-                    norm_loss_final = np.round([torch.linalg.norm(
-                        degraded_image - ref_img.detach().cpu()).numpy()], decimals=3)
-
-                    # calculate the "clean" image from the predicted phi's and ref image
-                    attenuation_flip_image = torch.exp(phi_a_image * sample_depth_calc)
-                    sample_rgb_recon = attenuation_flip_image * (ref_img_01 - backscatter_image)
-
-                    # logging values of phi's
-                    print_phi_a = [np.round(i, decimals=3) for i in phi_a.cpu().squeeze().tolist()]
-                    print_phi_b = [np.round(i, decimals=3) for i in phi_b.cpu().squeeze().tolist()]
-                    print_phi_inf = [np.round(i, decimals=3) for i in phi_inf.cpu().squeeze().tolist()]
-
-                    log_value_txt = f"\nInitialized values: " \
-                                    f"\nphi_a: [{measure_config['operator']['phi_a']}], lr: {measure_config['operator']['phi_a_eta']}" \
-                                    f"\nphi_b: [{measure_config['operator']['phi_b']}], lr: {measure_config['operator']['phi_b_eta']}" \
-                                    f"\nphi_inf: [{measure_config['operator']['phi_inf']}], lr: {measure_config['operator']['phi_inf_eta']}" \
-                                    f"\n\nResults values: " \
-                                    f"\nphi_a: {print_phi_a}" \
-                                    f"\nphi_b: {print_phi_b}" \
-                                    f"\nphi_inf: {print_phi_inf}" \
-                                    f"\n\nNorm loss: {norm_loss_final}" \
-                                    f"\nFinal loss: {np.round(np.array(loss), decimals=3)}"
-
-                    # log results for parameters
-                    logger.log(log_value_txt)
-
-                # haze model
-                elif ('haze' in args.measurement['operator']['name']) or (
-                        'underwater_physical' in args.measurement['operator']['name']):
-
-                    # create the ingredients for the hazed image
-                    phi_ab = variable_dict['phi_ab'].cpu().squeeze(0)
-                    phi_ab_image = phi_ab * torch.ones_like(sample_rgb, device=torch.device('cpu'))
-                    backscatter_image = phi_inf_image * (1 - torch.exp(-phi_ab_image * sample_depth_calc))
-                    attenuation_image = torch.exp(-phi_ab_image * sample_depth_calc)
-                    forward_predicted_image = sample_rgb_01 * attenuation_image + backscatter_image
-
-                    # calculate the "clean" image from the predicted phis, phi_inf and ref image
-                    attenuation_flip_image = torch.exp(phi_ab_image * sample_depth_calc)
-                    sample_rgb_recon = attenuation_flip_image * (ref_img_01 - backscatter_image)
-
-                    # calculate norm lost for visualization - both degraded_images and ref_img values should be [-1,1]
-                    degraded_image = 2 * forward_predicted_image - 1
-                    norm_loss_final = np.round(
-                        [torch.linalg.norm(degraded_image.cpu() - ref_img.detach().cpu()).numpy()],
-                        decimals=3)
-
-                    # logging values of phi and phi_inf
-                    print_phi_ab = np.round(phi_ab.cpu().squeeze(), decimals=3)
-                    print_phi_inf = np.round(phi_inf.cpu().squeeze(), decimals=3)
-                    log_value_txt = f"\nInitialized values: " \
-                                    f"\nphi_ab: [{measure_config['operator']['phi_ab']}], lr: {measure_config['operator']['phi_ab_eta']}" \
-                                    f"\nphi_inf: [{measure_config['operator']['phi_inf']}], lr: {measure_config['operator']['phi_inf_eta']}" \
-                                    f"\n\nResults values: " \
-                                    f"\nphi_ab: {print_phi_ab}" \
-                                    f"\nphi_inf: {print_phi_inf}" \
-                                    f"\n\nNorm loss: {norm_loss_final}" \
-                                    f"\nFinal loss: {np.round(np.array(loss), decimals=5)}"
-
-                    # log results for parameters
-                    logger.log(log_value_txt)
-
+                                                                    global_iteration=global_ii,
+                                                                    start_steps=start_steps)
+                log_phi_iterations(telemetry)
+                log_convergence(convergence, chains_file_names)
+
+                # the next frame starts from the last image of the batch
+                if sequence_mode and variable_dict is not None:
+                    previous_frame = {'phi': {key_ii: value_ii[-1:].detach().clone()
+                                              for key_ii, value_ii in variable_dict.items()},
+                                      'x0': out_xstart[-1:]}
+
+                if parallel_chains:
+                    save_osmosis_chains(args, out_xstart, variable_dict, loss, ref_img, orig_file_names, num_chains,
+                                        save_paths, gt_images=(gt_rgb_img_01, gt_depth_img_01) if gt_flag else None)
                 else:
-                    raise NotImplementedError("Operator can be for 'underwater' or 'haze' ")
-
-                # saving single images (reference (input), rgb (restored image), depth (depth estimation))
-                if args.save_singles:
-                    # input - reference image
-                    ref_im_pil = tvtf.to_pil_image(ref_img_01)
-                    # ref_im_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_ref.png'))
-                    ref_im_pil.save(pjoin(save_input_path, f'{orig_file_name}.png'))
-
-                    # rgb clip - sample_rgb_01_clip
-                    sample_rgb_01_clip_pil = tvtf.to_pil_image(sample_rgb_01_clip)
-                    # sample_rgb_01_clip_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_rgb.png'))
-                    sample_rgb_01_clip_pil.save(pjoin(save_rgb_path, f'{orig_file_name}.png'))
-
-                    # depth percentile min-max - sample_depth_vis_percentile_norm
-                    sample_depth_vis_pmm_color_pil = tvtf.to_pil_image(sample_depth_vis_pmm_color)
-                    # sample_depth_vis_pmm_color_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_depth.png'))
-                    sample_depth_vis_pmm_color_pil.save(pjoin(save_depth_pmm_color_path, f'{orig_file_name}.png'))
-
-                    # depth percentile min-max - sample_depth_vis_percentile_norm
-                    sample_depth_vis_mm_pil = tvtf.to_pil_image(sample_depth_mm)
-                    # sample_depth_vis_mm_pil.save(pjoin(save_singles_path, f'{orig_file_name}_g{global_ii}_depth_raw.png'))
-                    sample_depth_vis_mm_pil.save(pjoin(save_depth_mm_path, f'{orig_file_name}.png'))
-
-                # save extended results in the grid
-                if args.save_grids:
-
-                    grid_list = [ref_img_01, sample_rgb_01_clip, sample_depth_vis_pmm_color]
-
-                    # there is ground truth in the case of simulation
-                    if gt_flag:
-                        grid_list += [torch.zeros_like(sample_rgb_01, device=torch.device('cpu')),
-                                      gt_rgb_img_01, gt_depth_img_01]
-
-                    results_grid = make_grid(grid_list, nrow=3, pad_value=1.)
-                    results_grid = utilso.clip_image(results_grid, scale=False, move=False, is_uint8=True) \
-                        .permute(1, 2, 0).numpy()
-                    results_pil = Image.fromarray(results_grid, mode="RGB")
-
-                    # save the image
-                    results_pil.save(pjoin(save_grids_path, f'{orig_file_name}_g{global_ii}_grid.png'))
-
-                if args.save_singles or args.save_grids:
-                    logger.log(f"result images was saved into: {out_path}")
+                    save_osmosis_results(args, out_xstart, variable_dict, loss, ref_img, orig_file_names, global_ii,
+                                         save_paths,
+                                         gt_images=(gt_rgb_img_01, gt_depth_img_01) if gt_flag else None)
 
                 logger.log(f"Run time: {datetime.datetime.now() - start_run_time_ii}")
 
@@ -356,47 +649,53 @@ def main():
             else:
 
                 sample = sample_fn(x_start=x_start, measurement=y_n)
+                log_convergence(convergence, orig_file_names)
+
+                for batch_ii in range(batch_size):
+
+                    orig_file_name = orig_file_names[batch_ii]
+                    ref_img_01 = ref_imgs_01[batch_ii]
 
-                # split into rgb and depth image - not handling results save for a batch of images
-                sample_rgb = sample.cpu()[0, 0:-1, :, :]
-                sample_depth_tmp = sample.cpu()[0, -1, :, :].repeat(3, 1, 1)
+                    # split into rgb and depth image
+                    sample_rgb = sample.cpu()[batch_ii, 0:-1, :, :]
+                    sample_depth_tmp = sample.cpu()[batch_ii, -1, :, :].repeat(3, 1, 1)
 
-                # "move" the rgb predicted image to start from 0 (the values "sample_rgb" should be between [-1, 1])
-                sample_rgb_01 = 0.5 * (sample_rgb + 1)
-                sample_rgb_01_clip = torch.clamp(sample_rgb_01, 0., 1.)
+                    # "move" the rgb predicted image to start from 0 (the values "sample_rgb" should be between [-1, 1])
+                    sample_rgb_01 = 0.5 * (sample_rgb + 1)
+                    sample_rgb_01_clip = torch.clamp(sample_rgb_01, 0., 1.)
 
-                # used for visualization
-                sample_depth_mm = utilso.min_max_norm_range(sample_depth_tmp, vmin=0, vmax=1, is_uint8=False)
-                sample_depth_vis_pmm = utilso.min_max_norm_range_percentile(sample_depth_tmp,
-                                                                            percent_low=0.05, percent_high=0.99)
-                sample_depth_vis_pmm_color = utilso.depth_tensor_to_color_image(sample_depth_vis_pmm)
+                    # used for visualization
+                    sample_depth_mm = utilso.min_max_norm_range(sample_depth_tmp, vmin=0, vmax=1, is_uint8=False)
+                    sample_depth_vis_pmm = utilso.min_max_norm_range_percentile(sample_depth_tmp,
+                                                                                percent_low=0.05, percent_high=0.99)
+                    sample_depth_vis_pmm_color = utilso.depth_tensor_to_color_image(sample_depth_vis_pmm)
 
-                # saving seperated images
-                if args.save_singles:
-                    ref_im_pil = tvtf.to_pil_image(ref_img_01)
-                    ref_im_pil.save(pjoin(save_input_path, f'{orig_file_name}.png'))
+                    # saving seperated images
+                    if args.save_singles:
+                        ref_im_pil = tvtf.to_pil_image(ref_img_01)
+                        ref_im_pil.save(pjoin(save_input_path, f'{orig_file_name}.png'))
 
-                    sample_rgb_pil = tvtf.to_pil_image(sample_rgb_01_clip)
-                    sample_rgb_pil.save(pjoin(save_rgb_path, f'{orig_file_name}.png'))
+                        sample_rgb_pil = tvtf.to_pil_image(sample_rgb_01_clip)
+                        sample_rgb_pil.save(pjoin(save_rgb_path, f'{orig_file_name}.png'))
 
-                    sample_depth_vis_pil = tvtf.to_pil_image(sample_depth_vis_pmm_color)
-                    sample_depth_vis_pil.save(pjoin(save_depth_pmm_color_path, f'{orig_file_name}.png'))
+                        sample_depth_vis_pil = tvtf.to_pil_image(sample_depth_vis_pmm_color)
+                        sample_depth_vis_pil.save(pjoin(save_depth_pmm_color_path, f'{orig_file_name}.png'))
 
-                    sample_depth_mm_pil = tvtf.to_pil_image(sample_depth_mm)
-                    sample_depth_mm_pil.save(pjoin(save_depth_mm_path, f'{orig_file_name}.png'))
+                        sample_depth_mm_pil = tvtf.to_pil_image(sample_depth_mm)
+                        sample_depth_mm_pil.save(pjoin(save_depth_mm_path, f'{orig_file_name}.png'))
 
-                # create images grid
-                if args.save_grids:
-                    grid_list = [ref_img_01, sample_rgb_01_clip, sample_depth_vis_pmm_color]
-                    results_grid = make_grid(grid_list, nrow=3, pad_value=1.)
-                    results_grid = utilso.clip_image(results_grid, scale=False, move=False, is_uint8=True)
-                    results_pil = tvtf.to_pil_image(results_grid)
+                    # create images grid
+                    if args.save_grids:
+                        grid_list = [ref_img_01, sample_rgb_01_clip, sample_depth_vis_pmm_color]
+                        results_grid = make_grid(grid_list, nrow=3, pad_value=1.)
+                        results_grid = utilso.clip_image(results_grid, scale=False, move=False, is_uint8=True)
+                        results_pil = tvtf.to_pil_image(results_grid)
 
-                    # save the image
-                    results_pil.save(pjoin(save_grids_path, f'{orig_file_name}.png'))
+                        # save the image
+                        results_pil.save(pjoin(save_grids_path, f'{orig_file_name}.png'))
 
-                if args.save_singles or args.save_grids:
-                    logger.log(f"result images was saved into: {out_path}")
+                    if args.save_singles or args.save_grids:
+                        logger.log(f"result images was saved into: {out_path}")
 
                 logger.log(f"Run time: {datetime.datetime.now() - start_run_time_ii}")
 
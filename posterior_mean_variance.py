@@ -4,6 +4,7 @@ import numpy as np
 import torch
 
 from img_utils import dynamic_thresholding
+from schedule_tables import ScheduleTables
 
 # ====================
 # Model Mean Processor
@@ -32,9 +33,11 @@ class MeanProcessor(ABC):
     """Predict x_start and calculate mean value"""
 
     @abstractmethod
-    def __init__(self, betas, dynamic_threshold, clip_denoised):
+    def __init__(self, betas, dynamic_threshold, clip_denoised, tables=None):
         self.dynamic_threshold = dynamic_threshold
         self.clip_denoised = clip_denoised
+        # device-resident schedule coefficients, shared with the diffusion object when given
+        self.tables = tables if tables is not None else ScheduleTables(betas)
 
     @abstractmethod
     def get_mean_and_xstart(self, x, t, model_output):
@@ -52,18 +55,12 @@ class MeanProcessor(ABC):
 
 @register_mean_processor(name='previous_x')
 class PreviousXMeanProcessor(MeanProcessor):
-    def __init__(self, betas, dynamic_threshold, clip_denoised):
-        super().__init__(betas, dynamic_threshold, clip_denoised)
-        alphas = 1.0 - betas
-        alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
-
-        self.posterior_mean_coef1 = betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod)
-        self.posterior_mean_coef2 = (1.0 - alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - alphas_cumprod)
+    def __init__(self, betas, dynamic_threshold, clip_denoised, tables=None):
+        super().__init__(betas, dynamic_threshold, clip_denoised, tables)
 
     def predict_xstart(self, x_t, t, x_prev):
-        coef1 = extract_and_expand(1.0 / self.posterior_mean_coef1, t, x_t)
-        coef2 = extract_and_expand(self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t)
+        coef1 = self.tables.extract('recip_posterior_mean_coef1', t, x_t)
+        coef2 = self.tables.extract('posterior_mean_coef2_over_coef1', t, x_t)
         return coef1 * x_prev - coef2 * x_t
 
     def get_mean_and_xstart(self, x, t, model_output):
@@ -74,14 +71,8 @@ class PreviousXMeanProcessor(MeanProcessor):
 
 @register_mean_processor(name='start_x')
 class StartXMeanProcessor(MeanProcessor):
-    def __init__(self, betas, dynamic_threshold, clip_denoised):
-        super().__init__(betas, dynamic_threshold, clip_denoised)
-        alphas = 1.0 - betas
-        alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
-
-        self.posterior_mean_coef1 = betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod)
-        self.posterior_mean_coef2 = (1.0 - alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - alphas_cumprod)
+    def __init__(self, betas, dynamic_threshold, clip_denoised, tables=None):
+        super().__init__(betas, dynamic_threshold, clip_denoised, tables)
 
     def q_posterior_mean(self, x_start, x_t, t):
         """
@@ -89,8 +80,8 @@ class StartXMeanProcessor(MeanProcessor):
             q(x_{t-1} | x_t, x_0)
         """
         assert x_start.shape == x_t.shape
-        coef1 = extract_and_expand(self.posterior_mean_coef1, t, x_start)
-        coef2 = extract_and_expand(self.posterior_mean_coef2, t, x_t)
+        coef1 = self.tables.extract('posterior_mean_coef1', t, x_start)
+        coef2 = self.tables.extract('posterior_mean_coef2', t, x_t)
 
         return coef1 * x_start + coef2 * x_t
 
@@ -103,16 +94,8 @@ class StartXMeanProcessor(MeanProcessor):
 
 @register_mean_processor(name='epsilon')
 class EpsilonXMeanProcessor(MeanProcessor):
-    def __init__(self, betas, dynamic_threshold, clip_denoised):
-        super().__init__(betas, dynamic_threshold, clip_denoised)
-        alphas = 1.0 - betas
-        alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
-
-        self.sqrt_recip_alphas_cumprod = np.sqrt(1.0 / alphas_cumprod)
-        self.sqrt_recipm1_alphas_cumprod = np.sqrt(1.0 / alphas_cumprod - 1)
-        self.posterior_mean_coef1 = betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod)
-        self.posterior_mean_coef2 = (1.0 - alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - alphas_cumprod)
+    def __init__(self, betas, dynamic_threshold, clip_denoised, tables=None):
+        super().__init__(betas, dynamic_threshold, clip_denoised, tables)
 
     def q_posterior_mean(self, x_start, x_t, t):
         """
@@ -120,13 +103,13 @@ class EpsilonXMeanProcessor(MeanProcessor):
             q(x_{t-1} | x_t, x_0)
         """
         assert x_start.shape == x_t.shape
-        coef1 = extract_and_expand(self.posterior_mean_coef1, t, x_start)
-        coef2 = extract_and_expand(self.posterior_mean_coef2, t, x_t)
+        coef1 = self.tables.extract('posterior_mean_coef1', t, x_start)
+        coef2 = self.tables.extract('posterior_mean_coef2', t, x_t)
         return coef1 * x_start + coef2 * x_t
 
     def predict_xstart(self, x_t, t, eps):
-        coef1 = extract_and_expand(self.sqrt_recip_alphas_cumprod, t, x_t)
-        coef2 = extract_and_expand(self.sqrt_recipm1_alphas_cumprod, t, eps)
+        coef1 = self.tables.extract('sqrt_recip_alphas_cumprod', t, x_t)
+        coef2 = self.tables.extract('sqrt_recipm1_alphas_cumprod', t, eps)
         return coef1 * x_t - coef2 * eps
 
     def get_mean_and_xstart(self, x, t, model_output):
@@ -161,8 +144,9 @@ def get_var_processor(name: str, **kwargs):
 
 class VarianceProcessor(ABC):
     @abstractmethod
-    def __init__(self, betas):
-        pass
+    def __init__(self, betas, tables=None):
+        # device-resident schedule coefficients, shared with the diffusion object when given
+        self.tables = tables if tables is not None else ScheduleTables(betas)
 
     @abstractmethod
     def get_variance(self, x, t):
@@ -171,51 +155,31 @@ class VarianceProcessor(ABC):
 
 @register_var_processor(name='fixed_small')
 class FixedSmallVarianceProcessor(VarianceProcessor):
-    def __init__(self, betas):
-        alphas = 1.0 - betas
-        alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        self.posterior_variance = (
-                betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
-        )
+    def __init__(self, betas, tables=None):
+        super().__init__(betas, tables)
 
     def get_variance(self, x, t):
-        model_variance = self.posterior_variance
-        model_log_variance = np.log(model_variance)
-
-        model_variance = extract_and_expand(model_variance, t, x)
-        model_log_variance = extract_and_expand(model_log_variance, t, x)
+        model_variance = self.tables.extract('posterior_variance', t, x)
+        model_log_variance = self.tables.extract('log_posterior_variance', t, x)
 
         return model_variance, model_log_variance
 
 
 @register_var_processor(name='fixed_large')
 class FixedLargeVarianceProcessor(VarianceProcessor):
-    def __init__(self, betas):
-        self.betas = betas
-
-        alphas = 1.0 - betas
-        alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        self.posterior_variance = (
-                betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
-        )
+    def __init__(self, betas, tables=None):
+        super().__init__(betas, tables)
 
     def get_variance(self, x, t):
-        model_variance = np.append(self.posterior_variance[1], self.betas[1:])
-        model_log_variance = np.log(model_variance)
-
-        model_variance = extract_and_expand(model_variance, t, x)
-        model_log_variance = extract_and_expand(model_log_variance, t, x)
+        model_variance = self.tables.extract('fixed_large_variance', t, x)
+        model_log_variance = self.tables.extract('log_fixed_large_variance', t, x)
 
         return model_variance, model_log_variance
 
 
 @register_var_processor(name='learned')
 class LearnedVarianceProcessor(VarianceProcessor):
-    def __init__(self, betas):
+    def __init__(self, betas, tables=None):
         pass
 
     def get_variance(self, x, t):
@@ -226,30 +190,13 @@ class LearnedVarianceProcessor(VarianceProcessor):
 
 @register_var_processor(name='learned_range')
 class LearnedRangeVarianceProcessor(VarianceProcessor):
-    def __init__(self, betas):
-        self.betas = betas
-
-        alphas = 1.0 - betas
-        alphas_cumprod = np.cumprod(alphas, axis=0)
-        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
-
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        posterior_variance = (
-                betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
-        )
-        # log calculation clipped because the posterior variance is 0 at the
-        # beginning of the diffusion chain.
-        self.posterior_log_variance_clipped = np.log(
-            np.append(posterior_variance[1], posterior_variance[1:])
-        )
+    def __init__(self, betas, tables=None):
+        super().__init__(betas, tables)
 
     def get_variance(self, x, t):
         model_var_values = x
-        min_log = self.posterior_log_variance_clipped
-        max_log = np.log(self.betas)
-
-        min_log = extract_and_expand(min_log, t, x)
-        max_log = extract_and_expand(max_log, t, x)
+        min_log = self.tables.extract('posterior_log_variance_clipped', t, x)
+        max_log = self.tables.extract('log_betas', t, x)
 
         # The model_var_values is [-1, 1] for [min_var, max_var]
         frac = (model_var_values + 1.0) / 2.0
@@ -0,0 +1,173 @@
+"""
+Weight-only int8 quantization of the unet for cpu inference - the weights are kept as int8 with a float scale per
+output channel. The layers stay differentiable with respect to their input (the guidance backward), the backward
+uses the dequantized weights.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import logger
+
+QUANTIZE_MODES = ('none', 'int8')
+QUANTIZE_LAYERS = ('attention', 'time_embed', 'resblock')
+
+# the reasons the int8 kernel fell back to the dequantized matmul, the first one is logged (once per process)
+__FALLBACKS__ = []
+
+
+def log_fallback(reason):
+    if not __FALLBACKS__:
+        logger.log(f"int8 matmul kernel unavailable, the weights are dequantized for every call: {reason}")
+    __FALLBACKS__.append(reason)
+
+
+def quantize_weight(weight):
+    """
+    Symmetric per output channel (the first dimension) int8 quantization.
+
+    :return: the int8 weight and the float32 scale of every output channel.
+    """
+    weight = weight.detach().float()
+    scale = weight.flatten(1).abs().amax(dim=1).clamp(min=1e-12) / 127
+    qweight = torch.round(weight / scale.view(-1, *([1] * (weight.ndim - 1)))).clamp_(-127, 127)
+    return qweight.to(torch.int8), scale
+
+
+class _Int8MatMul(torch.autograd.Function):
+    """
+    x @ (qweight * scale)^T with the int8 kernel of torch (_weight_int8pack_mm), the input gradient with the
+    dequantized weight (the weights have no gradient).
+    """
+
+    @staticmethod
+    def forward(ctx, x, qweight, scale):
+        ctx.save_for_backward(qweight, scale)
+        return torch._weight_int8pack_mm(x, qweight, scale.to(x.dtype))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        qweight, scale = ctx.saved_tensors
+        weight = qweight.to(grad_output.dtype) * scale.to(grad_output.dtype)[:, None]
+        return grad_output @ weight, None, None
+
+
+class Int8Linear(nn.Module):
+    """
+    A weight-only int8 linear layer (also a 1x1 Conv1d - channels first input).
+
+    The int8 matmul kernel is used on the cpu when it supports the layer (checked once), otherwise the weight is
+    dequantized for every call (logged once).
+    """
+
+    def __init__(self, weight, bias=None, channels_first=False):
+        super().__init__()
+        qweight, scale = quantize_weight(weight.flatten(1))
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scale", scale)
+        self.register_buffer("bias", None if bias is None else bias.detach().float().clone())
+        self.channels_first = channels_first
+        self.int8_kernel = self.probe_int8_kernel()
+
+    @classmethod
+    def from_float(cls, module):
+        return cls(module.weight, module.bias, channels_first=isinstance(module, nn.Conv1d))
+
+    def probe_int8_kernel(self):
+        # a private torch operator - it may be missing or not support the shape
+        if not hasattr(torch, "_weight_int8pack_mm"):
+            log_fallback(f"torch {torch.__version__} has no _weight_int8pack_mm")
+            return False
+        try:
+            torch._weight_int8pack_mm(torch.zeros(1, self.qweight.shape[1]), self.qweight.cpu(), self.scale.cpu())
+            return True
+        except RuntimeError as error:
+            log_fallback(f"{type(error).__name__}: {error}")
+            return False
+
+    def dequantize(self, dtype):
+        return self.qweight.to(dtype) * self.scale.to(dtype)[:, None]
+
+    def forward(self, x):
+        # a 1x1 Conv1d - [N x C x T] as [N * T x C] rows
+        if self.channels_first:
+            n, _, t = x.shape
+            x = x.transpose(1, 2).reshape(n * t, -1)
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+
+        if self.int8_kernel and x.device.type == 'cpu' and x.dtype in (torch.float32, torch.bfloat16, torch.float16):
+            out = _Int8MatMul.apply(x.contiguous(), self.qweight, self.scale)
+        else:
+            out = x @ self.dequantize(x.dtype).t()
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+
+        out = out.reshape(*shape[:-1], -1)
+        if self.channels_first:
+            out = out.reshape(n, t, -1).transpose(1, 2)
+        return out
+
+
+class Int8Conv2d(nn.Module):
+    """
+    A weight-only int8 convolution - the weight is dequantized for every call (there is no differentiable int8
+    convolution kernel), it saves the weight memory and bandwidth.
+    """
+
+    def __init__(self, module):
+        super().__init__()
+        qweight, scale = quantize_weight(module.weight)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scale", scale)
+        self.register_buffer("bias", None if module.bias is None else module.bias.detach().float().clone())
+        self.stride, self.padding, self.dilation, self.groups = \
+            module.stride, module.padding, module.dilation, module.groups
+
+    def forward(self, x):
+        weight = self.qweight.to(x.dtype) * self.scale.to(x.dtype).view(-1, 1, 1, 1)
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.conv2d(x, weight, bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+def quantize_unet(model, layers=QUANTIZE_LAYERS):
+    """
+    Replace the layers of a unet by weight-only int8 layers (in place).
+
+    :param layers: attention - the 1x1 Conv1d qkv and proj_out of the attention blocks, time_embed - the linear
+                   layers of the time embedding (time_embed and the emb_layers of every ResBlock), resblock - the
+                   3x3 convolutions of the ResBlocks.
+    :return: the model and the number of quantized layers.
+    """
+    from unet import AttentionBlock, ResBlock
+
+    unknown = set(layers) - set(QUANTIZE_LAYERS)
+    if unknown:
+        raise ValueError(f"Unknown quantization layers {sorted(unknown)}, use one of {list(QUANTIZE_LAYERS)}")
+
+    def quantize(parent, name, module):
+        if isinstance(module, (nn.Linear, nn.Conv1d)) and (not isinstance(module, nn.Conv1d) or
+                                                           module.kernel_size == (1,)):
+            setattr(parent, name, Int8Linear.from_float(module))
+        elif isinstance(module, nn.Conv2d) and module.kernel_size == (3, 3):
+            setattr(parent, name, Int8Conv2d(module))
+        else:
+            return 0
+        return 1
+
+    count = 0
+    for module in list(model.modules()):
+        if 'attention' in layers and isinstance(module, AttentionBlock):
+            count += quantize(module, 'qkv', module.qkv) + quantize(module, 'proj_out', module.proj_out)
+        if 'time_embed' in layers and isinstance(module, ResBlock):
+            count += quantize(module.emb_layers, '1', module.emb_layers[1])
+        if 'resblock' in layers and isinstance(module, ResBlock):
+            count += quantize(module.in_layers, str(len(module.in_layers) - 1), module.in_layers[-1])
+            count += quantize(module.out_layers, str(len(module.out_layers) - 1), module.out_layers[-1])
+            if isinstance(module.skip_connection, nn.Conv2d):
+                count += quantize(module, 'skip_connection', module.skip_connection)
+    if 'time_embed' in layers and hasattr(model, 'time_embed'):
+        for index, layer in enumerate(list(model.time_embed)):
+            count += quantize(model.time_embed, str(index), layer)
+    return model, count
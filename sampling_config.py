@@ -0,0 +1,181 @@
+"""
+Typed sampling configuration - the comma separated strings of the yaml (depth conversion, loss weight function,
+guidance scale and gradient clipping) are parsed and validated once, before the sampling, into frozen objects
+(python floats tuples and preallocated device tensors) which the operators and the conditioning use on every step.
+"""
+
+from dataclasses import dataclass, field
+from typing import Optional, Tuple, Union
+
+import torch
+
+import utils as utilso
+
+# the depth conversions of utils.convert_depth and the number of values each one expects (None - no values)
+DEPTH_TYPES = {'original': None, 'move': 1, 'gamma': 3}
+LOSS_WEIGHTS = ('none', 'depth')
+
+
+def _parse_floats(value_raw, name):
+    """
+    A comma separated string, a number or a sequence of numbers into a tuple of python floats.
+    """
+    if value_raw is None:
+        return ()
+    if isinstance(value_raw, (int, float)):
+        return (float(value_raw),)
+    if isinstance(value_raw, str):
+        value_raw = [num_str for num_str in value_raw.split(',') if num_str.strip() != '']
+    try:
+        return tuple(float(num) for num in value_raw)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}: expected comma separated numbers, got {value_raw}")
+
+
+# %% depth conversion - the operators depth and the depth loss weight
+
+@dataclass(frozen=True)
+class DepthConfig:
+    """
+    A depth conversion of the unet depth output (utils.convert_depth).
+
+    :param depth_type: original - [0,1], move - depth + value, gamma - ((depth + value[0]) * value[1]) ^ value[2].
+    :param value: the values of the conversion - a float (move) or a tuple of floats (gamma).
+    """
+    depth_type: str = 'original'
+    value: Union[float, Tuple[float, ...], None] = None
+
+    @classmethod
+    def parse(cls, depth_type=None, value=None):
+        if isinstance(depth_type, cls):
+            return depth_type
+        depth_type = 'original' if depth_type is None else depth_type
+        if depth_type not in DEPTH_TYPES:
+            raise ValueError(f"Unknown depth type {depth_type}, use one of {list(DEPTH_TYPES.keys())}")
+
+        values = _parse_floats(value, f"depth {depth_type} value")
+        num_values = DEPTH_TYPES[depth_type]
+        if num_values is None:
+            return cls(depth_type=depth_type, value=None)
+        if len(values) != num_values:
+            raise ValueError(f"Depth type {depth_type} expects {num_values} values, got {value}")
+        return cls(depth_type=depth_type, value=values[0] if num_values == 1 else values)
+
+    @classmethod
+    def from_function(cls, weight_function):
+        """
+        Parse a loss weight function string "function,value0,value1,..." (e.g. gamma,1.4,1.4,1).
+        """
+        if weight_function is None or isinstance(weight_function, cls):
+            return weight_function
+        function_str, value = utilso.parse_weight_function(weight_function)
+        return cls.parse(function_str, value)
+
+    @classmethod
+    def from_kwargs(cls, kwargs):
+        """
+        The depth of an operator - a parsed depth (depth) or the depth_type and value of the yaml.
+        """
+        if kwargs.get('depth', None) is not None:
+            return cls.parse(kwargs['depth'])
+        return cls.parse(kwargs.get('depth_type', None), kwargs.get('value', None))
+
+    def __call__(self, depth):
+        return utilso.convert_depth(depth, depth_type=self.depth_type, value=self.value)
+
+
+# %% guidance - scale per channel and gradient clipping
+
+@dataclass(frozen=True)
+class GuidanceConfig:
+    """
+    The guidance step of the conditioning.
+
+    :param scale: the guidance scale per channel, [1 x C x 1 x 1] on the sampling device (C is 1 or the channels).
+    :param gradient_clip: clip the guidance gradients to [-gradient_clip_value, gradient_clip_value].
+    :param gradient_clip_value: the clipping value, None if there is no clipping.
+    """
+    scale: torch.Tensor = field(repr=False)
+    gradient_clip: bool = False
+    gradient_clip_value: Optional[float] = None
+
+    @classmethod
+    def parse(cls, scale=1.0, gradient_clip="False", device=None):
+        if isinstance(scale, cls):
+            return scale.to(device)
+        scale = torch.tensor(_parse_floats(scale, "scale"), dtype=torch.float, device=device)
+        if scale.numel() == 0:
+            raise ValueError("scale: expected at least one value")
+
+        # "True,0.005" - clip with the value, "False" - no clipping
+        gradient_clip_parts = [num_str.strip() for num_str in str(gradient_clip).split(',')]
+        clip = utilso.str2bool(gradient_clip_parts[0])
+        if clip and len(gradient_clip_parts) < 2:
+            raise ValueError(f"gradient_clip: expected True,value - got {gradient_clip}")
+        clip_value = float(gradient_clip_parts[1]) if clip else None
+
+        return cls(scale=scale[None, ..., None, None], gradient_clip=clip, gradient_clip_value=clip_value)
+
+    @classmethod
+    def from_kwargs(cls, kwargs, device=None):
+        """
+        The guidance of a conditioning method - a parsed guidance (guidance) or the scale and gradient_clip of the yaml.
+        """
+        if kwargs.get('guidance', None) is not None:
+            return cls.parse(kwargs['guidance'], device=device)
+        return cls.parse(kwargs.get('scale', 1.0), kwargs.get('gradient_clip', "False"), device=device)
+
+    def to(self, device):
+        if device is None or self.scale.device == torch.device(device):
+            return self
+        return GuidanceConfig(scale=self.scale.to(device), gradient_clip=self.gradient_clip,
+                              gradient_clip_value=self.gradient_clip_value)
+
+
+# %% the sampling configuration - built once from the yaml
+
+@dataclass(frozen=True)
+class SamplingConfig:
+    """
+    The parsed configuration of the osmosis sampling.
+
+    :param depth: the depth conversion of the operator (measurement operator depth_type and value).
+    :param guidance: the guidance scale and gradient clipping (conditioning scale and gradient_clip).
+    :param loss_weight: none or depth (conditioning loss_weight).
+    :param weight_function: the depth conversion of the depth loss weight (conditioning weight_function).
+    """
+    depth: DepthConfig
+    guidance: GuidanceConfig
+    loss_weight: str = 'none'
+    weight_function: Optional[DepthConfig] = None
+
+    @classmethod
+    def from_args(cls, args, device=None):
+        operator_config = args.measurement['operator']
+        cond_params = args.conditioning['params']
+
+        loss_weight = cond_params.get('loss_weight', None)
+        loss_weight = 'none' if loss_weight is None else loss_weight
+        if loss_weight not in LOSS_WEIGHTS:
+            raise ValueError(f"Unknown loss weight {loss_weight}, use one of {list(LOSS_WEIGHTS)}")
+        weight_function = DepthConfig.from_function(cond_params.get('weight_function', None))
+        if loss_weight == 'depth' and weight_function is None:
+            raise ValueError("loss_weight: depth requires a weight_function (e.g. gamma,1.4,1.4,1)")
+
+        return cls(depth=DepthConfig.from_kwargs(operator_config),
+                   guidance=GuidanceConfig.from_kwargs(cond_params, device=device),
+                   loss_weight=loss_weight,
+                   weight_function=weight_function)
+
+    def operator_params(self, operator_config):
+        """
+        The operator arguments with the parsed depth.
+        """
+        return dict(operator_config, depth=self.depth)
+
+    def conditioning_params(self, cond_params):
+        """
+        The conditioning method arguments with the parsed guidance and loss weight.
+        """
+        return dict(cond_params, guidance=self.guidance, loss_weight=self.loss_weight,
+                    weight_function=self.weight_function)
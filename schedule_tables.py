@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+
+
+class ScheduleTables:
+    """
+    Device-resident copies of every diffusion schedule coefficient.
+
+    The tables are computed once in float64 with numpy (for accuracy) and then stored as
+    torch tensors on the sampling device in the working dtype, so the per-step lookups are a
+    plain tensor index instead of a host-to-device copy of the whole schedule.
+
+    :param betas: a 1-D numpy array of betas for each diffusion timestep.
+    :param timestep_map: the original timestep of each (possibly respaced) timestep,
+                         defaults to the identity map.
+    :param device: the device the tables should live on.
+    :param dtype: the working floating point dtype of the tables.
+    """
+
+    def __init__(self, betas, timestep_map=None, device=None, dtype=torch.float32):
+        betas = np.array(betas, dtype=np.float64)
+        self.num_timesteps = int(betas.shape[0])
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.dtype = dtype
+
+        alphas = 1.0 - betas
+        alphas_cumprod = np.cumprod(alphas, axis=0)
+        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+        posterior_variance = betas * (1.0 - alphas_cumprod_prev) / (1.0 - alphas_cumprod)
+
+        # computed in float64 and cast only once, when moved to the device
+        arrays = {
+            'betas': betas,
+            'log_betas': np.log(betas),
+            'alphas_cumprod': alphas_cumprod,
+            'alphas_cumprod_prev': alphas_cumprod_prev,
+            'sqrt_alphas_cumprod': np.sqrt(alphas_cumprod),
+            'one_minus_alphas_cumprod': 1.0 - alphas_cumprod,
+            'sqrt_one_minus_alphas_cumprod': np.sqrt(1.0 - alphas_cumprod),
+            'log_one_minus_alphas_cumprod': np.log(1.0 - alphas_cumprod),
+            'sqrt_recip_alphas_cumprod': np.sqrt(1.0 / alphas_cumprod),
+            'sqrt_recipm1_alphas_cumprod': np.sqrt(1.0 / alphas_cumprod - 1),
+            'posterior_variance': posterior_variance,
+            # log calculation clipped because the posterior variance is 0 at the beginning of the chain
+            'posterior_log_variance_clipped': np.log(np.append(posterior_variance[1], posterior_variance[1:])),
+            'posterior_mean_coef1': betas * np.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod),
+            'posterior_mean_coef2': (1.0 - alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - alphas_cumprod),
+        }
+        # fixed large variance - the first entry is the posterior variance to get a better decoder log likelihood
+        arrays['fixed_large_variance'] = np.append(posterior_variance[1], betas[1:])
+        arrays['log_fixed_large_variance'] = np.log(arrays['fixed_large_variance'])
+        # the posterior variance is 0 at the beginning of the chain, used only by "fixed_small" and "previous_x"
+        with np.errstate(divide='ignore'):
+            arrays['log_posterior_variance'] = np.log(posterior_variance)
+            arrays['recip_posterior_mean_coef1'] = 1.0 / arrays['posterior_mean_coef1']
+            arrays['posterior_mean_coef2_over_coef1'] = \
+                arrays['posterior_mean_coef2'] / arrays['posterior_mean_coef1']
+
+        self.names = list(arrays.keys())
+        for name, array in arrays.items():
+            setattr(self, name, torch.from_numpy(array).to(device=self.device, dtype=self.dtype))
+
+        if timestep_map is None:
+            timestep_map = np.arange(self.num_timesteps)
+        self.timestep_map = torch.tensor(list(timestep_map), dtype=torch.long, device=self.device)
+
+    def to(self, device=None, dtype=None):
+        """
+        Move (and optionally cast) all the tables, done once and not per sampling step.
+        """
+        device = torch.device(device) if device is not None else self.device
+        dtype = dtype if dtype is not None else self.dtype
+        for name in self.names:
+            setattr(self, name, getattr(self, name).to(device=device, dtype=dtype))
+        self.timestep_map = self.timestep_map.to(device)
+        self.device = device
+        self.dtype = dtype
+        return self
+
+    def extract(self, name, time, target):
+        """
+        Extract the values of a table for a batch of time indices, broadcastable to target.
+
+        :param name: the name of the table, e.g. "posterior_mean_coef1".
+        :param time: a 1-D tensor of time indices, one per batch element.
+        :param target: the [N x C x ...] tensor the values should be expanded to.
+        :return: a tensor of target's shape.
+        """
+        if target.device != self.device:
+            self.to(target.device)
+        array = getattr(self, name)[time]
+        return array.view(-1, *([1] * (target.ndim - 1))).expand_as(target)
@@ -0,0 +1,143 @@
+"""
+Deferred (on device) recording of the per-step sampling values - loss, auxiliary losses and phi's.
+"""
+
+import numpy as np
+import torch
+
+import logger
+
+
+class SamplingTelemetry:
+    """
+    Ring buffer of the per-step sampling values which lives on the sampling device.
+
+    Every recorded step is written into a preallocated device tensor without any host
+    synchronization; the buffer is copied to the host only every `flush_every` steps (or at
+    the end of the sampling) and then the progress bar and the logger are updated.
+
+    :param flush_every: the number of recorded steps between two host flushes,
+                        1 means synchronizing on every step (the progress bar is always up to date).
+    :param log_to_logger: if True, log the last flushed step into the logger on every flush.
+    """
+
+    def __init__(self, flush_every=1, log_to_logger=False):
+        self.flush_every = max(int(flush_every), 1)
+        self.log_to_logger = log_to_logger
+        self.reset()
+
+    def reset(self, pbar=None):
+        """
+        Clear the recorded values, called at the beginning of every sampling loop.
+        """
+        self.pbar = pbar
+        self.history = []
+        self.buffer = None
+        self.layout = None
+        self.time_indices = []
+        self.extras = []
+        self.pending = {}
+
+    def _allocate(self, layout, device):
+        self.layout = layout
+        width = sum([numel for _, numel, _ in layout])
+        self.buffer = torch.empty(self.flush_every, width, device=device, dtype=torch.float32)
+
+    def record(self, time_index, loss, aux_loss=None, variables=None, **extras):
+        """
+        Write the values of a single step into the device buffer (no host synchronization).
+
+        :param time_index: the (python int) time index of the step.
+        :param loss: a tensor of the loss, one value per batch element (or a scalar).
+        :param aux_loss: a dictionary of the auxiliary loss tensors, or None.
+        :param variables: a dictionary of the operator variables (phi's), or None.
+        :param extras: host values of the step (python numbers), kept as they are in the history.
+        """
+        values = [('loss', loss)]
+        values += [(f"aux/{key_ii}", value_ii) for key_ii, value_ii in (aux_loss or {}).items()]
+        values += list((variables or {}).items())
+
+        layout = [(key_ii, value_ii.numel(), tuple(value_ii.shape)) for key_ii, value_ii in values]
+        if self.layout != layout:
+            # a new set of values (e.g. the first step) - flush the old ones and allocate a new buffer
+            self.flush()
+            self._allocate(layout, loss.device)
+
+        row = torch.cat([value_ii.detach().reshape(-1).float() for _, value_ii in values])
+        self.buffer[len(self.time_indices)].copy_(row, non_blocking=True)
+        self.time_indices.append(time_index)
+        # the accumulated values since the last recorded step
+        self.extras.append(dict(self.pending, **extras))
+        self.pending = {}
+
+        if len(self.time_indices) == self.flush_every:
+            self.flush()
+
+    def accumulate(self, key, value):
+        """
+        Add a host value (e.g. the inner phi iterations of a guided step) to the extras of the next recorded step.
+        """
+        self.pending[key] = self.pending.get(key, 0) + value
+
+    def total(self, key):
+        """
+        The sum of an extra value over the flushed steps.
+        """
+        return sum([row.get(key, 0) for row in self.history])
+
+    def flush(self):
+        """
+        Copy the recorded values to the host, update the progress bar and the logger.
+        """
+        if not self.time_indices:
+            return
+
+        # the only host synchronization of the telemetry, a copy since the buffer is reused (also on the cpu)
+        host_buffer = self.buffer[0:len(self.time_indices)].to('cpu', copy=True).numpy()
+
+        for time_index, host_row, extras in zip(self.time_indices, host_buffer, self.extras):
+            row = {'time': time_index}
+            start_ii = 0
+            for key_ii, numel, shape in self.layout:
+                row[key_ii] = host_row[start_ii:start_ii + numel].reshape(shape)
+                start_ii += numel
+            row.update(extras)
+            self.history.append(row)
+
+        self.time_indices = []
+        self.extras = []
+
+        print_dictionary = self.format_row(self.history[-1])
+        if self.pbar is not None:
+            self.pbar.set_postfix(print_dictionary, refresh=False)
+        if self.log_to_logger:
+            logger.log(", ".join([f"{key_ii}={value_ii}" for key_ii, value_ii in print_dictionary.items()]))
+
+    def close(self):
+        """
+        Flush the remaining values, called at the end of every sampling loop.
+        """
+        self.flush()
+        return self.history
+
+    @staticmethod
+    def format_row(row):
+        """
+        Round the values of a recorded step for printing.
+        """
+        print_dictionary = {'time': row['time'], 'loss': np.round(row['loss'], decimals=3)}
+
+        aux_keys = [key_ii for key_ii in row.keys() if key_ii.startswith("aux/")]
+        if aux_keys:
+            print_dictionary['aux'] = np.round([row[key_ii].item() for key_ii in aux_keys], decimals=4)
+
+        for key_ii, value_ii in row.items():
+            if key_ii in ['time', 'loss'] or key_ii.startswith("aux/"):
+                continue
+            current_var_value = np.round(np.squeeze(value_ii), decimals=3)
+            # in case the variable is a matrix
+            if len(current_var_value.shape) > 1:
+                current_var_value = np.round([current_var_value.mean(), current_var_value.std()], decimals=3)
+            print_dictionary[key_ii] = current_var_value
+
+        return print_dictionary
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import pytest
+
+# the modules of the repository are flat (imported by name from the repository root)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# a small osmosis (RGBD in, mean and variance out) unet with attention and scale-shift resblocks
+TINY_UNET = dict(image_size=16, in_channels=4, model_channels=32, out_channels=8, num_res_blocks=1,
+                 attention_resolutions=(2,), channel_mult=(1, 2), num_head_channels=16,
+                 use_scale_shift_norm=True, resblock_updown=True)
+
+# the same small osmosis unet as create_model builds it (the configuration of unet_model)
+UNET_MODEL = dict(image_size=64, num_channels=32, num_res_blocks=1, channel_mult="1,2", learn_sigma=True,
+                  attention_resolutions="32", num_head_channels=16, use_scale_shift_norm=True,
+                  resblock_updown=True, pretrain_model='osmosis')
+
+
+@pytest.fixture
+def tiny_unet():
+    """
+    A factory of seeded tiny unets (in eval mode), the keyword arguments override TINY_UNET.
+    """
+    import torch
+    from unet import UNetModel
+
+    def build(seed=0, **kwargs):
+        torch.manual_seed(seed)
+        model = UNetModel(**dict(TINY_UNET, **kwargs))
+        # the output convolutions are zero initialized - random weights for a non trivial output
+        with torch.no_grad():
+            for param in model.parameters():
+                if not param.any():
+                    param.normal_(0, 0.05)
+        return model.eval()
+
+    return build
+
+
+@pytest.fixture
+def tiny_inputs():
+    """
+    A seeded batch of 2 RGBD inputs of the tiny unet and their timesteps.
+    """
+    import torch
+
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(2, TINY_UNET['in_channels'], TINY_UNET['image_size'], TINY_UNET['image_size'],
+                    generator=generator)
+    return x, torch.tensor([10, 500])
+
+
+# the accuracy guards of the reduced precision unets (bf16 autocast, weight-only int8) against fp32 - max differences
+# relative to the largest fp32 value
+OUTPUT_RTOL = 0.03
+GRAD_RTOL = 0.05
+
+
+def output_and_grad(model, x, t):
+    """
+    The unet output and the input gradient of a guidance-like loss (the x0 related output channels).
+    """
+    import torch
+
+    x = x.clone().requires_grad_(True)
+    out = model(x, t)
+    grad, = torch.autograd.grad(out[:, :4].square().sum(), x)
+    return out.detach(), grad
+
+
+def max_relative_difference(value, reference):
+    return float((value - reference).abs().max() / reference.abs().max())
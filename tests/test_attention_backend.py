@@ -0,0 +1,43 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from unet import ATTENTION_BACKENDS, qkv_attention, set_attention_backend
+
+
+def test_qkv_attention_backends_match():
+    generator = torch.Generator().manual_seed(0)
+    q, k, v = [torch.randn(6, 16, 64, generator=generator) for _ in range(3)]
+
+    reference = qkv_attention(q, k, v, backend="einsum")
+    torch.testing.assert_close(qkv_attention(q, k, v, backend="sdpa"), reference, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("use_new_attention_order", [False, True])
+def test_unet_backends_match(tiny_unet, tiny_inputs, use_new_attention_order):
+    x, timesteps = tiny_inputs
+    model = tiny_unet(use_new_attention_order=use_new_attention_order)
+
+    outputs = {}
+    for backend in ATTENTION_BACKENDS:
+        set_attention_backend(model, backend)
+        with torch.no_grad():
+            outputs[backend] = model(x, timesteps)
+
+    assert outputs["einsum"].abs().max() > 0
+    torch.testing.assert_close(outputs["sdpa"], outputs["einsum"], rtol=1e-4, atol=1e-5)
+
+
+def test_unet_backends_input_gradients_match(tiny_unet, tiny_inputs):
+    # the guidance backward goes through the attention
+    x, timesteps = tiny_inputs
+    model = tiny_unet()
+
+    gradients = {}
+    for backend in ATTENTION_BACKENDS:
+        set_attention_backend(model, backend)
+        x_ii = x.clone().requires_grad_(True)
+        model(x_ii, timesteps).square().sum().backward()
+        gradients[backend] = x_ii.grad
+
+    torch.testing.assert_close(gradients["sdpa"], gradients["einsum"], rtol=1e-4, atol=1e-5)
@@ -0,0 +1,178 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from batch_scheduler import ContinuousBatchingScheduler
+from condition import get_conditioning_method
+from noise import get_operator
+
+NUM_TIMESTEPS = 4
+
+# no guidance at all - the slots are advanced by the schedule only
+SAMPLE_PATTERN = {'pattern': 'pcgs', 'start_guidance': -1, 'stop_guidance': 0, 'update_start': 0.7,
+                  'update_end': 0, 's_start': 0.7, 's_end': 0, 'local_M': 1, 'n_iter': 1}
+
+
+class IdentitySampler:
+    """
+    A sampler of NUM_TIMESTEPS steps which keeps x_t as it is (mean x_t, no noise) and records the timesteps.
+    """
+
+    def __init__(self):
+        self.num_timesteps = NUM_TIMESTEPS
+        self.timestep_map = list(range(NUM_TIMESTEPS))
+        self.original_num_steps = NUM_TIMESTEPS
+        self.calls = []
+
+    def wrap_model(self, model):
+        return model
+
+    def denoise_step(self, model, x, t):
+        self.calls.append(t.tolist())
+        return {'mean': x * 1, 'std': torch.zeros_like(x), 'pred_xstart': x * 1}
+
+
+class PoolOperator:
+
+    def __init__(self, pool_size):
+        self.phi = torch.zeros(pool_size, 3)
+        self.resets = []
+
+    def reset_variables(self, slot_ii):
+        self.resets.append(slot_ii)
+        self.phi[slot_ii] = slot_ii
+
+    def get_variable_gradients(self):
+        return {'phi_a': None}
+
+    def get_variable_list(self):
+        return [self.phi]
+
+
+class PoolConditioning:
+
+    def __init__(self, pool_size):
+        self.operator = PoolOperator(pool_size)
+
+
+def run_stream(num_images, pool_size, seed=0):
+    sampler = IdentitySampler()
+    cond_method = PoolConditioning(pool_size)
+    scheduler = ContinuousBatchingScheduler(sampler, model=None, cond_method=cond_method,
+                                            sample_pattern=SAMPLE_PATTERN, pool_size=pool_size, seed=seed)
+    images = [(torch.full((3, 8, 8), float(image_ii)), f"image_{image_ii}") for image_ii in range(num_images)]
+    return list(scheduler.run(images)), sampler, cond_method
+
+
+def test_every_image_is_sampled_once():
+    results, sampler, cond_method = run_stream(num_images=5, pool_size=2)
+
+    assert [result['info'] for result in results] == [f"image_{image_ii}" for image_ii in range(5)]
+    # 3 rounds of NUM_TIMESTEPS steps - 2 full rounds and a single image in the last one
+    assert len(sampler.calls) == 3 * NUM_TIMESTEPS
+    assert cond_method.operator.resets == [0, 1, 0, 1, 0]
+
+
+def test_slots_at_their_own_timesteps():
+    _, sampler, _ = run_stream(num_images=3, pool_size=2)
+
+    assert sampler.calls[:NUM_TIMESTEPS] == [[3, 3], [2, 2], [1, 1], [0, 0]]
+    # the second slot is empty in the last round (sampled at t=0 and ignored)
+    assert sampler.calls[NUM_TIMESTEPS:] == [[3, 0], [2, 0], [1, 0], [0, 0]]
+
+
+def test_seeded_initial_noise():
+    results, _, _ = run_stream(num_images=3, pool_size=2, seed=7)
+
+    # the identity sampler returns x_T - the x_T of a single image sampling with torch.manual_seed(seed)
+    expected = torch.randn((4, 8, 8), generator=torch.Generator().manual_seed(7))
+    for result in results:
+        assert result['sample'].shape == (4, 8, 8)
+        assert torch.equal(result['sample'], expected)
+        assert result['variables']['phi_a'].shape == (3,)
+
+
+# %% guided pools - the osmosis conditioning with the phi's of every slot
+
+OPERATOR = dict(name='underwater_physical_revised', device=torch.device("cpu"), depth_type='gamma', value='1.4,1.4,1',
+                phi_a='1.1,0.95,0.95', phi_b='0.95,0.8,0.8', phi_inf='0.14,0.29,0.49',
+                phi_a_eta='1e-3', phi_b_eta='1e-3', phi_inf_eta='1e-3')
+
+# guidance at every step, the phi's are frozen at the first step
+GUIDED_PATTERN = {'pattern': 'pcgs', 'start_guidance': 1, 'stop_guidance': 0, 'update_start': 0.7,
+                  'update_end': 0, 's_start': 0.7, 's_end': 0, 'local_M': 1, 'n_iter': 3}
+
+
+class GuidedSampler(IdentitySampler):
+    """
+    A differentiable sampler of NUM_TIMESTEPS steps without noise.
+    """
+
+    def denoise_step(self, model, x, t):
+        self.calls.append(t.tolist())
+        return {'mean': 0.9 * x, 'std': torch.zeros_like(x), 'pred_xstart': torch.tanh(x)}
+
+
+def build_conditioning(optimizer, batch_size):
+    operator = get_operator(optimizer=optimizer, batch_size=batch_size, **OPERATOR)
+    return get_conditioning_method('osmosis', operator, noiser=None, loss_function='norm', loss_weight='none',
+                                   scale='1', gradient_clip='False', gradient_x_prev=True, n_iter=3)
+
+
+def measurements(num_images):
+    generator = torch.Generator().manual_seed(3)
+    return [(torch.tanh(torch.randn(3, 8, 8, generator=generator)), f"image_{image_ii}")
+            for image_ii in range(num_images)]
+
+
+def run_guided_stream(images, pool_size, optimizer):
+    scheduler = ContinuousBatchingScheduler(GuidedSampler(), model=None,
+                                            cond_method=build_conditioning(optimizer, pool_size),
+                                            sample_pattern=GUIDED_PATTERN, pool_size=pool_size, seed=0)
+    return {result['info']: result for result in scheduler.run(images)}
+
+
+@pytest.mark.parametrize("optimizer", ["GD", "sgd", "rmsprop"])
+def test_guided_pool_matches_single_images(optimizer):
+    images = measurements(num_images=3)
+    # the last image is sampled next to an empty slot (masked) - its phi's and optimizer state must not move
+    pooled = run_guided_stream(images, pool_size=2, optimizer=optimizer)
+
+    for image in images:
+        single = run_guided_stream([image], pool_size=1, optimizer=optimizer)[image[1]]
+        torch.testing.assert_close(pooled[image[1]]['sample'], single['sample'], rtol=1e-5, atol=1e-6)
+        for name, value in single['variables'].items():
+            torch.testing.assert_close(pooled[image[1]]['variables'][name], value, rtol=1e-5, atol=1e-6)
+
+
+def test_shared_step_optimizer_is_rejected():
+    with pytest.raises(ValueError, match="adam"):
+        ContinuousBatchingScheduler(GuidedSampler(), model=None, cond_method=build_conditioning("adam", 2),
+                                    sample_pattern=GUIDED_PATTERN, pool_size=2)
+
+
+def test_masked_optimize_keeps_the_state_of_masked_elements():
+    pool = build_conditioning("rmsprop", batch_size=2).operator
+    singles = [build_conditioning("rmsprop", batch_size=1).operator for _ in range(2)]
+    for operator in [pool] + singles:
+        operator.set_variable_gradients(value=True)
+
+    generator = torch.Generator().manual_seed(0)
+    for step_ii in range(4):
+        grads = [torch.randn(variable_ii.shape, generator=generator) for variable_ii in pool.get_variable_list()]
+        update_mask = torch.tensor([True, step_ii % 2 == 0])
+
+        for variable_ii, grad_ii in zip(pool.get_variable_list(), grads):
+            variable_ii.grad = grad_ii.clone()
+        pool.masked_optimize(update_mask)
+
+        # the same steps of every image alone, only when it is updated
+        for element_ii, operator in enumerate(singles):
+            if update_mask[element_ii]:
+                for variable_ii, grad_ii in zip(operator.get_variable_list(), grads):
+                    variable_ii.grad = grad_ii[element_ii:element_ii + 1].clone()
+                operator.optimize(freeze_phi=False)
+
+    for element_ii, operator in enumerate(singles):
+        for variable_ii, single_ii in zip(pool.get_variable_list(), operator.get_variable_list()):
+            torch.testing.assert_close(variable_ii[element_ii:element_ii + 1].detach(), single_ii.detach())
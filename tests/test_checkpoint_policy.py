@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from checkpoint_policy import apply_checkpoint_policy, block_resolutions, checkpoint_blocks, profile_blocks
+from unet import AttentionBlock, ResBlock
+
+
+def test_attention_checkpointed_by_default(tiny_unet):
+    model = tiny_unet()
+
+    blocks = checkpoint_blocks(model)
+    assert all(module.use_checkpoint for _, _, module in blocks if isinstance(module, AttentionBlock))
+    assert not any(module.use_checkpoint for _, _, module in blocks if isinstance(module, ResBlock))
+
+
+@pytest.mark.parametrize("resblock_updown", [False, True])
+def test_block_resolutions_match_the_forward(tiny_unet, resblock_updown):
+    model = tiny_unet(resblock_updown=resblock_updown)
+    sample_shape = (1, 4, 16, 16)
+
+    profile, _ = profile_blocks(model, sample_shape, torch.device("cpu"))
+    assert block_resolutions(model, sample_shape[-1]) == {block_ii['name']: block_ii['resolution']
+                                                          for block_ii in profile}
+
+
+def test_select_policy(tiny_unet):
+    model = tiny_unet()
+
+    names = apply_checkpoint_policy(model, policy='select', sample_shape=(1, 4, 16, 16),
+                                    block_types=('resblock',), resolutions="8")
+    resolutions = block_resolutions(model, 16)
+    assert names and all(resolutions[name] == 8 for name in names)
+    for name, block_type, module in checkpoint_blocks(model):
+        assert module.use_checkpoint == (name in names)
+        if block_type == 'resblock' and resolutions[name] == 8:
+            assert name in names
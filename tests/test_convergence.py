@@ -0,0 +1,102 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from convergence import ConvergenceMonitor
+
+
+def x0_sequence(changes, batch_size=2, seed=0):
+    """
+    x0 predictions of consecutive steps, every one with the given relative change (per image) from the previous one.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    x0 = torch.randn(batch_size, 4, 16, 16, generator=generator)
+    sequence = [x0]
+    for change in changes:
+        direction = torch.randn(x0.shape, generator=generator)
+        direction = direction / torch.linalg.vector_norm(direction, dim=(1, 2, 3), keepdim=True)
+        change = torch.as_tensor(change, dtype=torch.float).view(-1, 1, 1, 1).expand(batch_size, 1, 1, 1)
+        x0 = x0 + change * torch.linalg.vector_norm(x0, dim=(1, 2, 3), keepdim=True) * direction
+        sequence.append(x0)
+    return sequence
+
+
+def run_monitor(monitor, sequence, variables=None, first_idx=20):
+    monitor.reset()
+    for step_ii, x0 in enumerate(sequence):
+        monitor.update(first_idx - step_ii, x0, None if variables is None else variables[step_ii])
+    return monitor
+
+
+def test_converges_after_window_steps():
+    # pool 1 - the relative change of the x0 prediction is exactly the given one
+    monitor = ConvergenceMonitor(tol=1e-2, phi_tol=None, window=3, pool=1)
+
+    assert not run_monitor(monitor, x0_sequence([1e-3, 1e-3])).converged()
+    assert run_monitor(monitor, x0_sequence([1e-3, 1e-3, 1e-3])).converged()
+    # a large change restarts the streak
+    assert not run_monitor(monitor, x0_sequence([1e-3, 1e-3, 0.1, 1e-3, 1e-3])).converged()
+    monitor = run_monitor(monitor, x0_sequence([1e-3, 1e-3, 0.1, 1e-3, 1e-3, 1e-3]))
+    assert monitor.converged()
+    assert monitor.streak_start.tolist() == [16, 16]
+
+
+def test_every_image_should_converge():
+    monitor = ConvergenceMonitor(tol=1e-2, phi_tol=None, window=2, pool=4)
+
+    assert not run_monitor(monitor, x0_sequence([[1e-3, 0.1]] * 4)).converged()
+    assert run_monitor(monitor, x0_sequence([[1e-4, 1e-4]] * 4)).converged()
+
+
+def test_phi_drift():
+    monitor = ConvergenceMonitor(tol=1e-2, phi_tol=1e-3, window=2, pool=1)
+    sequence = x0_sequence([1e-3] * 3)
+
+    phi_inf = torch.full((2, 3, 1, 1), 0.5)
+    steady = [{'phi_inf': phi_inf} for _ in sequence]
+    drifting = [{'phi_inf': phi_inf * (1 + 1e-2 * step_ii)} for step_ii in range(len(sequence))]
+
+    assert run_monitor(monitor, sequence, steady).converged()
+    assert not run_monitor(monitor, sequence, drifting).converged()
+
+
+def test_active_steps():
+    monitor = ConvergenceMonitor(start=0.3)
+
+    assert monitor.is_active(300, 1000) and monitor.is_active(0, 1000)
+    assert not monitor.is_active(301, 1000)
+
+
+def test_stop_mode():
+    monitor = ConvergenceMonitor(mode='stop')
+    monitor = run_monitor(monitor, x0_sequence([1e-4] * 4))
+
+    assert monitor.tail(12) is None
+    monitor.terminate(12, total_steps=50)
+    assert monitor.terminated_at == 12 and monitor.skipped_steps == 12
+    assert monitor.summary(["a.png", "b.png"])[0] == \
+        "a.png: converged from step 19, terminated at step 12 (stop), skipped 12 of 50 steps"
+
+
+def test_jump_mode():
+    monitor = ConvergenceMonitor(mode='jump', jump_stride=5)
+
+    tail = monitor.tail(12)
+    assert tail == {11: 6, 6: 1, 1: 0, 0: -1}
+    monitor.terminate(12, total_steps=50, tail=tail)
+    assert monitor.skipped_steps == 8
+
+    assert monitor.tail(11) == {10: 5, 5: 0, 0: -1}
+    assert monitor.tail(1) == {0: -1}
+
+
+def test_reset():
+    monitor = run_monitor(ConvergenceMonitor(window=1), x0_sequence([1e-4] * 2))
+    monitor.terminate(10, total_steps=50)
+    monitor.reset()
+
+    assert not monitor.converged()
+    assert monitor.terminated_at is None and monitor.summary() == []
+
+    with pytest.raises(NotImplementedError):
+        ConvergenceMonitor(mode='skip')
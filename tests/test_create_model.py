@@ -0,0 +1,57 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from unet import create_model, peak_rss_mb
+
+from conftest import UNET_MODEL
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    torch.manual_seed(0)
+    model = create_model(**UNET_MODEL)
+    path = tmp_path / "unet.pt"
+    torch.save(model.state_dict(), path)
+    return str(path), model.state_dict()
+
+
+def assert_same_weights(model, state_dict):
+    loaded = model.state_dict()
+    assert loaded.keys() == state_dict.keys()
+    for name, tensor in state_dict.items():
+        assert not loaded[name].is_meta
+        assert torch.equal(loaded[name], tensor), name
+
+
+@pytest.mark.parametrize("low_memory_load", [False, True])
+def test_load(checkpoint, low_memory_load):
+    path, state_dict = checkpoint
+    model = create_model(**UNET_MODEL, model_path=path, low_memory_load=low_memory_load)
+
+    assert model.input_blocks[0][0].in_channels == 4 and model.out[-1].out_channels == 8
+    assert_same_weights(model, state_dict)
+
+
+def test_no_checkpoint(capsys):
+    model = create_model(**UNET_MODEL)
+    assert "Randomly initialize" in capsys.readouterr().out
+    assert model.input_blocks[0][0].in_channels == 4
+
+
+@pytest.mark.parametrize("low_memory_load", [False, True])
+def test_missing_checkpoint(tmp_path, low_memory_load):
+    with pytest.raises(FileNotFoundError):
+        create_model(**UNET_MODEL, model_path=str(tmp_path / "missing.pt"), low_memory_load=low_memory_load)
+
+
+@pytest.mark.parametrize("low_memory_load", [False, True])
+def test_mismatched_checkpoint(checkpoint, low_memory_load):
+    path, state_dict = checkpoint
+    # the checkpoint of another (wider) model
+    with pytest.raises(RuntimeError):
+        create_model(**dict(UNET_MODEL, num_channels=64), model_path=path, low_memory_load=low_memory_load)
+
+
+def test_peak_rss():
+    assert peak_rss_mb() > 0 or peak_rss_mb() != peak_rss_mb()
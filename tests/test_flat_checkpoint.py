@@ -0,0 +1,67 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from flat_checkpoint import is_flat_checkpoint, load_flat_checkpoint, save_flat_checkpoint
+from unet import create_model
+
+from conftest import UNET_MODEL
+
+
+@pytest.fixture
+def state_dict():
+    generator = torch.Generator().manual_seed(0)
+    return {'weight': torch.randn(32, 16, generator=generator), 'bias': torch.randn(32, generator=generator),
+            'steps': torch.arange(5), 'empty': torch.zeros(0)}
+
+
+@pytest.mark.parametrize("shard_size_mb", [0, 0.001])
+def test_round_trip(tmp_path, state_dict, shard_size_mb):
+    paths = save_flat_checkpoint(state_dict, str(tmp_path / "model.osm"), shard_size_mb=shard_size_mb)
+
+    assert len(paths) == (1 if shard_size_mb == 0 else 2)
+    assert all(is_flat_checkpoint(path) for path in paths)
+    loaded = load_flat_checkpoint(paths[-1])
+    assert list(loaded.keys()) == list(state_dict.keys())
+    for name, tensor in state_dict.items():
+        assert loaded[name].dtype == tensor.dtype and torch.equal(loaded[name], tensor), name
+
+
+def test_stored_dtype_is_kept(tmp_path, state_dict):
+    path = save_flat_checkpoint(state_dict, str(tmp_path / "model.osm"), dtype=torch.float16)[0]
+
+    # zero-copy - the tensors as they are stored
+    loaded = load_flat_checkpoint(path)
+    assert loaded['weight'].dtype == torch.float16 and loaded['steps'].dtype == torch.int64
+    assert torch.equal(loaded['weight'], state_dict['weight'].half())
+
+    # cast only when asked, the integer tensors as they are
+    loaded = load_flat_checkpoint(path, dtype=torch.float32)
+    assert loaded['weight'].dtype == torch.float32 and loaded['steps'].dtype == torch.int64
+    assert torch.equal(loaded['weight'], state_dict['weight'].half().float())
+
+
+def test_corrupted(tmp_path, state_dict):
+    path = save_flat_checkpoint(state_dict, str(tmp_path / "model.osm"))[0]
+    with open(path, "r+b") as f:
+        f.seek(-1, 2)
+        f.write(b"\xff")
+
+    with pytest.raises(ValueError, match="sha256"):
+        load_flat_checkpoint(path)
+    load_flat_checkpoint(path, verify=False)
+
+
+@pytest.mark.parametrize("checkpoint_dtype", [torch.float32, None])
+@pytest.mark.parametrize("low_memory_load", [False, True])
+def test_create_model(tmp_path, checkpoint_dtype, low_memory_load):
+    torch.manual_seed(0)
+    state_dict = create_model(**UNET_MODEL).state_dict()
+    path = save_flat_checkpoint(state_dict, str(tmp_path / "model.osm"), dtype=torch.float16)[0]
+
+    # a flat checkpoint is always assigned, not copied into an initialized (float32) model - the stored dtype is kept
+    model = create_model(**UNET_MODEL, model_path=path, low_memory_load=low_memory_load,
+                         checkpoint_dtype=checkpoint_dtype)
+    weight = model.out[-1].weight
+    assert weight.dtype == (torch.float16 if checkpoint_dtype is None else torch.float32)
+    assert torch.equal(weight.float(), state_dict['out.2.weight'].half().float())
@@ -0,0 +1,72 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from condition import get_conditioning_method
+from noise import get_operator
+
+OPERATOR = dict(name='underwater_physical_revised', device=torch.device("cpu"), depth_type='gamma', value='1.4,1.4,1',
+                phi_a='1.1,0.95,0.95', phi_b='0.95,0.8,0.8', phi_inf='0.14,0.29,0.49',
+                phi_a_eta='1e-3', phi_b_eta='1e-3', phi_inf_eta='1e-3')
+
+
+def build_conditioning(optimizer, batch_size=2):
+    operator = get_operator(optimizer=optimizer, batch_size=batch_size, **OPERATOR)
+    return get_conditioning_method('osmosis', operator, noiser=None, loss_function='norm', loss_weight='none',
+                                   scale='1', gradient_clip='False', gradient_x_prev=True, n_iter=3,
+                                   phi_lr_stride=True)
+
+
+def seeded_step(seed, batch_size=2):
+    generator = torch.Generator().manual_seed(seed)
+    x_0_hat = torch.tanh(torch.randn(batch_size, 4, 8, 8, generator=generator))
+    measurement = torch.tanh(torch.randn(batch_size, 3, 8, 8, generator=generator))
+    return x_0_hat, measurement
+
+
+def guided_step(cond_method, seed, batch_size=2, step_stride=3):
+    x_0_hat, measurement = seeded_step(seed, batch_size)
+    x_0_step = x_0_hat.clone().requires_grad_()
+    cond_method.conditioning(x_prev=x_0_step, x_t=torch.zeros_like(x_0_hat), x_0_hat=x_0_step,
+                             measurement=measurement, step_stride=step_stride)
+    return [variable_ii.detach().clone() for variable_ii in cond_method.operator.get_variable_list()]
+
+
+@pytest.mark.parametrize("optimizer", ["GD", "sgd", "adam", "lm"])
+def test_reset_matches_a_fresh_operator(optimizer):
+    used = build_conditioning(optimizer)
+    for seed in range(3):
+        guided_step(used, seed)
+    used.reset()
+
+    fresh = build_conditioning(optimizer)
+    for used_ii, fresh_ii in zip(used.operator.get_variable_list(), fresh.operator.get_variable_list()):
+        assert torch.equal(used_ii, fresh_ii)
+        assert used_ii.grad is None
+    if used.operator.optimizer is not None:
+        assert len(used.operator.optimizer.state) == 0
+        assert [group['lr'] for group in used.operator.optimizer.param_groups] == \
+               [group['lr'] for group in fresh.operator.optimizer.param_groups]
+
+    # the next image - the same phi's as a new operator
+    for used_ii, fresh_ii in zip(guided_step(used, seed=10), guided_step(fresh, seed=10)):
+        torch.testing.assert_close(used_ii, fresh_ii)
+
+
+def test_reset_batch_size_and_init_phi():
+    used = build_conditioning("adam")
+    guided_step(used, seed=0)
+    used.reset(batch_size=3, init_phi={'phi_inf': [0.2, 0.3, 0.4]})
+
+    fresh = build_conditioning("adam", batch_size=3)
+    fresh.reset(init_phi={'phi_inf': [0.2, 0.3, 0.4]})
+    phi_a, phi_b, phi_inf = used.operator.get_variable_list()
+    assert phi_a.shape == (3, 3, 1, 1)
+    torch.testing.assert_close(phi_inf.view(3, 3), torch.tensor([[0.2, 0.3, 0.4]] * 3))
+
+    # the optimizer steps the reallocated phi's
+    for used_ii, fresh_ii in zip(guided_step(used, seed=10, batch_size=3), guided_step(fresh, seed=10, batch_size=3)):
+        torch.testing.assert_close(used_ii, fresh_ii)
+
+    with pytest.raises(KeyError):
+        used.reset(init_phi={'phi_ab': [1.0]})
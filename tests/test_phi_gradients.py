@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from condition import get_conditioning_method
+from noise import get_operator
+
+DEPTH = dict(depth_type='gamma', value='1.4,1.4,1')
+
+OPERATORS = {'haze_physical': dict(phi_ab='0.8', phi_inf='0.2,0.3,0.4'),
+             'underwater_physical': dict(phi_ab='1.1,0.9,0.95', phi_inf='0.2,0.3,0.4'),
+             'underwater_physical_revised': dict(phi_a='1.1,0.95,0.95', phi_b='0.95,0.8,0.8',
+                                                 phi_inf='0.14,0.29,0.49')}
+
+
+def build_conditioning(operator_name, loss_function, loss_weight, batch_size=2, **operator_kwargs):
+    operator = get_operator(operator_name, device=torch.device("cpu"), batch_size=batch_size,
+                            **dict(OPERATORS[operator_name], **DEPTH, **operator_kwargs))
+    return get_conditioning_method('osmosis', operator, noiser=None, loss_function=loss_function,
+                                   loss_weight=loss_weight, weight_function='gamma,1.4,1.4,1', scale='1',
+                                   gradient_clip='False')
+
+
+def seeded_inputs(batch_size=2, size=8):
+    generator = torch.Generator().manual_seed(0)
+    x_0_hat = (0.5 * torch.randn(batch_size, 4, size, size, generator=generator)).clamp(-1, 1)
+    measurement = (0.5 * torch.randn(batch_size, 3, size, size, generator=generator)).clamp(-1, 1)
+    return x_0_hat, measurement
+
+
+@pytest.mark.parametrize("operator_name", list(OPERATORS.keys()))
+@pytest.mark.parametrize("loss_function", ["norm", "mse"])
+@pytest.mark.parametrize("loss_weight", ["none", "depth"])
+def test_analytic_gradients_match_autograd(operator_name, loss_function, loss_weight):
+    cond_method = build_conditioning(operator_name, loss_function, loss_weight)
+    operator = cond_method.operator
+    x_0_hat, measurement = seeded_inputs()
+    operator.set_variable_gradients(value=True)
+
+    sep_loss, loss, _ = cond_method.grad_and_value(x_prev=None, x_0_hat=x_0_hat, measurement=measurement)
+    loss.backward(inputs=operator.get_variable_list())
+    autograd_gradients = [variable_ii.grad.clone() for variable_ii in operator.get_variable_list()]
+    for variable_ii in operator.get_variable_list():
+        variable_ii.grad = None
+
+    analytic_loss = cond_method.analytic_phi_gradients(**cond_method.analytic_terms(x_0_hat, measurement))
+
+    torch.testing.assert_close(analytic_loss, sep_loss, rtol=1e-5, atol=1e-6)
+    for variable_ii, autograd_ii in zip(operator.get_variable_list(), autograd_gradients):
+        assert variable_ii.grad.shape == variable_ii.shape
+        torch.testing.assert_close(variable_ii.grad, autograd_ii, rtol=1e-4, atol=1e-6)
+
+
+def test_analytic_gradients_accumulate():
+    cond_method = build_conditioning('underwater_physical_revised', 'norm', 'depth')
+    operator = cond_method.operator
+    x_0_hat, measurement = seeded_inputs()
+    operator.set_variable_gradients(value=True)
+
+    terms = cond_method.analytic_terms(x_0_hat, measurement)
+    cond_method.analytic_phi_gradients(**terms)
+    single = [variable_ii.grad.clone() for variable_ii in operator.get_variable_list()]
+    cond_method.analytic_phi_gradients(**terms)
+
+    for variable_ii, single_ii in zip(operator.get_variable_list(), single):
+        torch.testing.assert_close(variable_ii.grad, 2 * single_ii)
@@ -0,0 +1,70 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from condition import get_conditioning_method
+from noise import get_operator
+
+OPERATOR_CONFIG = dict(device=torch.device("cpu"), batch_size=2, depth_type='gamma', value='1.4,1.4,1')
+
+# the initialization of the phi's and the phi's of the synthetic measurement
+PHI_INIT = {'underwater_physical_revised': dict(phi_a='1.1,0.95,0.95', phi_b='0.95,0.8,0.8', phi_inf='0.14,0.29,0.49'),
+            'underwater_physical': dict(phi_ab='1.1,0.9,0.95', phi_inf='0.2,0.3,0.4'),
+            'haze_physical': dict(phi_ab='0.8', phi_inf='0.2,0.3,0.4')}
+PHI_TRUTH = {'underwater_physical_revised': dict(phi_a='0.6,0.4,0.3', phi_b='1.2,1.0,0.9', phi_inf='0.1,0.4,0.6'),
+             'underwater_physical': dict(phi_ab='0.6,0.4,0.3', phi_inf='0.1,0.4,0.6'),
+             'haze_physical': dict(phi_ab='0.5', phi_inf='0.7,0.7,0.7')}
+
+
+def x0_prediction(size=16):
+    generator = torch.Generator().manual_seed(0)
+    return torch.tanh(torch.randn(OPERATOR_CONFIG['batch_size'], 4, size, size, generator=generator))
+
+
+@pytest.mark.parametrize("operator_name", list(PHI_INIT.keys()))
+def test_lm_recovers_the_phis(operator_name):
+    x_0_hat = x0_prediction()
+    truth = get_operator(operator_name, optimizer="GD", **OPERATOR_CONFIG, **PHI_TRUTH[operator_name])
+    measurement = 2 * truth.forward(x_0_hat) - 1
+
+    operator = get_operator(operator_name, optimizer="lm", lm_steps=10, **OPERATOR_CONFIG, **PHI_INIT[operator_name])
+    cond_method = get_conditioning_method('osmosis', operator, noiser=None, loss_function='norm',
+                                          loss_weight='none', scale='1', gradient_clip='False', n_iter=1,
+                                          gradient_x_prev=True)
+
+    # guided steps on the same (noise free) x0 prediction - the phi's and the damping are carried over
+    for _ in range(5):
+        x_0_step = x_0_hat.clone().requires_grad_()
+        cond_method.conditioning(x_prev=x_0_step, x_t=torch.zeros_like(x_0_hat), x_0_hat=x_0_step,
+                                 measurement=measurement)
+
+    for variable_ii, truth_ii in zip(operator.get_variable_list(), truth.get_variable_list()):
+        torch.testing.assert_close(variable_ii.detach(), truth_ii, rtol=0, atol=1e-3)
+
+
+def test_lm_is_not_a_torch_optimizer():
+    operator = get_operator('underwater_physical_revised', optimizer="lm", **OPERATOR_CONFIG,
+                            **PHI_INIT['underwater_physical_revised'])
+    assert operator.solver == "lm" and operator.optimizer is None
+
+    # the phi's are set by solve_phi only - optimize, masked_optimize and reset leave them as they are
+    operator.set_variable_gradients(value=True)
+    for variable_ii in operator.get_variable_list():
+        variable_ii.grad = torch.ones_like(variable_ii)
+    initial = [variable_ii.detach().clone() for variable_ii in operator.get_variable_list()]
+
+    operator.optimize(freeze_phi=False)
+    operator.masked_optimize(torch.tensor([True, False]), lr_scale=torch.tensor([2.0, 1.0]))
+    for variable_ii, initial_ii in zip(operator.get_variable_list(), initial):
+        assert torch.equal(variable_ii.detach(), initial_ii)
+
+    operator.reset(batch_size=3)
+    assert operator.get_variable_list()[0].shape[0] == 3 and operator.damping is None
+
+
+@pytest.mark.parametrize("optimizer", [None, "", "GD", "sgd"])
+def test_optimizer_names(optimizer):
+    operator = get_operator('haze_physical', optimizer=optimizer, **OPERATOR_CONFIG, **PHI_INIT['haze_physical'])
+
+    assert operator.solver != "lm"
+    assert (operator.optimizer is None) == (optimizer != "sgd")
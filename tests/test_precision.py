@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from gaussian_diffusion import create_sampler
+
+from conftest import GRAD_RTOL, OUTPUT_RTOL, max_relative_difference, output_and_grad
+
+SAMPLER_KWARGS = dict(sampler='ddim', steps=1000, noise_schedule='linear', model_mean_type='epsilon',
+                      model_var_type='learned_range', dynamic_threshold=False, clip_denoised=False,
+                      rescale_timesteps=False, timestep_respacing='ddim50')
+
+GUIDED_PATTERN = {'pattern': 'pcgs', 'start_guidance': 1, 'stop_guidance': 0}
+UNGUIDED_PATTERN = {'pattern': 'pcgs', 'start_guidance': -1, 'stop_guidance': 0}
+
+
+def wrapped_model(model, precision):
+    return create_sampler(precision=precision, **SAMPLER_KWARGS)._wrap_model(model)
+
+
+def test_bf16_within_tolerance(tiny_unet, tiny_inputs):
+    model = tiny_unet()
+    x, t = tiny_inputs
+
+    reference, reference_grad = output_and_grad(wrapped_model(model, 'fp32'), x, t)
+    out, grad = output_and_grad(wrapped_model(model, 'bf16'), x, t)
+
+    assert out.dtype == torch.float32 and grad.dtype == torch.float32
+    assert not torch.equal(out, reference)
+    assert max_relative_difference(out, reference) < OUTPUT_RTOL
+    assert max_relative_difference(grad, reference_grad) < GRAD_RTOL
+
+
+def test_fp16_without_guidance_only():
+    create_sampler(precision='bf16', **SAMPLER_KWARGS).check_precision(GUIDED_PATTERN)
+
+    sampler = create_sampler(precision='fp16', **SAMPLER_KWARGS)
+    sampler.check_precision(UNGUIDED_PATTERN)
+    with pytest.raises(ValueError, match="fp16"):
+        sampler.check_precision(GUIDED_PATTERN)
+    with pytest.raises(ValueError, match="fp16"):
+        sampler.check_precision({'pattern': 'original'})
+
+
+def test_unknown_precision():
+    with pytest.raises(ValueError, match="Unknown precision"):
+        create_sampler(precision='fp8', **SAMPLER_KWARGS)
@@ -0,0 +1,55 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import quantization
+from quantization import Int8Conv2d, Int8Linear, QUANTIZE_LAYERS, quantize_unet
+
+from conftest import GRAD_RTOL, OUTPUT_RTOL, max_relative_difference, output_and_grad
+
+
+@pytest.mark.parametrize("layers", [QUANTIZE_LAYERS, ('attention',), ('time_embed',), ('resblock',)])
+def test_int8_within_tolerance(tiny_unet, tiny_inputs, layers):
+    model = tiny_unet()
+    x, t = tiny_inputs
+    quantized_model, count = quantize_unet(copy.deepcopy(model), layers=layers)
+
+    assert count > 0
+    reference, reference_grad = output_and_grad(model, x, t)
+    out, grad = output_and_grad(quantized_model, x, t)
+    assert max_relative_difference(out, reference) < OUTPUT_RTOL
+    assert max_relative_difference(grad, reference_grad) < GRAD_RTOL
+
+
+def test_quantized_layers(tiny_unet):
+    model, _ = quantize_unet(tiny_unet())
+
+    assert isinstance(model.time_embed[0], Int8Linear) and isinstance(model.time_embed[2], Int8Linear)
+    assert any(isinstance(module, Int8Conv2d) for module in model.modules())
+    assert all(module.qweight.dtype == torch.int8 for module in model.modules()
+               if isinstance(module, (Int8Linear, Int8Conv2d)))
+
+
+def test_unknown_layers(tiny_unet):
+    with pytest.raises(ValueError, match="Unknown quantization layers"):
+        quantize_unet(tiny_unet(), layers=('attention', 'output'))
+
+
+def test_kernel_fallback_logged_once(monkeypatch):
+    def unsupported(*args):
+        raise RuntimeError("unsupported")
+
+    messages = []
+    monkeypatch.setattr(torch, "_weight_int8pack_mm", unsupported, raising=False)
+    monkeypatch.setattr(quantization, "__FALLBACKS__", [])
+    monkeypatch.setattr(quantization.logger, "log", messages.append)
+
+    layers = [Int8Linear(torch.randn(8, 16)) for _ in range(3)]
+    assert not any(layer.int8_kernel for layer in layers)
+    assert len(messages) == 1 and "unsupported" in messages[0]
+
+    # the dequantized matmul
+    x = torch.randn(4, 16)
+    assert torch.allclose(layers[0](x), x @ layers[0].dequantize(torch.float32).t())
@@ -0,0 +1,58 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import utils as utilso
+from sampling_config import DepthConfig, GuidanceConfig
+
+
+def seeded_depth():
+    return torch.rand(2, 1, 8, 8, generator=torch.Generator().manual_seed(0)) * 2 - 1
+
+
+@pytest.mark.parametrize("depth_type", ["original", None])
+def test_original_depth(depth_type):
+    depth = seeded_depth()
+    depth_config = DepthConfig.parse(depth_type)
+
+    assert depth_config == DepthConfig('original', None)
+    torch.testing.assert_close(depth_config(depth), 0.5 * (depth + 1))
+
+
+@pytest.mark.parametrize("depth_type, value", [("gamma", "1.4,1.4,1"), ("gamma", "1.2, 1.5, 0.8"), ("move", "0.5")])
+def test_parsed_depth_matches_the_strings(depth_type, value):
+    depth = seeded_depth()
+
+    expected = utilso.convert_depth(depth, depth_type=depth_type, value=value)
+    torch.testing.assert_close(DepthConfig.parse(depth_type, value)(depth), expected)
+    torch.testing.assert_close(DepthConfig.from_kwargs({'depth_type': depth_type, 'value': value})(depth), expected)
+
+
+def test_depth_of_a_weight_function():
+    depth_config = DepthConfig.from_function("gamma,1.4,1.4,1")
+
+    assert depth_config == DepthConfig('gamma', (1.4, 1.4, 1.0))
+    assert DepthConfig.from_function(depth_config) is depth_config
+    assert DepthConfig.from_function(None) is None
+
+
+@pytest.mark.parametrize("depth_type, value", [("gamma", "1.4,1.4"), ("move", "1,2"), ("linear", "1"),
+                                               ("gamma", "1.4,a,1")])
+def test_invalid_depth(depth_type, value):
+    with pytest.raises(ValueError):
+        DepthConfig.parse(depth_type, value)
+
+
+def test_guidance():
+    guidance = GuidanceConfig.parse("7,7,7,0.9", "True,0.005")
+
+    assert guidance.scale.shape == (1, 4, 1, 1)
+    torch.testing.assert_close(guidance.scale.view(-1), torch.tensor([7, 7, 7, 0.9]))
+    assert guidance.gradient_clip and guidance.gradient_clip_value == 0.005
+
+    guidance = GuidanceConfig.parse(2.0, "False")
+    assert guidance.scale.shape == (1, 1, 1, 1) and not guidance.gradient_clip
+    assert guidance.gradient_clip_value is None
+
+    with pytest.raises(ValueError):
+        GuidanceConfig.parse("7,7,7", "True")
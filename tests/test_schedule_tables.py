@@ -0,0 +1,39 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+import numpy as np
+
+from gaussian_diffusion import create_sampler, get_named_beta_schedule
+from schedule_tables import ScheduleTables
+
+SAMPLER_KWARGS = dict(steps=1000, noise_schedule='linear', model_mean_type='epsilon', model_var_type='learned_range',
+                      dynamic_threshold=False, clip_denoised=False, rescale_timesteps=False)
+
+NAMES = ['alphas_cumprod', 'alphas_cumprod_prev', 'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod',
+         'log_one_minus_alphas_cumprod', 'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod',
+         'posterior_variance', 'posterior_log_variance_clipped', 'posterior_mean_coef1', 'posterior_mean_coef2']
+
+
+@pytest.mark.parametrize("sampler, respacing", [('ddpm', ''), ('ddpm', '100'), ('ddim', 'ddim50')])
+def test_tables_match_numpy(sampler, respacing):
+    diffusion = create_sampler(sampler=sampler, timestep_respacing=respacing, **SAMPLER_KWARGS)
+    x = torch.zeros(3, 4, 2, 2)
+    t = torch.tensor([0, diffusion.num_timesteps // 2, diffusion.num_timesteps - 1])
+
+    for name in NAMES:
+        expected = getattr(diffusion, name)[t.numpy()]
+        extracted = diffusion.tables.extract(name, t, x)
+        assert extracted.shape == x.shape
+        np.testing.assert_allclose(extracted[:, 0, 0, 0].numpy(), expected, rtol=1e-6, atol=1e-12, err_msg=name)
+
+
+def test_timestep_map_of_respaced_schedule():
+    diffusion = create_sampler(sampler='ddim', timestep_respacing='ddim50', **SAMPLER_KWARGS)
+    assert diffusion.tables.timestep_map.tolist() == diffusion.timestep_map
+    assert len(diffusion.timestep_map) == 50 and diffusion.timestep_map[-1] < 1000
+
+
+def test_tables_are_cast_once():
+    tables = ScheduleTables(get_named_beta_schedule('linear', 100))
+    tables.to(dtype=torch.float64)
+    assert all(getattr(tables, name).dtype == torch.float64 for name in tables.names)
@@ -0,0 +1,49 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from gaussian_diffusion import create_sampler
+
+SAMPLER_KWARGS = dict(sampler='ddim', steps=1000, noise_schedule='linear', model_mean_type='epsilon',
+                      model_var_type='learned_range', dynamic_threshold=False, clip_denoised=False,
+                      rescale_timesteps=False, timestep_respacing='ddim10')
+
+UNGUIDED_PATTERN = {'pattern': 'pcgs', 'start_guidance': -1, 'stop_guidance': 0, 'update_start': 0.7,
+                    'update_end': 0, 's_start': 0.7, 's_end': 0, 'local_M': 1, 'n_iter': 1}
+
+
+@pytest.mark.parametrize("add_noise", [True, False])
+def test_unguided_step(tiny_unet, tiny_inputs, add_noise):
+    sampler = create_sampler(eta=1.0, **SAMPLER_KWARGS)
+    model = sampler.wrap_model(tiny_unet())
+    x, _ = tiny_inputs
+    t = torch.tensor([5, 5])
+    noise = torch.randn(x.shape, generator=torch.Generator().manual_seed(2))
+
+    with torch.inference_mode():
+        sample, pred_xstart = sampler.unguided_step(model, x, t, noise, add_noise)
+        out = sampler.denoise_step(model, x, t)
+
+    torch.testing.assert_close(pred_xstart, out['pred_xstart'])
+    torch.testing.assert_close(sample, out['mean'] + out['std'] * noise if add_noise else out['mean'])
+
+
+def test_fast_path_matches_the_autograd_path(tiny_unet, tiny_inputs):
+    # a deterministic ddim (eta=0) without guidance - the same samples with and without the fast path
+    sampler = create_sampler(eta=0.0, **SAMPLER_KWARGS)
+    model = tiny_unet()
+    x, _ = tiny_inputs
+    measurement = torch.zeros(x.shape[0], 3, x.shape[2], x.shape[3])
+
+    samples = []
+    for fast_path in [True, False]:
+        sample, _, loss, pred_xstart = sampler.p_sample_loop(model=model, x_start=x.clone(), measurement=measurement,
+                                                             measurement_cond_fn=None, record=False, save_root=None,
+                                                             pretrain_model='osmosis',
+                                                             sample_pattern=UNGUIDED_PATTERN,
+                                                             inference_fast_path=fast_path)
+        assert loss is None
+        samples.append((sample, pred_xstart))
+
+    torch.testing.assert_close(samples[0][0], samples[1][0])
+    torch.testing.assert_close(samples[0][1], samples[1][1])
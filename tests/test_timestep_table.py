@@ -0,0 +1,58 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+FROZEN = [10.0, 250.0, 500.0]
+
+
+def test_frozen_embeddings_match(tiny_unet, tiny_inputs):
+    x, timesteps = tiny_inputs
+    model = tiny_unet()
+    with torch.no_grad():
+        reference = model(x, timesteps)
+        model.freeze_timesteps(FROZEN)
+        assert model.timestep_rows(timesteps) is not None
+        torch.testing.assert_close(model(x, timesteps), reference)
+
+
+def test_unknown_timesteps_on_the_cpu(tiny_unet, tiny_inputs):
+    x, _ = tiny_inputs
+    timesteps = torch.tensor([10, 11])
+    model = tiny_unet()
+    with torch.no_grad():
+        reference = model(x, timesteps)
+        model.freeze_timesteps(FROZEN)
+        # computed as usual
+        assert model.timestep_rows(timesteps) is None
+        torch.testing.assert_close(model(x, timesteps), reference)
+    model.check_timesteps()
+
+
+def test_table_follows_the_weights(tiny_unet, tiny_inputs):
+    x, timesteps = tiny_inputs
+    model = tiny_unet()
+    model.freeze_timesteps(FROZEN)
+    table = model.timestep_table
+
+    with torch.no_grad():
+        model.time_embed[0].weight.mul_(2)
+        reference_table = model(x, timesteps)
+        assert model.timestep_table is not table
+        model.unfreeze_timesteps()
+        torch.testing.assert_close(reference_table, model(x, timesteps))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="the lazy lookup check is on a gpu only")
+def test_unknown_timesteps_on_a_gpu(tiny_unet, tiny_inputs):
+    x, _ = tiny_inputs
+    model = tiny_unet().cuda()
+    model.freeze_timesteps(FROZEN)
+    with torch.no_grad():
+        model(x.cuda(), torch.tensor([10, 500], device="cuda"))
+        model.check_timesteps()
+        model(x.cuda(), torch.tensor([10, 11], device="cuda"))
+
+    with pytest.raises(ValueError, match="1 batch elements"):
+        model.check_timesteps()
+    # the count is cleared by the check
+    model.check_timesteps()
@@ -0,0 +1,93 @@
+"""
+Frozen inference timestep embeddings - the time_embed output and every ResBlock emb_layers output (scale/shift)
+precomputed once for the timesteps of the sampling schedule, the unet forward indexes the table.
+"""
+
+import torch as th
+
+from timestep_embedding import timestep_embedding
+
+
+class TimestepTable:
+    """
+    The timestep embeddings of a UNetModel for a fixed set of timesteps.
+
+    The table is valid as long as the weights it was computed from are the same tensors (data pointers) and were
+    not modified in place (versions), e.g. by load_state_dict, an optimizer step or a device / dtype conversion.
+
+    :param model: the UNetModel, in eval mode.
+    :param timesteps: the timesteps the model is called with (the sampler timestep map, possibly rescaled).
+    """
+
+    def __init__(self, model, timesteps):
+        device = next(model.parameters()).device
+        self.timesteps = sorted(set(float(timestep_ii) for timestep_ii in timesteps))
+        self.keys = th.tensor(self.timesteps, dtype=th.float32, device=device)
+        self.blocks = model.timestep_blocks()
+
+        with th.no_grad():
+            emb = model.time_embed(timestep_embedding(self.keys, model.model_channels))
+            self.emb = emb
+            self.emb_out = {block: block.emb_layers(emb) for block in self.blocks}
+        self.fingerprint = self.weights_fingerprint(model)
+        # the batch elements which were looked up with a timestep which is not in the table (on a gpu, see select)
+        self.misses = th.zeros((), dtype=th.long, device=device)
+
+    def weights_fingerprint(self, model):
+        # the buffers - the weights of quantized layers (quantization.py)
+        modules = [model.time_embed] + [block.emb_layers for block in self.blocks]
+        tensors = [tensor for module in modules for tensor in list(module.parameters()) + list(module.buffers())]
+        return tuple((tensor.data_ptr(), tensor._version) for tensor in tensors)
+
+    def is_valid(self, model):
+        return self.fingerprint == self.weights_fingerprint(model)
+
+    def select(self, timesteps):
+        """
+        The rows of a batch of timesteps, None if a timestep is not in the table.
+
+        On the cpu an unknown timestep is computed as usual. On a gpu a host check would synchronize every unet call,
+        the unknown timesteps are counted on the device instead and check raises for them (once per sampling) - the
+        sampler calls the model with the timesteps of the table only.
+        """
+        timesteps = timesteps.float()
+        rows = th.searchsorted(self.keys, timesteps).clamp_(max=self.keys.shape[0] - 1)
+        hits = self.keys[rows] == timesteps
+        if timesteps.device.type == 'cpu':
+            if not bool(hits.all()):
+                return None
+        else:
+            self.misses += (~hits).sum()
+        return TimestepRows(self, rows)
+
+    def check(self):
+        """
+        Raise if a timestep which is not in the table was looked up (a single host synchronization).
+        """
+        misses = int(self.misses.item())
+        if misses > 0:
+            self.misses.zero_()
+            raise ValueError(f"{misses} batch elements were looked up with timesteps which are not in the frozen "
+                             f"timestep table (they got the embeddings of another timestep), freeze the timesteps "
+                             f"the model is called with or unfreeze_timesteps")
+
+    def size_mb(self):
+        tables = [self.emb] + list(self.emb_out.values())
+        return sum([table.numel() * table.element_size() for table in tables]) / 2 ** 20
+
+
+class TimestepRows:
+    """
+    The timestep embeddings of a batch - passed to the blocks instead of the embedding tensor.
+    """
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+
+    @property
+    def emb(self):
+        return self.table.emb[self.rows]
+
+    def emb_out(self, block):
+        return self.table.emb_out[block][self.rows]
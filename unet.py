@@ -5,6 +5,7 @@ import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 import functools
+import time
 
 from checkpoint import checkpoint
 from conv_nd import conv_nd
@@ -12,8 +13,11 @@ from avg_pool_nd import avg_pool_nd
 from linear import linear
 from normalization import normalization
 from timestep_embedding import timestep_embedding
+from timestep_table import TimestepTable, TimestepRows
 from zero_module import zero_module
 from change_ip_op import change_input_output_unet
+from flat_checkpoint import is_flat_checkpoint, load_flat_checkpoint
+from quantization import QUANTIZE_MODES, QUANTIZE_LAYERS, quantize_unet
 from precision_manipulator import convert_module_to_f16, convert_module_to_f32
 
 NUM_CLASSES = 1000
@@ -37,9 +41,37 @@ def create_model(
         resblock_updown=False,
         use_fp16=False,
         use_new_attention_order=False,
+        attention_backend="einsum",
+        feature_cache_interval=0,
+        feature_cache_depth=1,
         model_path='',
         pretrain_model='',
+        low_memory_load=False,
+        verify_checkpoint=True,
+        checkpoint_dtype=th.float32,
+        quantize='none',
+        quantize_layers=",".join(QUANTIZE_LAYERS),
 ):
+    """
+    Create the unet and load the pretrained weights of model_path.
+
+    An empty model_path is a randomly initialized model, a model_path which can not be loaded (a missing file,
+    missing or unexpected keys, a corrupted checkpoint) raises. With low_memory_load the model is constructed
+    on the meta device (no allocation and no initialization) with the final input/output convolutions and the
+    memory mapped checkpoint tensors are assigned to it, otherwise the model is initialized, its convolutions are
+    changed (change_input_output_unet) and the checkpoint is read.
+
+    A flat checkpoint (flat_checkpoint.py) is detected by its magic and always loaded as with low_memory_load
+    (zero-copy, without unpickling), its sha256 is checked with verify_checkpoint. The weights of a pre-cast
+    (fp16/bf16) flat checkpoint are converted to checkpoint_dtype (a copy), None - the stored dtype is kept (for the
+    autocast precisions).
+
+    With quantize int8 the quantize_layers (comma separated, see quantize_unet) are replaced by weight-only int8
+    layers after the weights are loaded.
+    """
+    if quantize not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantization {quantize}, use one of {list(QUANTIZE_MODES)}")
+
     if channel_mult == "":
         if image_size == 512:
             channel_mult = (0.5, 1, 1, 2, 2, 4, 4)
@@ -63,7 +95,7 @@ def create_model(
     else:
         raise NotImplementedError
 
-    model = UNetModel(
+    model_kwargs = dict(
         image_size=image_size,
         in_channels=3,
         model_channels=num_channels,
@@ -81,19 +113,75 @@ def create_model(
         use_scale_shift_norm=use_scale_shift_norm,
         resblock_updown=resblock_updown,
         use_new_attention_order=use_new_attention_order,
+        attention_backend=attention_backend,
+        feature_cache_interval=feature_cache_interval,
+        feature_cache_depth=feature_cache_depth,
     )
 
-    # update number of channels according the pretrained model
-    if pretrain_model == "osmosis":
-        model = change_input_output_unet(model, in_channels=4, out_channels=8)
+    def initialized_model():
+        model = UNetModel(**model_kwargs)
+        # update number of channels according the pretrained model
+        if pretrain_model == "osmosis":
+            model = change_input_output_unet(model, in_channels=4, out_channels=8)
+        return model
+
+    if not model_path:
+        print("No model_path / Randomly initialize")
+        return quantize_model(initialized_model(), quantize, quantize_layers)
+
+    start_time = time.perf_counter()
+    low_memory_load = low_memory_load or is_flat_checkpoint(model_path)
+    if low_memory_load:
+        # the osmosis input/output convolutions (RGBD) are shaped at the construction
+        meta_kwargs = dict(model_kwargs, in_channels=4, out_channels=8) if pretrain_model == "osmosis" \
+            else model_kwargs
+        with th.device("meta"):
+            model = UNetModel(**meta_kwargs)
+        model.load_state_dict(load_state_dict_file(model_path, verify=verify_checkpoint, dtype=checkpoint_dtype),
+                              assign=True)
+        not_loaded = [name for name, tensor in model.state_dict().items() if tensor.is_meta]
+        if not_loaded:
+            raise RuntimeError(f"{model_path}: no weights for {not_loaded}")
+    else:
+        model = initialized_model()
+        model.load_state_dict(load_state_dict_file(model_path, mmap=False, verify=verify_checkpoint))
 
-    try:
-        model.load_state_dict(th.load(model_path, map_location='cpu'))
-    except Exception as e:
-        print(f"Got exception: {e} / Randomly initialize")
+    print(f"Loaded {model_path} ({'meta device, mmap' if low_memory_load else 'initialized, read'}"
+          f"{', flat' if is_flat_checkpoint(model_path) else ''}): "
+          f"{time.perf_counter() - start_time:.2f} sec, peak RSS {peak_rss_mb():.0f} MB")
+    return quantize_model(model, quantize, quantize_layers)
+
+
+def quantize_model(model, quantize='none', quantize_layers=",".join(QUANTIZE_LAYERS)):
+    if quantize == 'int8':
+        layers = [layer.strip() for layer in quantize_layers.split(",") if layer.strip()]
+        model, count = quantize_unet(model, layers=layers)
+        print(f"Quantized {count} layers ({', '.join(layers)}) to weight-only int8")
     return model
 
 
+def load_state_dict_file(model_path, mmap=True, verify=True, dtype=None):
+    """
+    The state dict of a flat checkpoint (memory mapped) or of a torch.save checkpoint (memory mapped with mmap).
+
+    :param dtype: the dtype of the floating point tensors of a flat checkpoint, None - as stored.
+    """
+    if is_flat_checkpoint(model_path):
+        return load_flat_checkpoint(model_path, verify=verify, dtype=dtype)
+    return th.load(model_path, map_location='cpu', mmap=mmap, weights_only=True)
+
+
+def peak_rss_mb():
+    """
+    The peak resident memory of the process in MB (linux), nan where it is not available (e.g. windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
 class AttentionPool2d(nn.Module):
     """
     Adapted from CLIP: https://github.com/openai/CLIP/blob/main/clip/model.py
@@ -105,6 +193,7 @@ class AttentionPool2d(nn.Module):
             embed_dim: int,
             num_heads_channels: int,
             output_dim: int = None,
+            attention_backend="einsum",
     ):
         super().__init__()
         self.positional_embedding = nn.Parameter(
@@ -113,7 +202,7 @@ class AttentionPool2d(nn.Module):
         self.qkv_proj = conv_nd(1, embed_dim, 3 * embed_dim, 1)
         self.c_proj = conv_nd(1, embed_dim, output_dim or embed_dim, 1)
         self.num_heads = embed_dim // num_heads_channels
-        self.attention = QKVAttention(self.num_heads)
+        self.attention = QKVAttention(self.num_heads, backend=attention_backend)
 
     def forward(self, x):
         b, c, *_spatial = x.shape
@@ -317,7 +406,9 @@ class ResBlock(TimestepBlock):
             h = in_conv(h)
         else:
             h = self.in_layers(x)
-        emb_out = self.emb_layers(emb).type(h.dtype)
+        # a frozen timestep table (TimestepRows) holds the emb_layers output of every block
+        emb_out = emb.emb_out(self) if isinstance(emb, TimestepRows) else self.emb_layers(emb)
+        emb_out = emb_out.type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
         if self.use_scale_shift_norm:
@@ -337,6 +428,9 @@ class AttentionBlock(nn.Module):
 
     Originally ported from here, but adapted to the N-d case.
     https://github.com/hojonathanho/diffusion/blob/1e0dceb3b3495bbe19116a5e1b3596cd0706c543/diffusion_tf/models/unet.py#L66.
+
+    The attention blocks are checkpointed by default (regardless of the unet use_checkpoint), a checkpoint
+    policy (checkpoint_policy.py) sets the checkpointing of every block.
     """
 
     def __init__(
@@ -344,8 +438,9 @@ class AttentionBlock(nn.Module):
             channels,
             num_heads=1,
             num_head_channels=-1,
-            use_checkpoint=False,
+            use_checkpoint=True,
             use_new_attention_order=False,
+            attention_backend="einsum",
     ):
         super().__init__()
         self.channels = channels
@@ -361,15 +456,15 @@ class AttentionBlock(nn.Module):
         self.qkv = conv_nd(1, channels, channels * 3, 1)
         if use_new_attention_order:
             # split qkv before split heads
-            self.attention = QKVAttention(self.num_heads)
+            self.attention = QKVAttention(self.num_heads, backend=attention_backend)
         else:
             # split heads before split qkv
-            self.attention = QKVAttentionLegacy(self.num_heads)
+            self.attention = QKVAttentionLegacy(self.num_heads, backend=attention_backend)
 
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)
+        return checkpoint(self._forward, (x,), self.parameters(), self.use_checkpoint)
 
     def _forward(self, x):
         b, c, *spatial = x.shape
@@ -400,14 +495,113 @@ def count_flops_attn(model, _x, y):
     model.total_ops += th.DoubleTensor([matmul_ops])
 
 
+ATTENTION_BACKENDS = ("einsum", "sdpa")
+
+
+def qkv_attention(q, k, v, backend="einsum"):
+    """
+    Scaled dot product attention of the heads.
+
+    :param q, k, v: [N x C x T] tensors of Qs, Ks and Vs, the batch and the heads are merged (N = B * H).
+    :param backend: "einsum" - the [N x T x T] weight matrix is materialized (and kept for the backward pass),
+                    "sdpa" - torch scaled_dot_product_attention, which picks a fused (flash / memory efficient)
+                    kernel and does not keep the weight matrix.
+    :return: an [N x C x T] tensor after attention.
+    """
+    ch = q.shape[1]
+    if backend == "sdpa":
+        # sdpa attends over the second to last dimension, the fused kernels require [B x H x T x C] inputs
+        # with a contiguous C (otherwise it silently falls back to the math kernel), the default scale is 1 / sqrt(C)
+        q, k, v = [x.transpose(1, 2).contiguous().unsqueeze(0) for x in (q, k, v)]
+        a = F.scaled_dot_product_attention(q, k, v)
+        return a.squeeze(0).transpose(1, 2)
+    elif backend == "einsum":
+        scale = 1 / math.sqrt(math.sqrt(ch))
+        weight = th.einsum(
+            "bct,bcs->bts", q * scale, k * scale
+        )  # More stable with f16 than dividing afterwards
+        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
+        return th.einsum("bts,bcs->bct", weight, v)
+    else:
+        raise NotImplementedError(f"unknown attention backend: {backend}, use one of {ATTENTION_BACKENDS}")
+
+
+def set_attention_backend(model, backend):
+    """
+    Set the attention backend of all the attention layers of a model (the weights are not changed).
+    """
+    if backend not in ATTENTION_BACKENDS:
+        raise NotImplementedError(f"unknown attention backend: {backend}, use one of {ATTENTION_BACKENDS}")
+    for module in model.modules():
+        if isinstance(module, (QKVAttention, QKVAttentionLegacy)):
+            module.backend = backend
+    return model
+
+
+class DeepFeatureCache:
+    """
+    DeepCache-style reuse of the deep UNet features across adjacent sampling steps.
+
+    Every interval-th call of the model is a cache step - the full model, the input of the last depth output blocks
+    (the deep features - the middle block and the deep skip connections) is kept. The other calls are reuse steps -
+    only the first depth input blocks and the last depth output blocks run, with the cached deep features.
+
+    The cached features are detached, the guidance gradients of a reuse step flow through the shallow blocks only.
+
+    :param interval: the number of model calls per cache step.
+    :param depth: the number of shallow input (and output) blocks which run on the reuse steps.
+    """
+
+    def __init__(self, interval, depth=1):
+        self.interval = interval
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        """
+        Drop the cached features, called at the beginning of every sampling loop.
+        """
+        self.features = None
+        self.calls = 0
+
+    def reuse(self, h):
+        """
+        True if the call of h is a reuse step - not a cache step and there are cached features of the same batch.
+        """
+        reuse = self.features is not None and self.calls % self.interval != 0 and \
+            self.features.shape[0] == h.shape[0]
+        self.calls += 1
+        return reuse
+
+    def store(self, h):
+        self.features = h.detach()
+
+    def get(self):
+        # features of an inference mode step (no guidance) are copied for a guided step
+        if self.features.is_inference() and not th.is_inference_mode_enabled():
+            return self.features.clone()
+        return self.features
+
+
+def set_feature_cache(model, interval=0, depth=1):
+    """
+    Set the deep feature cache of all the UNet models of a model, interval 0 or 1 - no cache (every step is full).
+    """
+    for module in model.modules():
+        if isinstance(module, UNetModel):
+            module.set_feature_cache(interval=interval, depth=depth)
+    return model
+
+
 class QKVAttentionLegacy(nn.Module):
     """
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend="einsum"):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = backend
 
     def forward(self, qkv):
         """
@@ -420,12 +614,7 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v)
+        a = qkv_attention(q, k, v, backend=self.backend)
         return a.reshape(bs, -1, length)
 
     @staticmethod
@@ -438,9 +627,10 @@ class QKVAttention(nn.Module):
     A module which performs QKV attention and splits in a different order.
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend="einsum"):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = backend
 
     def forward(self, qkv):
         """
@@ -453,14 +643,10 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
+        a = qkv_attention(q.reshape(bs * self.n_heads, ch, length),
+                          k.reshape(bs * self.n_heads, ch, length),
+                          v.reshape(bs * self.n_heads, ch, length),
+                          backend=self.backend)
         return a.reshape(bs, -1, length)
 
     @staticmethod
@@ -497,6 +683,11 @@ class UNetModel(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attention_backend: "einsum" - the weight matrix is materialized, or "sdpa" -
+                              torch scaled_dot_product_attention (memory efficient kernels).
+    :param feature_cache_interval: reuse the deep features (DeepFeatureCache) for feature_cache_interval - 1
+                                   calls after every full call, 0 or 1 - no reuse.
+    :param feature_cache_depth: the number of shallow input/output blocks which run on the reuse calls.
     """
 
     def __init__(
@@ -520,6 +711,9 @@ class UNetModel(nn.Module):
             use_scale_shift_norm=False,
             resblock_updown=False,
             use_new_attention_order=False,
+            attention_backend="einsum",
+            feature_cache_interval=0,
+            feature_cache_depth=1,
     ):
         super().__init__()
 
@@ -577,10 +771,10 @@ class UNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attention_backend=attention_backend,
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -622,10 +816,10 @@ class UNetModel(nn.Module):
             ),
             AttentionBlock(
                 ch,
-                use_checkpoint=use_checkpoint,
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
+                attention_backend=attention_backend,
             ),
             ResBlock(
                 ch,
@@ -658,10 +852,10 @@ class UNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
                             num_heads=num_heads_upsample,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attention_backend=attention_backend,
                         )
                     )
                 if level and i == num_res_blocks:
@@ -690,6 +884,64 @@ class UNetModel(nn.Module):
             zero_module(conv_nd(dims, input_ch, out_channels, 3, padding=1)),
         )
 
+        self.set_feature_cache(interval=feature_cache_interval, depth=feature_cache_depth)
+        self.timestep_table = None
+
+    def timestep_blocks(self):
+        """
+        The blocks which project the timestep embedding (emb_layers).
+        """
+        return [module for module in self.modules() if isinstance(module, ResBlock)]
+
+    def freeze_timesteps(self, timesteps):
+        """
+        Frozen inference - precompute the timestep embeddings of the blocks for the timesteps the model is
+        called with (e.g. the timesteps of the sampling schedule), the other timesteps are computed as usual.
+        The table is recomputed if the weights change, it is not used in training mode.
+        """
+        with th.inference_mode(False):
+            self.timestep_table = TimestepTable(self, timesteps)
+        return self.timestep_table
+
+    def unfreeze_timesteps(self):
+        self.timestep_table = None
+
+    def check_timesteps(self):
+        """
+        Raise if the frozen timestep table was used with other timesteps (see TimestepTable.check).
+        """
+        if self.timestep_table is not None:
+            self.timestep_table.check()
+
+    def timestep_rows(self, timesteps):
+        """
+        The frozen timestep embeddings of a batch, None if they should be computed.
+        """
+        table = self.timestep_table
+        if table is None or self.training or self.num_classes is not None:
+            return None
+        if not table.is_valid(self):
+            misses = table.misses
+            table = self.freeze_timesteps(table.timesteps)
+            table.misses += misses
+        return table.select(timesteps)
+
+    def set_feature_cache(self, interval=0, depth=1):
+        """
+        Reuse the deep features across adjacent calls (steps), interval 0 or 1 - no reuse.
+        """
+        if interval > 1:
+            if not 0 < depth < len(self.input_blocks):
+                raise ValueError(f"feature cache depth should be in [1, {len(self.input_blocks) - 1}], got {depth}")
+            self.feature_cache = DeepFeatureCache(interval, depth)
+        else:
+            self.feature_cache = None
+        return self
+
+    def reset_feature_cache(self):
+        if self.feature_cache is not None:
+            self.feature_cache.reset()
+
     def convert_to_fp16(self):
         """
         Convert the torso of the model to float16.
@@ -720,18 +972,35 @@ class UNetModel(nn.Module):
         ), "must specify y if and only if the model is class-conditional"
 
         hs = []
-        emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
+        emb = self.timestep_rows(timesteps)
+        if emb is None:
+            emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
         h = x.type(self.dtype)
+        cache = self.feature_cache
+        if cache is not None and cache.reuse(h):
+            # reuse step - the shallow blocks only, the deep features of the last cache step
+            for module in self.input_blocks[:cache.depth]:
+                h = module(h, emb)
+                hs.append(h)
+            h = cache.get()
+            for module in self.output_blocks[-cache.depth:]:
+                h = th.cat([h, hs.pop()], dim=1)
+                h = module(h, emb)
+            h = h.type(x.dtype)
+            return self.out(h)
+
         for module in self.input_blocks:
             h = module(h, emb)
             hs.append(h)
         h = self.middle_block(h, emb)
-        for module in self.output_blocks:
+        for i, module in enumerate(self.output_blocks):
+            if cache is not None and i == len(self.output_blocks) - cache.depth:
+                cache.store(h)
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb)
         h = h.type(x.dtype)
@@ -783,6 +1052,7 @@ class EncoderUNetModel(nn.Module):
             resblock_updown=False,
             use_new_attention_order=False,
             pool="adaptive",
+            attention_backend="einsum",
     ):
         super().__init__()
 
@@ -835,10 +1105,10 @@ class EncoderUNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attention_backend=attention_backend,
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -880,10 +1150,10 @@ class EncoderUNetModel(nn.Module):
             ),
             AttentionBlock(
                 ch,
-                use_checkpoint=use_checkpoint,
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
+                attention_backend=attention_backend,
             ),
             ResBlock(
                 ch,
@@ -910,7 +1180,8 @@ class EncoderUNetModel(nn.Module):
                 normalization(ch),
                 nn.SiLU(),
                 AttentionPool2d(
-                    (image_size // ds), ch, num_head_channels, out_channels
+                    (image_size // ds), ch, num_head_channels, out_channels,
+                    attention_backend=attention_backend,
                 ),
             )
         elif pool == "spatial":
@@ -493,9 +493,11 @@ def get_os():
 # %% return torch optimizer by name
 
 def get_optimizer(optimizer_name, model_parameters, **kwargs):
-    optimizer_name = optimizer_name.lower()
+    optimizer_name = (optimizer_name or "").lower()
 
-    if optimizer_name is None or optimizer_name == "gd" or optimizer_name == "":
+    # gd - the gradient descent of the operators, lm - their per step phi solver (closed form phi_inf and
+    # Levenberg-Marquardt), neither one is a torch optimizer
+    if optimizer_name == "gd" or optimizer_name == "" or optimizer_name == "lm":
         return None
     elif optimizer_name == 'adam':
         return optim.Adam(model_parameters, **kwargs)
@@ -519,8 +521,6 @@ def get_optimizer(optimizer_name, model_parameters, **kwargs):
         return optim.LBFGS(model_parameters, **kwargs)
     elif optimizer_name == 'rprop':
         return optim.Rprop(model_parameters, **kwargs)
-    elif optimizer_name == 'rprop':
-        return optim.Rprop(model_parameters, **kwargs)
     else:
         raise ValueError(f"Optimizer '{optimizer_name}' is not supported.")
 
@@ -528,13 +528,17 @@ def get_optimizer(optimizer_name, model_parameters, **kwargs):
 # %% change depth function according to the input of depth type
 
 def get_depth_value(value_raw, **kwargs):
-    if isinstance(value_raw, float):
+    if value_raw is None:
+        # the original conversion has no values
+        value = None
+    elif isinstance(value_raw, float):
         value = value_raw
     elif isinstance(value_raw, int):
         value = float(value_raw)
     elif isinstance(value_raw, str):
         value = np.fromstring(value_raw, dtype=float, sep=',')
-    elif isinstance(value_raw, (np.ndarray, np.generic)):
+    elif isinstance(value_raw, (tuple, np.ndarray, np.generic)):
+        # already parsed (e.g. sampling_config.DepthConfig)
         value = value_raw
     else:
         raise NotImplementedError
@@ -567,6 +571,46 @@ def convert_depth(depth, depth_type, **kwargs):
     return depth_out
 
 
+# %% initial RGBD guess of a partial (SDEdit like) sampling - the measurement rgb and a cheap depth prior
+
+DEPTH_PRIORS = ('constant', 'dark_channel', 'underwater_dark_channel')
+
+
+def depth_prior(rgb, prior='constant', patch_size=15):
+    """
+    A cheap depth estimation of an image, in the unet depth range [-1,1] (far is larger).
+
+    :param rgb: the image [B x 3 x H x W] in [-1,1].
+    :param prior: constant - the middle of the range, dark_channel - the dark channel (the minimum over the channels
+                  and a patch) which grows with the haze, underwater_dark_channel - the same over the green and blue
+                  channels only (the red channel is absorbed in water).
+    :param patch_size: the (odd) patch size of the dark channel.
+    :return: [B x 1 x H x W] depth, min-max normalized per image for the dark channel priors.
+    """
+    if prior == 'constant':
+        return torch.zeros_like(rgb[:, 0:1])
+
+    elif prior in ['dark_channel', 'underwater_dark_channel']:
+        channels = rgb if prior == 'dark_channel' else rgb[:, 1:3]
+        dark = channels.min(dim=1, keepdim=True)[0]
+        # minimum filter over the patch
+        dark = -F.max_pool2d(-dark, kernel_size=patch_size, stride=1, padding=patch_size // 2)
+
+        dark_min = dark.amin(dim=(1, 2, 3), keepdim=True)
+        dark_max = dark.amax(dim=(1, 2, 3), keepdim=True)
+        return 2 * (dark - dark_min) / (dark_max - dark_min).clamp(min=1e-6) - 1
+
+    else:
+        raise NotImplementedError(f"Unknown depth prior {prior}, use one of {list(DEPTH_PRIORS)}")
+
+
+def initial_rgbd_guess(measurement, prior='constant', patch_size=15):
+    """
+    The RGBD initial guess of a partial sampling - the measurement as the rgb and a depth prior.
+    """
+    return torch.cat([measurement, depth_prior(measurement, prior=prior, patch_size=patch_size)], dim=1)
+
+
 # %% when pattern sampling - check if freezing phi is required
 
 def is_freeze_phi(sample_pattern, time_index, num_timesteps):
@@ -631,6 +675,44 @@ def set_alternate_length(sample_pattern, time_index, num_timesteps):
     return alternate_length
 
 
+# %% parallel global_N chains - select or aggregate the chains of every image
+
+def aggregate_chains(x_0_pred, variables_dict, loss, num_chains, method="min_loss"):
+    """
+    The chains of an image are consecutive in the batch: [image_0 chain_0, image_0 chain_1, ..., image_1 chain_0, ...]
+
+    min_loss - the chain with the lowest final loss, mean - the mean RGBD prediction, phi's and loss of the chains.
+    In both cases the per-pixel variance of the depth between the chains is returned as well.
+    :return: x_0_pred [B,4,H,W], variables_dict, loss [B], depth variance [B,1,H,W], selected chain per image (or None)
+    """
+    x_0_pred_chains = x_0_pred.reshape(-1, num_chains, *x_0_pred.shape[1:])
+    variables_chains = {key_ii: value_ii.reshape(-1, num_chains, *value_ii.shape[1:])
+                        for key_ii, value_ii in variables_dict.items()}
+    loss_chains = np.asarray(loss).reshape(-1, num_chains)
+
+    depth_variance = x_0_pred_chains[:, :, 3:4].var(dim=1, unbiased=False)
+
+    if method == "min_loss":
+        selected = loss_chains.argmin(axis=1)
+        batch_index = torch.arange(x_0_pred_chains.shape[0])
+        chain_index = torch.from_numpy(selected)
+        x_0_pred_out = x_0_pred_chains[batch_index, chain_index]
+        variables_out = {key_ii: value_ii[batch_index.to(value_ii.device), chain_index.to(value_ii.device)]
+                         for key_ii, value_ii in variables_chains.items()}
+        loss_out = loss_chains[np.arange(loss_chains.shape[0]), selected]
+
+    elif method == "mean":
+        selected = None
+        x_0_pred_out = x_0_pred_chains.mean(dim=1)
+        variables_out = {key_ii: value_ii.mean(dim=1) for key_ii, value_ii in variables_chains.items()}
+        loss_out = loss_chains.mean(axis=1)
+
+    else:
+        raise NotImplementedError(f"Chains aggregation '{method}' is not supported")
+
+    return x_0_pred_out, variables_out, loss_out, depth_variance, selected
+
+
 # %% logging text
 
 def log_text(args):
@@ -672,15 +754,29 @@ def log_text(args):
 
 # %% loss_weight - factor the difference between the  measurement to the degraded image
 
+def parse_weight_function(weight_function):
+    """
+    Split a weight function string "function,value0,value1,..." into the function and its values
+    (a float for a single value, a tuple of floats otherwise, None for no values).
+    """
+    str_parts = weight_function.split(",")
+    function_str = str_parts[0].strip()
+
+    value = tuple(float(num_str) for num_str in str_parts[1:])
+    value = None if len(value) == 0 else (value[0] if len(value) == 1 else value)
+
+    return function_str, value
+
+
 def set_loss_weight(loss_weight_type, weight_function=None, degraded_image=None, x_0_hat=None):
-    # weight function is a string divided into "function,value0,value1,..."
+    # weight function is a parsed depth conversion (sampling_config.DepthConfig, parsed once) or a string divided into
+    # "function,value0,value1,..." (parsed on every call)
+    value = None
     if isinstance(weight_function, str):
-        str_parts = weight_function.split(",")
-        function_str = str_parts[0]
+        function_str, value = parse_weight_function(weight_function)
 
-        if len(str_parts) > 1:
-            value = np.asarray(str_parts[1:]).astype(float)
-            value = value.item() if value.shape[0] == 1 else value
+    elif weight_function is not None:
+        function_str, value = weight_function.depth_type, weight_function.value
 
     else:
         function_str = 'none'